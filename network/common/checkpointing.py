@@ -0,0 +1,57 @@
+"""
+    File Name:          MoReL/checkpointing.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Activation checkpointing for the graph encoders, which store only
+        the inputs of every block of convolution steps (or edge types) in
+        forward, and recompute the activations inside the block during
+        backward. Dropout masks are the same in the recomputation, as the
+        RNG state is restored.
+"""
+import torch
+import inspect
+from typing import List, Optional, Tuple
+from torch.utils.checkpoint import checkpoint as torch_checkpoint
+
+# Non-reentrant checkpointing (PyTorch >= 1.11) works with inputs that do
+# not require gradients (e.g. node attributes) and non-tensor arguments
+NON_REENTRANT = 'use_reentrant' in \
+    inspect.signature(torch_checkpoint).parameters
+
+
+def block_ranges(num_steps: int,
+                 checkpoint_every: Optional[int]) -> List[Tuple[int, int]]:
+    """
+    Ranges [start, end) of the blocks of checkpoint_every steps, or a
+    single block if checkpoint_every is None.
+    """
+    if checkpoint_every is None:
+        return [(0, num_steps)]
+    if checkpoint_every < 1:
+        raise ValueError(f'checkpoint_every must be positive '
+                         f'(got {checkpoint_every}).')
+    return [(__start, min(__start + checkpoint_every, num_steps))
+            for __start in range(0, num_steps, checkpoint_every)]
+
+
+def checkpoint(function: callable, *args, enabled: bool = True):
+    """
+    function(*args) with activation checkpointing if enabled and in a
+    forward pass with gradients.
+    """
+
+    if not (enabled and torch.is_grad_enabled()):
+        return function(*args)
+    if NON_REENTRANT:
+        return torch_checkpoint(function, *args, use_reentrant=False)
+
+    # Reentrant checkpointing only computes the gradients of the
+    # parameters if at least one of the inputs requires gradients
+    if not any(isinstance(a, torch.Tensor) and a.requires_grad
+               for a in args):
+        return function(*args)
+    return torch_checkpoint(function, *args)
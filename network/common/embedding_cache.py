@@ -0,0 +1,110 @@
+"""
+    File Name:          MoReL/embedding_cache.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Embedding cache of a frozen drug tower (e.g. a graph encoder
+        pretrained in graph_to_dscrptr.py), which runs the tower once per
+        unique drug and replaces the forward pass of the tower on every
+        batch with a lookup into the embedding table, by the drug indices
+        of the batch (drug_data.drug_idx from DrugRespDataset).
+
+        The cache is used only if all the parameters of the tower do not
+        require gradients, and is invalidated (and rebuilt on the next
+        frozen batch) whenever the tower is unfrozen or its parameters are
+        modified in place (e.g. load_state_dict). Note that the embeddings
+        are computed in eval mode, as a frozen tower should be.
+
+        Usage:
+            for p in drug_tower.parameters():
+                p.requires_grad = False
+            model = SimpleUno(..., drug_tower=drug_tower)
+            model.cache_drug_embeddings(list(drug_dict.values()))
+"""
+import torch
+import torch.nn as nn
+import torch_geometric.data as pyg_data
+from typing import List, Optional, Sequence
+
+
+class DrugEmbeddingCache:
+
+    def __init__(self,
+                 tower: nn.Module,
+                 drug_data_list: Sequence[pyg_data.Data],
+                 batch_size: int = 256):
+        """
+        :param tower: drug tower (graph model on PyG batches)
+        :param drug_data_list: graphs of all the drugs, in the order of
+            drug indices
+        :param batch_size: number of drugs per forward pass of the tower
+            when building the embedding table
+        """
+
+        self.__tower = tower
+        self.__batch_size = batch_size
+        # Copies with only the graph attributes, as the dataset attaches
+        # other attributes (cell data, target, etc.) to the drug graphs
+        self.__drug_data_list = [
+            pyg_data.Data(x=d.x, edge_index=d.edge_index,
+                          edge_attr=d.edge_attr) for d in drug_data_list]
+
+        self.__table = None
+        self.__signature = None
+
+    @property
+    def table(self) -> Optional[torch.Tensor]:
+        return self.__table
+
+    def frozen(self) -> bool:
+        return not any(p.requires_grad for p in self.__tower.parameters())
+
+    def __parameter_signature(self) -> List[int]:
+        # Version counters of tensors increase with in-place modifications
+        return [p._version for p in self.__tower.parameters()] + \
+            [b._version for b in self.__tower.buffers()]
+
+    def invalidate(self):
+        self.__table, self.__signature = None, None
+
+    def valid(self) -> bool:
+        return (self.__table is not None) and \
+            self.__signature == self.__parameter_signature()
+
+    def build(self, device: Optional[torch.device] = None):
+
+        if device is None:
+            device = next(self.__tower.parameters()).device
+
+        __training = self.__tower.training
+        self.__tower.eval()
+        __embeddings = []
+        with torch.no_grad():
+            for __start in range(0, len(self.__drug_data_list),
+                                 self.__batch_size):
+                __batch = pyg_data.Batch.from_data_list(
+                    self.__drug_data_list[
+                        __start: __start + self.__batch_size]).to(device)
+                __embeddings.append(self.__tower(__batch).float())
+        self.__tower.train(__training)
+
+        self.__table = torch.cat(__embeddings, dim=0)
+        self.__signature = self.__parameter_signature()
+
+    def usable(self, drug_data) -> bool:
+        """
+        Whether the embeddings of the batch can be looked up, which is the
+        case for batches with drug indices of a frozen tower.
+        """
+        if not self.frozen():
+            self.invalidate()
+            return False
+        return getattr(drug_data, 'drug_idx', None) is not None
+
+    def __call__(self, drug_data) -> torch.Tensor:
+        if not self.valid():
+            self.build()
+        return self.__table[drug_data.drug_idx.to(self.__table.device)]
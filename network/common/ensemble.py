@@ -0,0 +1,243 @@
+"""
+    File Name:          MoReL/ensemble.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Vectorized ensembles of models with the same architecture (e.g.
+        SimpleUno of sweep trials with different seeds or learning rates).
+        The parameters and buffers of the K members are stacked along a
+        new leading dimension, and the forward pass of all the members is
+        a single call of the model with vmap, so that the many small
+        matmuls of the members become batched matmuls.
+
+        The members are independent in training: the loss is the sum of
+        the member losses, and EnsembleOptimizer applies the update of
+        every member with its own learning rate (and stops the members
+        that are done), while EnsembleScheduler reduces the learning rates
+        on plateau and stops the members early, per member.
+
+        Usage:
+            ensemble = StackedEnsemble([SimpleUno(...) for _ in range(k)])
+            optimizer = EnsembleOptimizer(
+                ensemble, torch.optim.Adam, lrs=[1e-4, 3e-4], amsgrad=True)
+            pred = ensemble(cell, drug, dose)   # [k, batch_size, 1]
+            loss = member_losses(pred, trgt).sum()
+"""
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Dict, List, Optional, Sequence
+
+# torch.func replaces functorch in PyTorch >= 2.0
+try:
+    from torch.func import functional_call, vmap
+except ImportError:
+    from functorch import vmap
+    from torch.nn.utils.stateless import functional_call
+
+
+class StackedEnsemble(nn.Module):
+    """
+    K models of the same architecture with stacked parameters and buffers
+    (of shape [K, ...]), whose forward pass returns the outputs of all the
+    members stacked as [K, ...].
+    """
+
+    def __init__(self,
+                 models: Sequence[nn.Module],
+                 shared_inputs: bool = True):
+
+        super().__init__()
+        self.__num_members = len(models)
+        self.__shared_inputs = shared_inputs
+
+        # Stateless copy of the architecture for functional calls, which
+        # is not registered as a submodule (and not in the state dict)
+        self.__base_model = (copy.deepcopy(models[0]).to('meta'), )
+
+        self.__param_names = [n for n, _ in models[0].named_parameters()]
+        self.__buffer_names = [n for n, _ in models[0].named_buffers()]
+
+        self.stacked_params = nn.ParameterList([nn.Parameter(torch.stack(
+            [m.get_parameter(n).detach() for m in models]))
+            for n in self.__param_names])
+        for __i, __name in enumerate(self.__buffer_names):
+            self.register_buffer(f'stacked_buffer_{__i}', torch.stack(
+                [m.get_buffer(__name).detach() for m in models]))
+
+    @property
+    def num_members(self) -> int:
+        return self.__num_members
+
+    def __stacked_buffers(self) -> List[torch.Tensor]:
+        return [getattr(self, f'stacked_buffer_{__i}')
+                for __i in range(len(self.__buffer_names))]
+
+    def train(self, mode: bool = True):
+        super().train(mode)
+        self.__base_model[0].train(mode)
+        return self
+
+    def __member_forward(self, params, buffers, *args):
+        return functional_call(
+            self.__base_model[0],
+            {**dict(zip(self.__param_names, params)),
+             **dict(zip(self.__buffer_names, buffers))},
+            args)
+
+    def forward(self, *args):
+        """
+        :param args: inputs of the model, which are shared by all the
+            members (shared_inputs) or stacked as [K, ...]
+        :return: outputs of the members stacked as [K, ...]
+        """
+        __in_dims = (0, 0) + \
+            ((None, ) if self.__shared_inputs else (0, )) * len(args)
+        # Different dropout masks for the members
+        return vmap(self.__member_forward, in_dims=__in_dims,
+                    randomness='different')(
+            tuple(self.stacked_params), tuple(self.__stacked_buffers()),
+            *args)
+
+    def member_state_dict(self, member: int) -> Dict[str, torch.Tensor]:
+        """
+        State dict of a single member, which can be loaded into a model of
+        the same architecture.
+        """
+        return {__name: __tensor[member].detach().clone()
+                for __name, __tensor in
+                zip(self.__param_names + self.__buffer_names,
+                    list(self.stacked_params) + self.__stacked_buffers())}
+
+    def load_member_state_dict(self,
+                               member: int,
+                               state_dict: Dict[str, torch.Tensor]):
+        with torch.no_grad():
+            for __name, __tensor in \
+                    zip(self.__param_names + self.__buffer_names,
+                        list(self.stacked_params) +
+                        self.__stacked_buffers()):
+                __tensor[member].copy_(state_dict[__name])
+
+
+def member_losses(pred: torch.Tensor,
+                  trgt: torch.Tensor,
+                  loss_func: callable = F.mse_loss) -> torch.Tensor:
+    """
+    Losses [K] of the stacked predictions [K, batch_size, ...] against
+    the shared targets [batch_size, ...].
+    """
+    __losses = loss_func(pred, trgt.unsqueeze(0).expand_as(pred),
+                         reduction='none')
+    return __losses.view(pred.shape[0], -1).mean(dim=1)
+
+
+class EnsembleOptimizer:
+    """
+    Optimizer of a StackedEnsemble with a learning rate per member.
+
+    The wrapped optimizer steps with learning rate 1, and the update of
+    every member is then scaled by its learning rate. This is exact for
+    the element-wise optimizers (SGD, Adam, RMSprop, etc.), where the
+    update is linear in the learning rate, and the optimizer states (e.g.
+    moments) are independent of the learning rate.
+    """
+
+    def __init__(self,
+                 ensemble: StackedEnsemble,
+                 optimizer_class: type,
+                 lrs: Sequence[float],
+                 **kwargs):
+
+        if len(lrs) != ensemble.num_members:
+            raise ValueError(f'Number of learning rates ({len(lrs)}) does '
+                             f'not match the ensemble size '
+                             f'({ensemble.num_members}).')
+
+        self.__params = list(ensemble.parameters())
+        self.__optimizer = optimizer_class(self.__params, lr=1., **kwargs)
+
+        self.lrs = torch.tensor(lrs, dtype=torch.float32)
+        self.active = torch.ones(ensemble.num_members, dtype=torch.bool)
+
+    @property
+    def optimizer(self) -> torch.optim.Optimizer:
+        return self.__optimizer
+
+    def zero_grad(self):
+        self.__optimizer.zero_grad()
+
+    def stop(self, member: int):
+        """
+        Stop updating the parameters of a member (e.g. early stopping).
+        """
+        self.active[member] = False
+
+    def step(self):
+
+        with torch.no_grad():
+            __prev_params = [p.detach().clone() for p in self.__params]
+            self.__optimizer.step()
+
+            for __param, __prev_param in zip(self.__params, __prev_params):
+                __scale = (self.lrs * self.active).to(__param).view(
+                    -1, *([1] * (__param.dim() - 1)))
+                __param.copy_(torch.lerp(__prev_param, __param, __scale))
+
+
+class EnsembleScheduler:
+    """
+    Per-member ReduceLROnPlateau and early stopping for EnsembleOptimizer,
+    with scores that are higher for the better (e.g. R2).
+    """
+
+    def __init__(self,
+                 optimizer: EnsembleOptimizer,
+                 factor: float = 0.8,
+                 lr_patience: int = 4,
+                 stop_patience: Optional[int] = None,
+                 min_lr: float = 1e-6):
+
+        self.__optimizer = optimizer
+        self.__factor = factor
+        self.__lr_patience = lr_patience
+        self.__stop_patience = stop_patience
+        self.__min_lr = min_lr
+
+        __num_members = len(optimizer.lrs)
+        self.best_scores = torch.full((__num_members, ), float('-inf'))
+        self.__num_bad_epochs = torch.zeros(__num_members, dtype=torch.long)
+        self.__num_lr_bad_epochs = torch.zeros_like(self.__num_bad_epochs)
+
+    def step(self, scores: Sequence[float]) -> torch.Tensor:
+        """
+        :param scores: scores of the members [K] in the current epoch
+        :return: mask [K] of the active members that improved
+        """
+
+        __scores = torch.as_tensor(scores, dtype=torch.float32)
+        __active = self.__optimizer.active
+        improved = __active & (__scores > self.best_scores)
+
+        self.best_scores[improved] = __scores[improved]
+        self.__num_bad_epochs[improved] = 0
+        self.__num_lr_bad_epochs[improved] = 0
+        self.__num_bad_epochs[~improved] += 1
+        self.__num_lr_bad_epochs[~improved] += 1
+
+        __reduce = __active & (self.__num_lr_bad_epochs > self.__lr_patience)
+        __lrs = self.__optimizer.lrs
+        __lrs[__reduce] = torch.clamp(__lrs[__reduce] * self.__factor,
+                                      min=self.__min_lr)
+        self.__num_lr_bad_epochs[__reduce] = 0
+
+        if self.__stop_patience is not None:
+            for __member in torch.nonzero(
+                    __active & (self.__num_bad_epochs >=
+                                self.__stop_patience)).view(-1).tolist():
+                self.__optimizer.stop(__member)
+        return improved
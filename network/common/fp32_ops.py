@@ -0,0 +1,40 @@
+"""
+    File Name:          MoReL/fp32_ops.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Float32 scatter/segment operations for the graph layers under
+        bfloat16 autocast (see utils/misc/precision.py). These operations
+        accumulate over a variable number of elements (e.g. the incoming
+        messages of a node), which loses too much precision with only 8
+        bits of mantissa, while the dense operations around them (typed
+        linear layers, edge networks, gates) are fine in bfloat16.
+
+        Usage:
+            out = fp32_op(torch.Tensor.index_add, out, 0, dst, msg)
+            alpha = fp32_op(pyg_utils.softmax, alpha, seg, num_nodes=n)
+"""
+import torch
+
+
+def to_fp32(value):
+    if isinstance(value, torch.Tensor) and value.is_floating_point():
+        return value.float()
+    return value
+
+
+def fp32_op(function: callable, *args, **kwargs):
+    """
+    function(*args, **kwargs) with autocast disabled and the floating
+    point tensor arguments in float32. Without autocast and with float32
+    inputs, this is the same as calling the function directly.
+    """
+
+    __device_type = next((a.device.type for a in args
+                          if isinstance(a, torch.Tensor)), 'cpu')
+    with torch.autocast(device_type=__device_type, enabled=False):
+        return function(*[to_fp32(a) for a in args],
+                        **{k: to_fp32(v) for k, v in kwargs.items()})
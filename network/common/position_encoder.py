@@ -48,16 +48,18 @@ class PositionEncoder(nn.Module):
         # Use register_buffer (returns tensor) instead of nn.Parameter()
         self.register_buffer('pos_enc_mat', pos_enc_mat.unsqueeze(0))
 
-    def forward(self, x):
+    def forward(self, x, offset: int = 0):
 
         # Input size: (batch_size, seq_length, emb_dim)
         # Output size: (batch_size, seq_length, emb_dim)
+        # Offset is the position of the first element in x, which is used
+        # for incremental decoding
 
         # Scaling embedded input (could do this in the embedding layer)
         x = x * self.__emb_scale
 
         # Add positional variable to embedding
-        x += Variable(self.pos_enc_mat[:, :x.size(1)],
+        x += Variable(self.pos_enc_mat[:, offset: offset + x.size(1)],
                       requires_grad=False)
 
         return self.__dropout(x)
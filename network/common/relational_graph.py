@@ -0,0 +1,78 @@
+"""
+    File Name:          MoReL/relational_graph.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Helper functions for relational (multi edge type) message passing.
+
+        The edge-type models (EdgeGCN, EdgeGAT) run one graph network per
+        channel of the (binary) edge attributes. The fused versions
+        instead treat every (node, edge type) pair as a virtual node with
+        index (node * num_edge_types + edge_type), so that all the edge
+        types go through a single message passing call, and the node
+        states of shape [num_nodes, num_edge_types, state_dim] can be
+        viewed as [num_nodes * num_edge_types, state_dim] without copying.
+"""
+import torch
+
+
+def relational_edges(edge_index: torch.Tensor,
+                     edge_attr: torch.Tensor):
+    """
+    Expand the edges by the non-zero channels of the edge attributes, in
+    the same way as masking edge_index with edge_attr[:, i].byte().
+
+    :param edge_index: [2, num_edges]
+    :param edge_attr: [num_edges, num_edge_types]
+    :return: edge_index [2, num_relational_edges] and
+        edge_type [num_relational_edges]
+    """
+    mask = (edge_attr.byte() != 0)
+    __edge_id, edge_type = mask.nonzero().t()
+    return edge_index[:, __edge_id], edge_type
+
+
+def virtual_edge_index(edge_index: torch.Tensor,
+                       edge_type: torch.Tensor,
+                       num_edge_types: int) -> torch.Tensor:
+    """
+    Map the edges of each type to edges between virtual nodes.
+    """
+    return edge_index * num_edge_types + edge_type.unsqueeze(0)
+
+
+def basis_weight(basis: torch.Tensor,
+                 comp: torch.Tensor) -> torch.Tensor:
+    """
+    Per-type weights from basis decomposition (Schlichtkrull et al., 2017)
+        weight[e] = sum_b comp[e, b] * basis[b]
+
+    :param basis: [num_bases, in_dim, out_dim]
+    :param comp: [num_edge_types, num_bases]
+    :return: [num_edge_types, in_dim, out_dim]
+    """
+    num_bases, in_dim, out_dim = basis.shape
+    return torch.matmul(comp, basis.view(num_bases, -1)).view(
+        -1, in_dim, out_dim)
+
+
+def typed_linear(x: torch.Tensor,
+                 weight: torch.Tensor) -> torch.Tensor:
+    """
+    Apply one linear transformation per edge type.
+
+    :param x: either [num_nodes, in_dim], which is shared by all the edge
+        types, or [num_nodes, num_edge_types, in_dim]
+    :param weight: [num_edge_types, in_dim, out_dim]
+    :return: [num_nodes, num_edge_types, out_dim]
+    """
+    num_edge_types, in_dim, out_dim = weight.shape
+    if x.dim() == 2:
+        # A single matmul against the concatenated weights
+        return torch.matmul(
+            x, weight.transpose(0, 1).reshape(in_dim, -1)).view(
+            -1, num_edge_types, out_dim)
+    return torch.bmm(x.transpose(0, 1), weight).transpose(0, 1)
@@ -12,6 +12,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch_geometric.nn as pyg_nn
 import torch_geometric.data as pyg_data
+import torch_geometric.utils as pyg_utils
+from typing import Optional
+
+from network.common.checkpointing import block_ranges, checkpoint
+from network.common.fp32_ops import fp32_op
+from network.common.relational_graph import \
+    relational_edges, virtual_edge_index, basis_weight, typed_linear
 
 
 class GAT(nn.Module):
@@ -37,6 +44,10 @@ class GAT(nn.Module):
             heads=(1 if (i == (num_conv - 1)) else num_heads),
             dropout=dropout) for i in range(num_conv)])
 
+    @property
+    def conv_layers(self) -> nn.ModuleList:
+        return self.__conv_layers
+
     def forward(self, data: pyg_data.Data):
         out = data.x
         for i, layer in enumerate(self.__conv_layers):
@@ -51,6 +62,10 @@ class GAT(nn.Module):
 class EdgeGAT(nn.Module):
     """
     Version of GAT that takes one-hot encoded edge attribute
+
+    With checkpoint_every, the GATs of every checkpoint_every edge types
+    are checkpointed together, and their activations are recomputed in
+    backward.
     """
 
     def __init__(self,
@@ -60,11 +75,15 @@ class EdgeGAT(nn.Module):
                  num_heads: int = 8,
                  num_conv: int = 2,
                  out_dim: int = 1,
-                 dropout: float = 0.2):
+                 dropout: float = 0.2,
+                 checkpoint_every: Optional[int] = None):
 
         super(EdgeGAT, self).__init__()
 
         self.__edge_attr_dim = edge_attr_dim
+        self.__checkpoint_ranges = \
+            block_ranges(edge_attr_dim, checkpoint_every)
+        self.__checkpoint = (checkpoint_every is not None)
         __gat_kwargs = {
             'node_attr_dim': node_attr_dim,
             'state_dim': state_dim,
@@ -76,20 +95,249 @@ class EdgeGAT(nn.Module):
         self.__gat_nets = nn.ModuleList(
             [GAT(**__gat_kwargs) for _ in range(edge_attr_dim)])
 
-    def forward(self, data: pyg_data.Data):
+    @property
+    def gat_nets(self) -> nn.ModuleList:
+        return self.__gat_nets
+
+    def __edge_type_nets(self, x, edge_index, edge_attr,
+                         start: int, end: int):
 
         out = []
-        for i in range(self.__edge_attr_dim):
+        for i in range(start, end):
             # New graph that corresponds to the edge attributes
-            _mask = data.edge_attr[:, i].byte()
+            _mask = edge_attr[:, i].byte()
             _edge_index = torch.masked_select(
-                data.edge_index, mask=_mask).view(2, -1)
-            _data = pyg_data.Data(x=data.x, edge_index=_edge_index)
+                edge_index, mask=_mask).view(2, -1)
+            _data = pyg_data.Data(x=x, edge_index=_edge_index)
 
             out.append(self.__gat_nets[i](_data))
 
         return torch.cat(tuple(out), dim=1)
 
+    def forward(self, data: pyg_data.Data):
+
+        out = [checkpoint(self.__edge_type_nets, data.x, data.edge_index,
+                          data.edge_attr, __start, __end,
+                          enabled=self.__checkpoint)
+               for __start, __end in self.__checkpoint_ranges]
+
+        return torch.cat(tuple(out), dim=1)
+
+
+class RelationalGATConv(nn.Module):
+    """
+    Graph attention layer over all the edge types at once, with per-type
+    weights and attention vectors. The attention logits of every edge
+    type are computed on the full relational edge list and normalized in
+    a single segment softmax:
+        - merge_relations=False: over the incoming edges of the same type
+          (and the self-loop), which is equivalent to one GATConv per type;
+          output shape [num_nodes, num_edge_types, out_dim]
+        - merge_relations=True: over the incoming edges of all the types,
+          so that the relations compete for attention and the states are
+          merged; output shape [num_nodes, out_dim]
+    """
+
+    def __init__(self,
+                 in_dim: int,
+                 out_dim: int,
+                 num_edge_types: int,
+                 heads: int = 1,
+                 concat: bool = True,
+                 negative_slope: float = 0.2,
+                 dropout: float = 0.,
+                 num_bases: Optional[int] = None,
+                 merge_relations: bool = False):
+
+        super(RelationalGATConv, self).__init__()
+
+        self.__out_dim = out_dim
+        self.__num_edge_types = num_edge_types
+        self.__heads = heads
+        self.__concat = concat
+        self.__negative_slope = negative_slope
+        self.__dropout = dropout
+        self.__num_bases = num_bases
+        self.__merge_relations = merge_relations
+
+        if num_bases is None:
+            self.weight = nn.Parameter(
+                torch.Tensor(num_edge_types, in_dim, heads * out_dim))
+        else:
+            self.weight = nn.Parameter(
+                torch.Tensor(num_bases, in_dim, heads * out_dim))
+            self.comp = nn.Parameter(torch.Tensor(num_edge_types, num_bases))
+        self.att_src = nn.Parameter(
+            torch.Tensor(num_edge_types, heads, out_dim))
+        self.att_dst = nn.Parameter(
+            torch.Tensor(num_edge_types, heads, out_dim))
+
+        __bias_dim = (heads * out_dim) if concat else out_dim
+        self.bias = nn.Parameter(torch.Tensor(__bias_dim)) \
+            if merge_relations else \
+            nn.Parameter(torch.Tensor(num_edge_types, __bias_dim))
+
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        for __w in self.weight:
+            nn.init.xavier_uniform_(__w)
+        if self.__num_bases is not None:
+            nn.init.xavier_uniform_(self.comp)
+        for __att in [self.att_src, self.att_dst]:
+            for __a in __att:
+                nn.init.xavier_uniform_(__a)
+        nn.init.zeros_(self.bias)
+
+    def load_gat_conv(self, edge_type: int, gat_conv: pyg_nn.GATConv):
+        """
+        Copy the weights of a GATConv into the ones of a single edge type.
+        """
+        assert (self.__num_bases is None) and (not self.__merge_relations)
+        __c = self.__out_dim
+        with torch.no_grad():
+            # PyG < 2.0 keeps a [in, heads * out] weight and a concatenated
+            # [1, heads, 2 * out] attention vector of (target, source);
+            # recent PyG keeps the shared projection (of an int in_channels)
+            # in lin, with lin_src set to None
+            if hasattr(gat_conv, 'att_src'):
+                __lin = gat_conv.lin_src \
+                    if getattr(gat_conv, 'lin_src', None) is not None \
+                    else gat_conv.lin
+                self.weight[edge_type].copy_(__lin.weight.t())
+                self.att_src[edge_type].copy_(gat_conv.att_src[0])
+                self.att_dst[edge_type].copy_(gat_conv.att_dst[0])
+            else:
+                self.weight[edge_type].copy_(gat_conv.weight)
+                self.att_dst[edge_type].copy_(gat_conv.att[0, :, :__c])
+                self.att_src[edge_type].copy_(gat_conv.att[0, :, __c:])
+            self.bias[edge_type].copy_(gat_conv.bias)
+
+    def forward(self,
+                x: torch.Tensor,
+                edge_index: torch.Tensor,
+                edge_type: torch.Tensor) -> torch.Tensor:
+        """
+        :param x: [num_nodes, in_dim] or
+            [num_nodes, num_edge_types, in_dim]
+        :param edge_index: [2, num_relational_edges] of the original nodes
+        :param edge_type: [num_relational_edges]
+        """
+
+        num_nodes = x.shape[0]
+        num_virtual_nodes = num_nodes * self.__num_edge_types
+
+        weight = self.weight if (self.__num_bases is None) \
+            else basis_weight(self.weight, self.comp)
+        h = typed_linear(x, weight).reshape(
+            num_nodes, self.__num_edge_types, self.__heads, self.__out_dim)
+
+        # Logits of both ends per (virtual node, head)
+        a_src = (h * self.att_src).sum(dim=-1).reshape(num_virtual_nodes, -1)
+        a_dst = (h * self.att_dst).sum(dim=-1).reshape(num_virtual_nodes, -1)
+        h = h.reshape(num_virtual_nodes, self.__heads, self.__out_dim)
+
+        # Self-loops for all the virtual nodes
+        __loop = torch.arange(num_virtual_nodes, device=x.device)
+        src, dst = virtual_edge_index(
+            edge_index, edge_type, self.__num_edge_types)
+        src, dst = torch.cat([src, __loop]), torch.cat([dst, __loop])
+
+        if self.__merge_relations:
+            # Typed messages compete for the attention of the target node
+            seg = dst // self.__num_edge_types
+            num_segs = num_nodes
+        else:
+            seg, num_segs = dst, num_virtual_nodes
+
+        alpha = F.leaky_relu(a_src[src] + a_dst[dst], self.__negative_slope)
+        alpha = fp32_op(pyg_utils.softmax, alpha, seg, num_nodes=num_segs)
+        alpha = F.dropout(alpha, p=self.__dropout, training=self.training)
+
+        out = h.new_zeros(num_segs, self.__heads, self.__out_dim)
+        out = fp32_op(torch.Tensor.index_add,
+                      out, 0, seg, h[src] * alpha.unsqueeze(-1))
+
+        out = out.view(num_segs, -1) if self.__concat else out.mean(dim=1)
+        if not self.__merge_relations:
+            out = out.view(num_nodes, self.__num_edge_types, -1)
+        return out + self.bias
+
+
+class FusedEdgeGAT(nn.Module):
+    """
+    Fused version of EdgeGAT built from RelationalGATConv layers.
+
+    With merge_relations=False, the output is numerically equivalent to
+    EdgeGAT (see from_edge_gat) with shape
+    [num_nodes, edge_attr_dim * out_dim]. With merge_relations=True, the
+    edge types are merged by attention in every layer and the output has
+    shape [num_nodes, out_dim].
+
+    With checkpoint_every, the layers are checkpointed in blocks of
+    checkpoint_every layers.
+    """
+
+    def __init__(self,
+                 node_attr_dim: int,
+                 edge_attr_dim: int,
+                 state_dim: int = 8,
+                 num_heads: int = 8,
+                 num_conv: int = 2,
+                 out_dim: int = 1,
+                 dropout: float = 0.2,
+                 num_bases: Optional[int] = None,
+                 merge_relations: bool = False,
+                 checkpoint_every: Optional[int] = None):
+
+        super(FusedEdgeGAT, self).__init__()
+        self.__dropout = dropout
+        self.__checkpoint_ranges = block_ranges(num_conv, checkpoint_every)
+        self.__checkpoint = (checkpoint_every is not None)
+
+        self.__conv_layers = nn.ModuleList([RelationalGATConv(
+            node_attr_dim if (i == 0) else state_dim * num_heads,
+            out_dim if (i == (num_conv - 1)) else state_dim,
+            num_edge_types=edge_attr_dim,
+            heads=(1 if (i == (num_conv - 1)) else num_heads),
+            dropout=dropout,
+            num_bases=num_bases,
+            merge_relations=merge_relations) for i in range(num_conv)])
+
+    @classmethod
+    def from_edge_gat(cls, edge_gat: EdgeGAT, **kwargs) -> 'FusedEdgeGAT':
+        """
+        Build a fused model with the weights of an EdgeGAT. The keyword
+        arguments are the ones used to construct the EdgeGAT.
+        """
+        fused_edge_gat = cls(**kwargs)
+        for __e, __gat in enumerate(edge_gat.gat_nets):
+            for __layer, __conv in zip(fused_edge_gat.__conv_layers,
+                                       __gat.conv_layers):
+                __layer.load_gat_conv(__e, __conv)
+        return fused_edge_gat
+
+    def forward(self, data: pyg_data.Data):
+
+        edge_index, edge_type = relational_edges(
+            data.edge_index, data.edge_attr)
+
+        out = data.x
+        for __start, __end in self.__checkpoint_ranges:
+            out = checkpoint(self.__layers, out, edge_index, edge_type,
+                             __start, __end, enabled=self.__checkpoint)
+
+        return out.reshape(out.shape[0], -1)
+
+    def __layers(self, out, edge_index, edge_type, start: int, end: int):
+        for i in range(start, end):
+            out = self.__conv_layers[i](out, edge_index, edge_type)
+            if i != (len(self.__conv_layers) - 1):
+                out = F.dropout(F.relu(out),
+                                p=self.__dropout,
+                                training=self.training)
+        return out
+
 
 class EdgeGATEncoder(nn.Module):
 
@@ -101,39 +349,62 @@ class EdgeGATEncoder(nn.Module):
                  num_conv: int = 2,
                  out_dim: int = 1,
                  dropout: float = 0.2,
-                 attention_pooling: bool = True):
+                 attention_pooling: bool = True,
+                 fused_relations: bool = False,
+                 merge_relations: bool = False,
+                 num_bases: Optional[int] = None,
+                 checkpoint_every: Optional[int] = None):
 
         super(EdgeGATEncoder, self).__init__()
 
-        self.__edge_gat = EdgeGAT(node_attr_dim=node_attr_dim,
-                                  edge_attr_dim=edge_attr_dim,
-                                  state_dim=state_dim,
-                                  num_heads=num_heads,
-                                  num_conv=num_conv,
-                                  out_dim=state_dim,
-                                  dropout=dropout)
+        __edge_gat_kwargs = {
+            'node_attr_dim': node_attr_dim,
+            'edge_attr_dim': edge_attr_dim,
+            'state_dim': state_dim,
+            'num_heads': num_heads,
+            'num_conv': num_conv,
+            'out_dim': state_dim,
+            'dropout': dropout,
+            'checkpoint_every': checkpoint_every}
+
+        if fused_relations:
+            self.__edge_gat = FusedEdgeGAT(num_bases=num_bases,
+                                           merge_relations=merge_relations,
+                                           **__edge_gat_kwargs)
+        else:
+            if merge_relations or (num_bases is not None):
+                raise ValueError('Merged relations and basis decomposition '
+                                 '(num_bases) are only available with '
+                                 'fused_relations.')
+            self.__edge_gat = EdgeGAT(**__edge_gat_kwargs)
 
         # Pooling layer is supposed to perform the following shape-shifting:
         #   From [num_nodes, node_attr_dim * edge_attr_dim]
         #   To [num_graphs, 2 * state_dim * edge_attr_dim]
+        # Merged relations are pooled from [num_nodes, state_dim] instead
+        __pool_dim = state_dim * (1 if merge_relations else edge_attr_dim)
         if attention_pooling:
             self.__pooling = pyg_nn.GlobalAttention(
-                nn.Linear(state_dim * edge_attr_dim, 1),
-                nn.Linear(state_dim * edge_attr_dim,
-                          2 * state_dim * edge_attr_dim))
+                nn.Linear(__pool_dim, 1),
+                nn.Linear(__pool_dim, 2 * __pool_dim))
         else:
-            self.__pooling = pyg_nn.Set2Set(state_dim * edge_attr_dim,
-                                            processing_steps=3)
+            self.__pooling = pyg_nn.Set2Set(__pool_dim, processing_steps=3)
 
         self.__out_linear = nn.Sequential(
-            nn.Linear(2 * state_dim * edge_attr_dim, state_dim),
+            nn.Linear(2 * __pool_dim, state_dim),
             nn.ReLU(),
             nn.Linear(state_dim, out_dim))
 
-    def forward(self, data: pyg_data.Data):
+    def embed(self, data: pyg_data.Data):
+        """
+        Graph embeddings from the pooling layer, of the shape
+        [batch_size, pooling output dim].
+        """
         out = self.__edge_gat(data)
-        out = self.__pooling(out, data.batch)
-        return self.__out_linear(out)
+        return self.__pooling(out, data.batch)
+
+    def forward(self, data: pyg_data.Data):
+        return self.__out_linear(self.embed(data))
 
 
 # Testing segment for GAT with edge attributes and pooling layer
@@ -145,6 +416,30 @@ if __name__ == '__main__':
     import utils.dataset.config as c
     from utils.dataset.graph_to_dscrptr_dataset import GraphToDscrptrDataset
 
+    # Equivalence of EdgeGAT and FusedEdgeGAT (with the weights of the
+    # GATConvs loaded by RelationalGATConv.load_gat_conv) on a small
+    # random batch
+    torch.manual_seed(0)
+    __src, __dst = torch.randint(10, (2, 20))
+    __edge_attr = (torch.rand(20, 4) < 0.3).float()
+    __edge_attr[:, 0] = 1.
+    __data = pyg_data.Batch.from_data_list([pyg_data.Data(
+        x=torch.rand(10, 8),
+        edge_index=torch.stack([torch.cat([__src, __dst]),
+                                torch.cat([__dst, __src])]),
+        edge_attr=torch.cat([__edge_attr, __edge_attr]))] * 2)
+
+    __kwargs = {'node_attr_dim': 8, 'edge_attr_dim': 4, 'state_dim': 8,
+                'num_heads': 4, 'num_conv': 2, 'out_dim': 16}
+    __edge_gat = EdgeGAT(**__kwargs).eval()
+    __fused_edge_gat = FusedEdgeGAT.from_edge_gat(
+        __edge_gat, **__kwargs).eval()
+    with torch.no_grad():
+        __max_diff = (__edge_gat(__data) -
+                      __fused_edge_gat(__data)).abs().max().item()
+    print(f'EdgeGAT vs. FusedEdgeGAT max abs diff: {__max_diff:.2e}')
+    assert __max_diff < 1e-4
+
     PCBA_ONLY = True
     USE_CUDA = True
     RAND_STATE = 0
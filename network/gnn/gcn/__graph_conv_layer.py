@@ -11,11 +11,14 @@
         this implementation differs from his in the following way:
             * adding edge channels (features)
             * support mini-batch optimization
+            * support block-diagonal sparse adjacency matrix of graphs with
+              variable sizes (see utils/dataset/graph_collate.py)
 """
 import torch
 import torch.nn as nn
+from typing import Optional
 
-from utils.misc.sparse_tensor_helper import to_dense
+from utils.misc.sparse_tensor_helper import is_sparse, to_dense
 
 
 def gcn_state_reshape(state: torch.Tensor,
@@ -25,9 +28,11 @@ def gcn_state_reshape(state: torch.Tensor,
     # Matrix state (either in-going or out-going) has size
     # [batch_size, num_node, state_dim * num_edge_types]
     state_ = state.view(-1, num_nodes, in_state_dim, num_edge_types)
-    # [batch_size, num_nodes, state_dim, num_edge_types]
-    state_ = state_.transpose(2, 3).transpose(1, 2).contiguous()
-    # [batch_size * num_edge_types * num_nodes * state_dim]
+    # [batch_size, num_nodes, num_edge_types, state_dim]
+    # Note that the rows must be ordered as (node, edge type), which is
+    # the order of the columns in the flattened adjacency matrix
+    state_ = state_.transpose(2, 3).contiguous()
+    # [batch_size, num_nodes * num_edge_types, state_dim]
     return state_.view(-1, num_nodes * num_edge_types, in_state_dim)
 
 
@@ -36,9 +41,12 @@ class GraphConvLayer(nn.Module):
     def __init__(self,
                  in_state_dim: int,
                  out_state_dim: int,
-                 num_nodes: int,
+                 num_nodes: Optional[int],
                  num_edge_types: int,
                  use_bias: bool = True):
+        """
+        num_nodes is inferred from the input state if not given.
+        """
 
         super().__init__()
 
@@ -58,27 +66,53 @@ class GraphConvLayer(nn.Module):
                 adj_matrix):
         """
         :param in_state:
-            [batch_size, num_nodes, in_dim]
+            [batch_size, num_nodes, in_dim], or
+            [total_num_nodes, in_dim] with sparse adjacency matrix
         :param adj_matrix:
-            [batch_size, num_nodes, num_nodes, num_edge_types]
+            [batch_size, num_nodes, num_nodes, num_edge_types], or
+            sparse (COO/CSR) block-diagonal adjacency matrix of the whole
+            batch [total_num_nodes, total_num_nodes * num_edge_types]
         :return:
         """
 
-        # [batch_size, num_edge_types * num_nodes, in_state_dim]
+        if is_sparse(adj_matrix) and (in_state.dim() == 2):
+            return self.__sparse_forward(in_state, adj_matrix)
+
+        num_nodes = self.__num_nodes if self.__num_nodes \
+            else in_state.shape[-2]
+
+        # [batch_size, num_nodes * num_edge_types, in_state_dim]
         tmp_state = gcn_state_reshape(self.__linear_in(in_state),
-                                      self.__num_nodes,
+                                      num_nodes,
                                       self.__in_state_dim,
                                       self.__num_edge_types)
 
-        # [batch_size, num_nodes, in_state_dim]
+        # [batch_size, num_nodes, num_nodes * num_edge_types]
         tmp_adj_matrix = to_dense(adj_matrix).view(
-            -1, self.__num_nodes, self.__num_nodes * self.__num_edge_types)
+            -1, num_nodes, num_nodes * self.__num_edge_types)
 
         # Note that bmm does not support sparse matrix in 1.0.1
         tmp_state = torch.bmm(tmp_adj_matrix, tmp_state)
 
         return self.__linear_out(tmp_state)
 
+    def __sparse_forward(self, in_state, adj_matrix):
+
+        # [total_num_nodes * num_edge_types, in_state_dim]
+        tmp_state = gcn_state_reshape(self.__linear_in(in_state),
+                                      in_state.shape[0],
+                                      self.__in_state_dim,
+                                      self.__num_edge_types)[0]
+
+        # Sparse-dense matmul over the block-diagonal adjacency matrix
+        # [total_num_nodes, in_state_dim]
+        if adj_matrix.layout == torch.sparse_coo:
+            tmp_state = torch.sparse.mm(adj_matrix, tmp_state)
+        else:
+            tmp_state = torch.matmul(adj_matrix, tmp_state)
+
+        return self.__linear_out(tmp_state)
+
 
 # Test out the correctness of graph convolution layer
 if __name__ == '__main__':
@@ -12,6 +12,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch_geometric.nn as pyg_nn
 import torch_geometric.data as pyg_data
+from typing import Optional
+
+from network.common.checkpointing import block_ranges, checkpoint
+from network.common.fp32_ops import fp32_op
+from network.common.relational_graph import \
+    relational_edges, virtual_edge_index, basis_weight, typed_linear
 
 
 class GCN(nn.Module):
@@ -34,6 +40,10 @@ class GCN(nn.Module):
             out_dim if (i == (num_conv - 1)) else state_dim,
             cached=False) for i in range(num_conv)])
 
+    @property
+    def conv_layers(self) -> nn.ModuleList:
+        return self.__conv_layers
+
     def forward(self, data: pyg_data.Data):
         out = data.x
         for i, layer in enumerate(self.__conv_layers):
@@ -49,6 +59,10 @@ class GCN(nn.Module):
 class EdgeGCN(nn.Module):
     """
     Version of GCN that takes one-hot encoded edge attribute
+
+    With checkpoint_every, the GCNs of every checkpoint_every edge types
+    are checkpointed together, and their activations are recomputed in
+    backward.
     """
 
     def __init__(self,
@@ -57,11 +71,15 @@ class EdgeGCN(nn.Module):
                  state_dim: int = 16,
                  num_conv: int = 2,
                  out_dim: int = 1,
-                 dropout: float = 0.2):
+                 dropout: float = 0.2,
+                 checkpoint_every: Optional[int] = None):
 
         super(EdgeGCN, self).__init__()
 
         self.__edge_attr_dim = edge_attr_dim
+        self.__checkpoint_ranges = \
+            block_ranges(edge_attr_dim, checkpoint_every)
+        self.__checkpoint = (checkpoint_every is not None)
         __gcn_kwargs = {
             'node_attr_dim': node_attr_dim,
             'state_dim': state_dim,
@@ -72,21 +90,173 @@ class EdgeGCN(nn.Module):
         self.__gcn_nets = nn.ModuleList(
             [GCN(**__gcn_kwargs) for _ in range(edge_attr_dim)])
 
-    def forward(self, data: pyg_data.Data):
+    @property
+    def gcn_nets(self) -> nn.ModuleList:
+        return self.__gcn_nets
+
+    def __edge_type_nets(self, x, edge_index, edge_attr,
+                         start: int, end: int):
 
         out = []
-        for i in range(self.__edge_attr_dim):
+        for i in range(start, end):
 
             # New graph that corresponds to the edge attributes
-            _mask = data.edge_attr[:, i].byte()
+            _mask = edge_attr[:, i].byte()
             _edge_index = torch.masked_select(
-                data.edge_index, mask=_mask).view(2, -1)
+                edge_index, mask=_mask).view(2, -1)
 
-            _data = pyg_data.Data(x=data.x, edge_index=_edge_index)
+            _data = pyg_data.Data(x=x, edge_index=_edge_index)
             out.append(self.__gcn_nets[i](_data))
 
         return torch.cat(tuple(out), dim=1)
 
+    def forward(self, data: pyg_data.Data):
+
+        out = [checkpoint(self.__edge_type_nets, data.x, data.edge_index,
+                          data.edge_attr, __start, __end,
+                          enabled=self.__checkpoint)
+               for __start, __end in self.__checkpoint_ranges]
+
+        return torch.cat(tuple(out), dim=1)
+
+
+class FusedEdgeGCN(nn.Module):
+    """
+    Fused version of EdgeGCN that runs all the edge types in a single
+    message passing call (see network/common/relational_graph.py), with
+    one weight matrix per edge type and layer.
+
+    With num_bases=None the weights are block-diagonal over the edge
+    types, and the output is numerically equivalent to EdgeGCN (see
+    from_edge_gcn). Otherwise the weights of each layer are decomposed
+    into num_bases shared bases, which saves parameters for large
+    edge_attr_dim.
+
+    With checkpoint_every, the layers are checkpointed in blocks of
+    checkpoint_every layers.
+    """
+
+    def __init__(self,
+                 node_attr_dim: int,
+                 edge_attr_dim: int,
+                 state_dim: int = 16,
+                 num_conv: int = 2,
+                 out_dim: int = 1,
+                 dropout: float = 0.2,
+                 num_bases: Optional[int] = None,
+                 checkpoint_every: Optional[int] = None):
+
+        super(FusedEdgeGCN, self).__init__()
+
+        self.__edge_attr_dim = edge_attr_dim
+        self.__num_conv = num_conv
+        self.__checkpoint_ranges = block_ranges(num_conv, checkpoint_every)
+        self.__checkpoint = (checkpoint_every is not None)
+        self.__dropout = dropout
+        self.__num_bases = num_bases
+
+        __dims = [node_attr_dim] + [state_dim] * (num_conv - 1) + [out_dim]
+        if num_bases is None:
+            self.__weights = nn.ParameterList([nn.Parameter(torch.Tensor(
+                edge_attr_dim, __dims[i], __dims[i + 1]))
+                for i in range(num_conv)])
+        else:
+            self.__weights = nn.ParameterList([nn.Parameter(torch.Tensor(
+                num_bases, __dims[i], __dims[i + 1]))
+                for i in range(num_conv)])
+            self.__comps = nn.ParameterList([nn.Parameter(torch.Tensor(
+                edge_attr_dim, num_bases)) for _ in range(num_conv)])
+        self.__biases = nn.ParameterList([nn.Parameter(torch.Tensor(
+            edge_attr_dim, __dims[i + 1])) for i in range(num_conv)])
+
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same initialization as GCNConv for each edge type
+        for __weight in self.__weights:
+            for __w in __weight:
+                nn.init.xavier_uniform_(__w)
+        if self.__num_bases is not None:
+            for __comp in self.__comps:
+                nn.init.xavier_uniform_(__comp)
+        for __bias in self.__biases:
+            nn.init.zeros_(__bias)
+
+    def __layer_weight(self, i: int) -> torch.Tensor:
+        if self.__num_bases is None:
+            return self.__weights[i]
+        return basis_weight(self.__weights[i], self.__comps[i])
+
+    @classmethod
+    def from_edge_gcn(cls, edge_gcn: EdgeGCN, **kwargs) -> 'FusedEdgeGCN':
+        """
+        Build a fused model with the weights of an EdgeGCN. The keyword
+        arguments are the ones used to construct the EdgeGCN (except for
+        dropout, which is not part of the weights).
+        """
+
+        fused_edge_gcn = cls(**kwargs)
+        with torch.no_grad():
+            for __e, __gcn in enumerate(edge_gcn.gcn_nets):
+                for __i, __conv in enumerate(__gcn.conv_layers):
+                    # GCNConv keeps a [in, out] weight in PyG < 2.0 and a
+                    # Linear layer with [out, in] weight afterwards
+                    __weight = __conv.lin.weight.t() \
+                        if hasattr(__conv, 'lin') else __conv.weight
+                    fused_edge_gcn.__weights[__i][__e].copy_(__weight)
+                    fused_edge_gcn.__biases[__i][__e].copy_(__conv.bias)
+        return fused_edge_gcn
+
+    def forward(self, data: pyg_data.Data):
+
+        num_nodes = data.x.shape[0]
+        num_virtual_nodes = num_nodes * self.__edge_attr_dim
+
+        edge_index, edge_type = relational_edges(
+            data.edge_index, data.edge_attr)
+        src, dst = virtual_edge_index(
+            edge_index, edge_type, self.__edge_attr_dim)
+
+        # Symmetric normalization with self-loops, shared by all the layers
+        deg = torch.ones(num_virtual_nodes,
+                         dtype=data.x.dtype, device=data.x.device)
+        deg.index_add_(0, dst, torch.ones_like(dst, dtype=deg.dtype))
+        deg_inv_sqrt = deg.pow(-0.5)
+        norm = (deg_inv_sqrt[src] * deg_inv_sqrt[dst]).unsqueeze(-1)
+        self_norm = (deg_inv_sqrt * deg_inv_sqrt).unsqueeze(-1)
+
+        out = data.x
+        for __start, __end in self.__checkpoint_ranges:
+            out = checkpoint(self.__layers, out, src, dst, norm, self_norm,
+                             __start, __end, enabled=self.__checkpoint)
+
+        # Same layout as the concatenation over edge types in EdgeGCN
+        return out.view(num_nodes, -1)
+
+    def __layers(self, out, src, dst, norm, self_norm, start: int, end: int):
+
+        num_nodes = out.shape[0]
+        num_virtual_nodes = num_nodes * self.__edge_attr_dim
+
+        for i in range(start, end):
+
+            # [num_nodes, edge_attr_dim, dim] -> [num_virtual_nodes, dim]
+            __h = typed_linear(out, self.__layer_weight(i))
+            __h = __h.reshape(num_virtual_nodes, -1)
+
+            out = __h * self_norm
+            out = fp32_op(torch.Tensor.index_add,
+                          out, 0, dst, __h[src] * norm)
+            out = out.view(num_nodes, self.__edge_attr_dim, -1) + \
+                self.__biases[i]
+
+            if i != (self.__num_conv - 1):
+                out = F.dropout(F.relu(out),
+                                p=self.__dropout,
+                                training=self.training)
+
+        return out
+
 
 class EdgeGCNEncoder(nn.Module):
 
@@ -97,16 +267,30 @@ class EdgeGCNEncoder(nn.Module):
                  num_conv: int = 2,
                  out_dim: int = 1,
                  dropout: float = 0.2,
-                 attention_pooling: bool = True):
+                 attention_pooling: bool = True,
+                 fused_relations: bool = False,
+                 num_bases: Optional[int] = None,
+                 checkpoint_every: Optional[int] = None):
 
         super(EdgeGCNEncoder, self).__init__()
 
-        self.__edge_gcn = EdgeGCN(node_attr_dim=node_attr_dim,
-                                  edge_attr_dim=edge_attr_dim,
-                                  state_dim=state_dim,
-                                  num_conv=num_conv,
-                                  out_dim=state_dim,
-                                  dropout=dropout)
+        __edge_gcn_kwargs = {
+            'node_attr_dim': node_attr_dim,
+            'edge_attr_dim': edge_attr_dim,
+            'state_dim': state_dim,
+            'num_conv': num_conv,
+            'out_dim': state_dim,
+            'dropout': dropout,
+            'checkpoint_every': checkpoint_every}
+
+        if fused_relations:
+            self.__edge_gcn = FusedEdgeGCN(num_bases=num_bases,
+                                           **__edge_gcn_kwargs)
+        else:
+            if num_bases is not None:
+                raise ValueError('Basis decomposition (num_bases) is only '
+                                 'available with fused_relations.')
+            self.__edge_gcn = EdgeGCN(**__edge_gcn_kwargs)
 
         # Pooling layer is supposed to perform the following shape-shifting:
         #   From [num_nodes, node_attr_dim * edge_attr_dim]
@@ -125,10 +309,16 @@ class EdgeGCNEncoder(nn.Module):
             nn.ReLU(),
             nn.Linear(state_dim, out_dim))
 
-    def forward(self, data: pyg_data.Data):
+    def embed(self, data: pyg_data.Data):
+        """
+        Graph embeddings from the pooling layer, of the shape
+        [batch_size, pooling output dim].
+        """
         out = self.__edge_gcn(data)
-        out = self.__pooling(out, data.batch)
-        return self.__out_linear(out)
+        return self.__pooling(out, data.batch)
+
+    def forward(self, data: pyg_data.Data):
+        return self.__out_linear(self.embed(data))
 
 
 # Testing segment for GCN with edge attributes and pooling layer
@@ -140,6 +330,28 @@ if __name__ == '__main__':
     import utils.dataset.config as c
     from utils.dataset.graph_to_dscrptr_dataset import GraphToDscrptrDataset
 
+    # Equivalence of EdgeGCN and FusedEdgeGCN on a small random batch
+    torch.manual_seed(0)
+    __src, __dst = torch.randint(10, (2, 20))
+    __edge_attr = (torch.rand(20, 4) < 0.3).float()
+    __edge_attr[:, 0] = 1.
+    __data = pyg_data.Batch.from_data_list([pyg_data.Data(
+        x=torch.rand(10, 8),
+        edge_index=torch.stack([torch.cat([__src, __dst]),
+                                torch.cat([__dst, __src])]),
+        edge_attr=torch.cat([__edge_attr, __edge_attr]))] * 2)
+
+    __kwargs = {'node_attr_dim': 8, 'edge_attr_dim': 4,
+                'state_dim': 16, 'num_conv': 2, 'out_dim': 16}
+    __edge_gcn = EdgeGCN(**__kwargs).eval()
+    __fused_edge_gcn = FusedEdgeGCN.from_edge_gcn(
+        __edge_gcn, **__kwargs).eval()
+    with torch.no_grad():
+        __max_diff = (__edge_gcn(__data) -
+                      __fused_edge_gcn(__data)).abs().max().item()
+    print(f'EdgeGCN vs. FusedEdgeGCN max abs diff: {__max_diff:.2e}')
+    assert __max_diff < 1e-4
+
     PCBA_ONLY = True
     USE_CUDA = True
     RAND_STATE = 0
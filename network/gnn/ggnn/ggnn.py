@@ -15,7 +15,7 @@
 """
 import torch
 import torch.nn as nn
-from network.gnn.ggnn.propagator import Propagator
+from network.gnn.ggnn.propagator import Propagator, SparsePropagator
 
 
 class GGNN(nn.Module):
@@ -48,7 +48,7 @@ class GGNN(nn.Module):
 
         self.__propagator = Propagator(
             self.__state_dim, self.__num_nodes,
-            self.__num_edge_types)
+            self.__num_edge_types, self.__directional_edges)
 
         self.__output = nn.Sequential(
             nn.Linear(self.__state_dim + self.__annotation_dim,
@@ -62,9 +62,11 @@ class GGNN(nn.Module):
         # [batch_size, num_node, state_dim * num_edge_types]
         states_ = states.view(
             -1, self.__num_nodes, self.__state_dim, self.__num_edge_types)
-        # [batch_size, num_nodes, state_dim, num_edge_types]
-        states_ = states_.transpose(2, 3).transpose(1, 2).contiguous()
-        # [batch_size * num_edge_types * num_nodes * state_dim]
+        # [batch_size, num_nodes, num_edge_types, state_dim]
+        # Note that the rows must be ordered as (node, edge type), which is
+        # the order of the columns in the flattened adjacency matrix
+        states_ = states_.transpose(2, 3).contiguous()
+        # [batch_size, num_nodes * num_edge_types, state_dim]
         return states_.view(
             -1, self.__num_nodes * self.__num_edge_types, self.__state_dim)
 
@@ -101,3 +103,117 @@ class GGNN(nn.Module):
         # Return a vector of size [batch_size, num_node, state_dim]
         # TODO: need to check the shape here and see if .sum(-1) is needed
         return self.__output(torch.cat((curr_state, annotation), -1)).sum(-1)
+
+
+class SparseGGNN(nn.Module):
+    """
+    Version of GGNN on PyG-style batches of graphs with variable sizes.
+    Messages are aggregated over the edge list with scatter operations
+    (see SparsePropagator), so the memory usage is linear to the number of
+    edges instead of quadratic to the number of nodes.
+
+    Takes the same parameters as GGNN except for num_nodes, and the
+    weights of a GGNN (undirectional) can be loaded with from_ggnn.
+    """
+
+    def __init__(self,
+                 state_dim: int,
+                 num_edge_types: int,
+                 annotation_dim: int,
+                 propagation_steps: int):
+
+        super().__init__()
+
+        self.__state_dim = state_dim
+        self.__num_edge_types = num_edge_types
+        self.__propagation_steps = propagation_steps
+
+        self.__linear_in = nn.Linear(self.__state_dim,
+                                     self.__state_dim * self.__num_edge_types)
+        self.__linear_out = nn.Linear(self.__state_dim,
+                                      self.__state_dim * self.__num_edge_types)
+
+        self.__propagator = SparsePropagator(
+            self.__state_dim, self.__num_edge_types)
+
+        self.__output = nn.Sequential(
+            nn.Linear(self.__state_dim + annotation_dim,
+                      self.__state_dim))
+
+    @classmethod
+    def from_ggnn(cls, ggnn: GGNN, **kwargs) -> 'SparseGGNN':
+        sparse_ggnn = cls(**kwargs)
+        sparse_ggnn.load_state_dict(
+            {k.replace('_GGNN__', '_SparseGGNN__').replace(
+                '_Propagator__', '_SparsePropagator__'): v
+             for k, v in ggnn.state_dict().items()})
+        return sparse_ggnn
+
+    def __state_reshape(self, states):
+        # [num_nodes, state_dim * num_edge_types]
+        # -> [num_nodes, num_edge_types, state_dim]
+        return states.view(-1, self.__state_dim,
+                           self.__num_edge_types).transpose(1, 2)
+
+    def forward(self,
+                init_state,
+                annotation,
+                edge_index,
+                edge_type):
+        """
+        :param init_state:
+            [num_nodes, state_dim]
+        :param annotation:
+            [num_nodes, annotation_dim]
+        :param edge_index:
+            [2, num_edges], with both directions for undirected graphs
+        :param edge_type:
+            [num_edges] of edge type indices, or
+            [num_edges, num_edge_types] of multi-hot edge attributes
+        :return:
+            [num_nodes]
+        """
+
+        curr_state = init_state
+        for i_step in range(self.__propagation_steps):
+
+            in_states = self.__state_reshape(self.__linear_in(curr_state))
+            out_states = self.__state_reshape(self.__linear_out(curr_state))
+
+            curr_state = self.__propagator(
+                in_states, out_states, curr_state, edge_index, edge_type)
+
+        return self.__output(torch.cat((curr_state, annotation), -1)).sum(-1)
+
+
+# Testing segment for SparseGGNN against the dense GGNN on the same graphs
+if __name__ == '__main__':
+
+    torch.manual_seed(0)
+    num_graphs, num_nodes, num_edge_types, state_dim = 2, 10, 3, 16
+    kwargs = {'state_dim': state_dim,
+              'num_edge_types': num_edge_types,
+              'annotation_dim': state_dim,
+              'propagation_steps': 2}
+    ggnn = GGNN(num_nodes=num_nodes, **kwargs)
+    sparse_ggnn = SparseGGNN.from_ggnn(ggnn, **kwargs)
+
+    # Undirected random graphs as dense adjacency matrices
+    # [num_graphs, num_nodes (dst), num_nodes (src), num_edge_types] and
+    # as the edge list of the batch with the nodes of all the graphs
+    adj_matrix = (torch.rand(num_graphs, num_nodes, num_nodes,
+                             num_edge_types) < 0.1).float()
+    adj_matrix = ((adj_matrix + adj_matrix.transpose(1, 2)) > 0).float()
+    _graph, _dst, _src, edge_type = adj_matrix.nonzero().t()
+    edge_index = torch.stack([_graph * num_nodes + _src,
+                              _graph * num_nodes + _dst])
+
+    state = torch.randn(num_graphs, num_nodes, state_dim)
+    with torch.no_grad():
+        dense_out = ggnn(state, state, adj_matrix).view(-1)
+        sparse_out = sparse_ggnn(state.view(-1, state_dim),
+                                 state.view(-1, state_dim),
+                                 edge_index, edge_type)
+    max_diff = (dense_out - sparse_out).abs().max().item()
+    print(f'GGNN vs. SparseGGNN max abs diff: {max_diff:.2e}')
+    assert max_diff < 1e-4
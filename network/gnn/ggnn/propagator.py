@@ -10,6 +10,8 @@
 import torch
 import torch.nn as nn
 
+from network.common.fp32_ops import fp32_op
+from network.common.relational_graph import relational_edges
 from utils.misc.sparse_tensor_helper import to_dense
 
 
@@ -100,3 +102,76 @@ class Propagator(nn.Module):
 
         # Returned matrix size: [batch_size, num_nodes, state_dim]
         return (1 - z) * curr_state + z * h_hat
+
+
+class SparsePropagator(nn.Module):
+    """
+    Version of Propagator that aggregates the messages over an edge list
+    with scatter operations instead of a dense adjacency matrix. For every
+    edge (src -> dst) of type e:
+        a_in[dst] += in_states[src, e]
+        a_out[src] += out_states[dst, e]
+    which is the same as Propagator with a symmetric adjacency matrix
+    when the edge list contains both directions of every edge.
+    """
+
+    def __init__(self,
+                 state_dim: int,
+                 num_edge_types: int):
+
+        super().__init__()
+
+        self.__num_edge_types = num_edge_types
+
+        # Same gates as Propagator
+        self.__reset_gate = nn.Sequential(
+            nn.Linear(state_dim*3, state_dim),
+            nn.Sigmoid())
+
+        self.__update_gate = nn.Sequential(
+            nn.Linear(state_dim*3, state_dim),
+            nn.Sigmoid())
+
+        self.__new_gate = nn.Sequential(
+            nn.Linear(state_dim*3, state_dim),
+            nn.Tanh())
+
+    def forward(self,
+                in_states,
+                out_states,
+                curr_state,
+                edge_index,
+                edge_type):
+        """
+        :param in_states:
+            [num_nodes, num_edge_types, state_dim]
+        :param out_states:
+            [num_nodes, num_edge_types, state_dim]
+        :param curr_state:
+            [num_nodes, state_dim]
+        :param edge_index:
+            [2, num_edges]
+        :param edge_type:
+            [num_edges] or multi-hot [num_edges, num_edge_types]
+        :return:
+        """
+
+        if edge_type.dim() == 2:
+            edge_index, edge_type = relational_edges(edge_index, edge_type)
+        src, dst = edge_index
+
+        # Equation (2) in section 3.2, with scatter instead of bmm
+        # Matrices a_in and a_out size: [num_nodes, state_dim]
+        a_in = fp32_op(torch.Tensor.index_add, torch.zeros_like(curr_state),
+                       0, dst, in_states[src, edge_type])
+        a_out = fp32_op(torch.Tensor.index_add, torch.zeros_like(curr_state),
+                        0, src, out_states[dst, edge_type])
+        a = torch.cat((a_in, a_out), -1)
+
+        # Equation (3), (4) and (5) in section 3.2
+        gate_input = torch.cat((a, curr_state), -1)
+        r = self.__reset_gate(gate_input)
+        z = self.__update_gate(gate_input)
+        h_hat = self.__new_gate(torch.cat((a, r * curr_state), -1))
+
+        return (1 - z) * curr_state + z * h_hat
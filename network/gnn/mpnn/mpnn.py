@@ -13,11 +13,140 @@
             https://github.com/rusty1s/pytorch_geometric/blob/master/
             examples/qm9_nn_conv.py
 
+        With edge_type_weights, the edge network is only evaluated once per
+        distinct edge attribute vector in the batch (see TypedNNConv),
+        which avoids the [num_edges, state_dim, state_dim] weight tensor
+        of NNConv.
+
+        With checkpoint_every, the convolution steps are checkpointed in
+        blocks of checkpoint_every steps (see
+        network/common/checkpointing.py), so that the NNConv and GRU
+        activations are recomputed in backward instead of stored.
+
 """
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch_geometric.nn as pyg_nn
 import torch_geometric.data as pyg_data
+from typing import Optional, List, Tuple
+
+from network.common.checkpointing import block_ranges, checkpoint
+from network.common.fp32_ops import fp32_op
+
+
+class TypedNNConv(nn.Module):
+    """
+    Drop-in replacement of NNConv (root_weight=False) for discrete edge
+    attributes. The edge attribute rows are deduplicated, the edge network
+    generates one weight matrix per unique row (edge type), and the
+    messages are computed with one matmul per edge type over the edges
+    grouped by type.
+
+    The attribute names ('nn' and 'bias') are the same as NNConv, so the
+    state dict of a model with NNConv can be loaded directly.
+
+    With weight_rank, the edge network generates a low-rank factorization
+    of the weight matrix instead, i.e. [in_dim, rank] and [rank, out_dim]
+    matrices, and thus needs (in_dim + out_dim) * rank outputs.
+
+    Grouping the edges copies the group sizes to the host (a device
+    sync), so the grouping from group_edges() should be computed once per
+    batch and passed to every convolution step over the same edges.
+    """
+
+    def __init__(self,
+                 in_channels: int,
+                 out_channels: int,
+                 nn: nn.Module,
+                 aggr: str = 'mean',
+                 weight_rank: Optional[int] = None,
+                 bias: bool = True):
+
+        super(TypedNNConv, self).__init__()
+
+        if aggr not in ['add', 'mean']:
+            raise ValueError(f'Aggregation {aggr} is not supported.')
+
+        self.__in_channels = in_channels
+        self.__out_channels = out_channels
+        self.__aggr = aggr
+        self.__weight_rank = weight_rank
+
+        self.nn = nn
+        self.bias = torch.nn.Parameter(torch.Tensor(out_channels)) \
+            if bias else None
+
+        # Same initialization of bias as NNConv
+        if self.bias is not None:
+            __bound = 1. / (in_channels ** 0.5)
+            torch.nn.init.uniform_(self.bias, -__bound, __bound)
+
+    @staticmethod
+    def group_edges(edge_index: torch.Tensor,
+                    edge_attr: torch.Tensor) \
+            -> Optional[Tuple[torch.Tensor, torch.Tensor,
+                              torch.Tensor, List[int]]]:
+        """
+        Deduplicate the edge attribute rows into edge types and sort the
+        edges by type on the device. Returns the edge types, the source
+        and target nodes of the sorted edges and the number of edges of
+        each type, or None if there is no edge.
+        """
+
+        if edge_index.size(1) == 0:
+            return None
+
+        edge_types, edge_type, counts = torch.unique(
+            edge_attr, dim=0, return_inverse=True, return_counts=True)
+        order = torch.argsort(edge_type)
+        src, dst = edge_index[:, order]
+        return edge_types, src, dst, counts.tolist()
+
+    def forward(self,
+                x: torch.Tensor,
+                edge_index: torch.Tensor,
+                edge_attr: torch.Tensor,
+                edge_groups: Optional[tuple] = None) -> torch.Tensor:
+
+        out = x.new_zeros(x.shape[0], self.__out_channels)
+
+        # Without any edge, the aggregation is zero (plus bias)
+        if edge_index.size(1) == 0:
+            return out if (self.bias is None) else (out + self.bias)
+
+        if edge_groups is None:
+            edge_groups = self.group_edges(edge_index, edge_attr)
+        edge_types, src, dst, counts = edge_groups
+        weight = self.nn(edge_types)
+
+        # Compute the messages of each group of edges with the weight
+        # matrix (or factors) of the type
+        x_j = x[src].split(counts)
+
+        if self.__weight_rank is None:
+            weight = weight.view(
+                -1, self.__in_channels, self.__out_channels)
+            msg = [torch.matmul(__x_j, __w)
+                   for __x_j, __w in zip(x_j, weight)]
+        else:
+            __split = self.__in_channels * self.__weight_rank
+            u = weight[:, :__split].view(
+                -1, self.__in_channels, self.__weight_rank)
+            v = weight[:, __split:].view(
+                -1, self.__weight_rank, self.__out_channels)
+            msg = [torch.matmul(torch.matmul(__x_j, __u), __v)
+                   for __x_j, __u, __v in zip(x_j, u, v)]
+        msg = torch.cat(msg, dim=0)
+
+        out = fp32_op(torch.Tensor.index_add, out, 0, dst, msg)
+        if self.__aggr == 'mean':
+            __deg = torch.bincount(dst, minlength=x.shape[0]).clamp(min=1)
+            out = out / __deg.unsqueeze(-1).to(out.dtype)
+
+        if self.bias is not None:
+            out = out + self.bias
+        return out
 
 
 class MPNN(nn.Module):
@@ -31,22 +160,39 @@ class MPNN(nn.Module):
                  state_dim: int = 64,
                  num_conv: int = 3,
                  out_dim: int = 1,
-                 attention_pooling: bool = False):
+                 attention_pooling: bool = False,
+                 edge_type_weights: bool = False,
+                 weight_rank: Optional[int] = None,
+                 checkpoint_every: Optional[int] = None):
 
         super(MPNN, self).__init__()
 
+        if (weight_rank is not None) and (not edge_type_weights):
+            raise ValueError('Low-rank edge weights (weight_rank) are only '
+                             'available with edge_type_weights.')
+
         self.__in_linear = nn.Sequential(
             nn.Linear(node_attr_dim, state_dim),
             nn.ReLU())
 
         self.__num_conv = num_conv
+        self.__edge_type_weights = edge_type_weights
+        self.__checkpoint_ranges = block_ranges(num_conv, checkpoint_every)
+        self.__checkpoint = (checkpoint_every is not None)
+        __nn_conv_out_dim = (state_dim * state_dim) \
+            if (weight_rank is None) else (2 * state_dim * weight_rank)
         self.__nn_conv_linear = nn.Sequential(
             nn.Linear(edge_attr_dim, state_dim),
             nn.ReLU(),
-            nn.Linear(state_dim, state_dim * state_dim))
-        self.__nn_conv = pyg_nn.NNConv(
-            state_dim, state_dim, self.__nn_conv_linear,
-            aggr='mean', root_weight=False)
+            nn.Linear(state_dim, __nn_conv_out_dim))
+        if edge_type_weights:
+            self.__nn_conv = TypedNNConv(
+                state_dim, state_dim, self.__nn_conv_linear,
+                aggr='mean', weight_rank=weight_rank)
+        else:
+            self.__nn_conv = pyg_nn.NNConv(
+                state_dim, state_dim, self.__nn_conv_linear,
+                aggr='mean', root_weight=False)
         self.__gru = nn.GRU(state_dim, state_dim)
 
         # self.__set2set = pyg_nn.Set2Set(state_dim, processing_steps=3)
@@ -64,7 +210,23 @@ class MPNN(nn.Module):
             nn.ReLU(),
             nn.Linear(2 * state_dim, out_dim))
 
-    def forward(self, data: pyg_data.Data):
+    def __conv_steps(self, out, h, edge_index, edge_attr, num_steps: int,
+                     edge_groups=None):
+        for _ in range(num_steps):
+            if self.__edge_type_weights:
+                m = F.relu(self.__nn_conv(out, edge_index, edge_attr,
+                                          edge_groups))
+            else:
+                m = F.relu(self.__nn_conv(out, edge_index, edge_attr))
+            out, h = self.__gru(m.unsqueeze(0), h)
+            out = out.squeeze(0)
+        return out, h
+
+    def embed(self, data: pyg_data.Data):
+        """
+        Graph embeddings from the pooling layer, of the shape
+        [batch_size, 2 * state_dim].
+        """
 
         out = self.__in_linear(data.x)
         h = out.unsqueeze(0)
@@ -72,15 +234,54 @@ class MPNN(nn.Module):
         # Now out has the shape of [num_nodes, state_dim],
         # and h has the shape of [1, num_nodes, state_dim]
 
-        for i in range(self.__num_conv):
-            m = F.relu(self.__nn_conv(out, data.edge_index, data.edge_attr))
-            out, h = self.__gru(m.unsqueeze(0), h)
-            out = out.squeeze(0)
+        # Edges grouped by type once for all the convolution steps
+        edge_groups = TypedNNConv.group_edges(
+            data.edge_index, data.edge_attr) \
+            if self.__edge_type_weights else None
+
+        for __start, __end in self.__checkpoint_ranges:
+            out, h = checkpoint(self.__conv_steps, out, h,
+                                data.edge_index, data.edge_attr,
+                                __end - __start, edge_groups,
+                                enabled=self.__checkpoint)
 
         # Note that data.bach has the shape of [num_nodes]
         # which specifies the node's graph id in a batch
         out = self.__pooling(out, data.batch)
 
         # Now out is of size [batch_size, 2 * state_dim]
-        return self.__out_linear(out)
-        # return out.view(-1)
+        return out
+
+    def forward(self, data: pyg_data.Data):
+        return self.__out_linear(self.embed(data))
+
+
+# Testing segment for the edge-type weights (TypedNNConv) against NNConv
+if __name__ == '__main__':
+
+    # Edge attributes drawn from a few distinct vectors (like bond
+    # features), and a graph without any bond in the same batch
+    torch.manual_seed(0)
+    __palette = (torch.rand(3, 4) < 0.3).float()
+    __palette[:, 0] = 1.
+    __src, __dst = torch.randint(10, (2, 20))
+    __edge_attr = __palette[torch.randint(3, (20, ))]
+    __data = pyg_data.Batch.from_data_list([
+        pyg_data.Data(x=torch.rand(10, 8),
+                      edge_index=torch.stack([torch.cat([__src, __dst]),
+                                              torch.cat([__dst, __src])]),
+                      edge_attr=torch.cat([__edge_attr, __edge_attr])),
+        pyg_data.Data(x=torch.rand(3, 8),
+                      edge_index=torch.zeros(2, 0, dtype=torch.long),
+                      edge_attr=torch.zeros(0, 4))])
+
+    __kwargs = {'node_attr_dim': 8, 'edge_attr_dim': 4,
+                'state_dim': 16, 'num_conv': 2}
+    __mpnn = MPNN(**__kwargs).eval()
+    __typed_mpnn = MPNN(edge_type_weights=True, **__kwargs).eval()
+    __typed_mpnn.load_state_dict(__mpnn.state_dict())
+    with torch.no_grad():
+        __max_diff = (__mpnn(__data) -
+                      __typed_mpnn(__data)).abs().max().item()
+    print(f'NNConv vs. TypedNNConv MPNN max abs diff: {__max_diff:.2e}')
+    assert __max_diff < 1e-4
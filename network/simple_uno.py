@@ -6,10 +6,75 @@
     Python Version:     3.5.4
     File Description:   
 
+        SimpleUno.export() returns an inference-only copy of the model, with
+        every eval-mode BatchNorm1d folded into the preceding Linear, the
+        Dropout layers removed, and the result scripted and frozen with
+        TorchScript (if possible).
+
+        SimpleUno.cache_drug_embeddings() replaces the forward pass of a
+        frozen drug tower (e.g. a pretrained graph encoder) with a lookup
+        into the embeddings of all the drugs (DrugEmbeddingCache).
 """
+import copy
 import torch
+import logging
 from torch import nn
-from typing import Optional
+from typing import Optional, Sequence
+
+from network.common.embedding_cache import DrugEmbeddingCache
+
+logger = logging.getLogger(__name__)
+
+
+# Inference helper functions ##################################################
+def fold_linear_batch_norm(linear: nn.Linear,
+                           batch_norm: nn.BatchNorm1d) -> nn.Linear:
+    """
+    Linear layer equivalent to linear followed by batch_norm in eval mode:
+        W' = W * s, b' = (b - mean) * s + beta, s = gamma / sqrt(var + eps)
+    """
+
+    __weight, __bias = linear.weight.detach(), linear.bias
+    __bias = torch.zeros_like(batch_norm.running_mean) if __bias is None \
+        else __bias.detach()
+    __scale = torch.rsqrt(batch_norm.running_var + batch_norm.eps)
+    __shift = -batch_norm.running_mean * __scale
+    if batch_norm.affine:
+        __scale = __scale * batch_norm.weight.detach()
+        __shift = __shift * batch_norm.weight.detach() + \
+            batch_norm.bias.detach()
+
+    folded = nn.Linear(linear.in_features, linear.out_features, bias=True)
+    folded = folded.to(device=__weight.device, dtype=__weight.dtype)
+    with torch.no_grad():
+        folded.weight.copy_(__weight * __scale.unsqueeze(1))
+        folded.bias.copy_(__bias * __scale + __shift)
+    return folded
+
+
+def fold_batch_norm(module: nn.Module) -> nn.Module:
+    """
+    Eval-mode copy of a module, where the (Linear, BatchNorm1d) pairs of
+    nn.Sequential are folded into single Linear layers and the Dropout
+    layers are removed. Other modules (e.g. graph drug towers) are only
+    copied.
+    """
+
+    if not isinstance(module, nn.Sequential):
+        return copy.deepcopy(module).eval()
+
+    __layers = [l for l in module if not isinstance(l, nn.Dropout)]
+    layers = []
+    for __layer in __layers:
+        if isinstance(__layer, nn.BatchNorm1d) and layers and \
+                isinstance(layers[-1], nn.Linear) and \
+                __layer.track_running_stats:
+            layers[-1] = fold_linear_batch_norm(layers[-1], __layer)
+        else:
+            layers.append(fold_batch_norm(__layer)
+                          if isinstance(__layer, nn.Sequential)
+                          else copy.deepcopy(__layer))
+    return nn.Sequential(*layers).eval()
 
 
 # Simple Uno-like model
@@ -32,6 +97,7 @@ class SimpleUno(nn.Module):
         super(SimpleUno, self).__init__()
         self.__dose_info = dose_info
         self.__sigmoid_output = sigmoid_output
+        self.__drug_cache = None
 
         self.__cell_tower = cell_tower if (cell_tower is not None) \
             else nn.Sequential(
@@ -94,10 +160,94 @@ class SimpleUno(nn.Module):
     def forward(self, cell_data, drug_data, dose=None):
 
         __cell_latent_vec = self.__cell_tower(cell_data)
-        __drug_latent_vec = self.__drug_tower(drug_data)
+        __drug_latent_vec = self.__drug_cache(drug_data) \
+            if (self.__drug_cache is not None) and \
+            self.__drug_cache.usable(drug_data) \
+            else self.__drug_tower(drug_data)
 
         __latent_vec = (__cell_latent_vec, __drug_latent_vec, dose) \
             if self.__dose_info else (__cell_latent_vec, __drug_latent_vec)
         __pred = self.__pred_tower(torch.cat(__latent_vec, dim=-1))
 
         return torch.sigmoid(__pred) if self.__sigmoid_output else __pred
+
+    def cache_drug_embeddings(self,
+                              drug_data_list: Optional[Sequence] = None,
+                              batch_size: int = 256):
+        """
+        Look up the embeddings of the drugs (with drug indices, in the order
+        of drug_data_list) instead of running the drug tower while it is
+        frozen, or disable the cache if drug_data_list is None.
+        """
+        self.__drug_cache = None if drug_data_list is None else \
+            DrugEmbeddingCache(self.__drug_tower, drug_data_list, batch_size)
+
+    def export(self, script: bool = True, freeze: bool = True) -> nn.Module:
+        """
+        Inference-only copy of the model with folded BatchNorm layers,
+        which is scripted (and frozen) with TorchScript if possible. Note
+        that custom towers that cannot be scripted (e.g. graph models on
+        PyG batches) are kept in eager mode.
+        """
+
+        exported = InferenceUno(
+            cell_tower=fold_batch_norm(self.__cell_tower),
+            drug_tower=fold_batch_norm(self.__drug_tower),
+            pred_tower=fold_batch_norm(self.__pred_tower),
+            dose_info=self.__dose_info,
+            sigmoid_output=self.__sigmoid_output).eval()
+
+        if not script:
+            return exported
+        try:
+            scripted = torch.jit.script(exported)
+        except Exception as e:
+            logger.warning(f'Failed to script the model ({e}); '
+                           f'using the eager model for inference.')
+            return exported
+        if freeze and hasattr(torch.jit, 'freeze'):
+            scripted = torch.jit.freeze(scripted)
+        return scripted
+
+
+class InferenceUno(nn.Module):
+    """
+    Inference counterpart of SimpleUno from SimpleUno.export(). The
+    attributes are public and the flags are constants so that the model
+    can be compiled by TorchScript.
+    """
+
+    __constants__ = ['dose_info', 'sigmoid_output']
+
+    def __init__(self,
+                 cell_tower: nn.Module,
+                 drug_tower: nn.Module,
+                 pred_tower: nn.Module,
+                 dose_info: bool,
+                 sigmoid_output: bool):
+
+        super().__init__()
+        self.dose_info = dose_info
+        self.sigmoid_output = sigmoid_output
+
+        self.cell_tower = cell_tower
+        self.drug_tower = drug_tower
+        self.pred_tower = pred_tower
+
+    def forward(self,
+                cell_data: torch.Tensor,
+                drug_data: torch.Tensor,
+                dose: Optional[torch.Tensor] = None) -> torch.Tensor:
+
+        cell_latent_vec = self.cell_tower(cell_data)
+        drug_latent_vec = self.drug_tower(drug_data)
+
+        if self.dose_info:
+            assert dose is not None
+            latent_vec = torch.cat(
+                (cell_latent_vec, drug_latent_vec, dose), dim=-1)
+        else:
+            latent_vec = torch.cat((cell_latent_vec, drug_latent_vec), dim=-1)
+        pred = self.pred_tower(latent_vec)
+
+        return torch.sigmoid(pred) if self.sigmoid_output else pred
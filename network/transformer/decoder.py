@@ -8,6 +8,7 @@
 
 """
 import torch.nn as nn
+from typing import Optional, List
 
 from network.common.embedding import Embedding
 from network.transformer.decoder_layer import DecoderLayer
@@ -33,7 +34,8 @@ class Decoder(nn.Module):
                  ff_dropout: float = 0.0,
                  enc_dropout: float = 0.0,
 
-                 epsilon: float = 1e-6):
+                 epsilon: float = 1e-6,
+                 use_sdpa: Optional[bool] = None):
 
         super().__init__()
 
@@ -54,15 +56,30 @@ class Decoder(nn.Module):
                           mha_dropout=mha_dropout,
                           ff_dropout=ff_dropout,
                           enc_dropout=enc_dropout,
-                          epsilon=epsilon) for _ in range(num_layers)])
+                          epsilon=epsilon,
+                          use_sdpa=use_sdpa) for _ in range(num_layers)])
 
         self.__output_norm = nn.LayerNorm(normalized_shape=emb_dim,
                                           eps=epsilon)
 
-    def forward(self, trg_indexed_sentence, encoder_output,
-                src_mask, trg_mask):
+    def init_cache(self) -> List[dict]:
+        """
+        Empty cache of keys and values for incremental decoding.
+        """
+        return [{'self': {}, 'enc': {}} for _ in self.__decoder_layers]
 
-        h = self.__position_encoder(self.__embedding(trg_indexed_sentence))
-        for decoder_layer in self.__decoder_layers:
-            h = decoder_layer(h, encoder_output, src_mask, trg_mask)
+    def forward(self, trg_indexed_sentence, encoder_output,
+                src_mask, trg_mask,
+                cache: Optional[List[dict]] = None,
+                offset: int = 0):
+        """
+        For incremental decoding, pass the cache from init_cache() and
+        only the new target tokens, which start at position offset.
+        """
+
+        h = self.__position_encoder(self.__embedding(trg_indexed_sentence),
+                                    offset=offset)
+        for i, decoder_layer in enumerate(self.__decoder_layers):
+            h = decoder_layer(h, encoder_output, src_mask, trg_mask,
+                              cache=None if cache is None else cache[i])
         return self.__output_norm(h)
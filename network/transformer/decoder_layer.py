@@ -8,6 +8,7 @@
 
 """
 import torch.nn as nn
+from typing import Optional
 from network.transformer.feed_forward import FeedForward
 from network.transformer.multi_head_attn import MultiHeadAttention
 
@@ -24,7 +25,8 @@ class DecoderLayer(nn.Module):
                  mha_dropout: float = 0.0,
                  ff_dropout: float = 0.0,
                  enc_dropout: float = 0.0,
-                 epsilon: float = 1e-6):
+                 epsilon: float = 1e-6,
+                 use_sdpa: Optional[bool] = None):
 
         super().__init__()
 
@@ -34,7 +36,8 @@ class DecoderLayer(nn.Module):
         self.__dropout_for_x_mha = nn.Dropout(enc_dropout)
         self.__x_mha = MultiHeadAttention(emb_dim=emb_dim,
                                           num_heads=num_heads,
-                                          dropout=mha_dropout)
+                                          dropout=mha_dropout,
+                                          use_sdpa=use_sdpa)
 
         # This part of the network takes encoder layer output
         self.__norm_for_enc_mha = nn.LayerNorm(normalized_shape=emb_dim,
@@ -42,7 +45,8 @@ class DecoderLayer(nn.Module):
         self.__dropout_for_enc_mha = nn.Dropout(enc_dropout)
         self.__enc_mha = MultiHeadAttention(emb_dim=emb_dim,
                                             num_heads=num_heads,
-                                            dropout=mha_dropout)
+                                            dropout=mha_dropout,
+                                            use_sdpa=use_sdpa)
 
         # Feed-forward network
         self.__norm_for_ff = nn.LayerNorm(normalized_shape=emb_dim,
@@ -52,17 +56,26 @@ class DecoderLayer(nn.Module):
                                 mid_dim=ff_mid_dim,
                                 dropout=ff_dropout)
 
-    def forward(self, x, enc_out, src_mask, trg_mask):
+    def forward(self, x, enc_out, src_mask, trg_mask, cache=None):
+        """
+        With cache ({'self': {}, 'enc': {}}), x only contains the new
+        target positions, and the keys/values of the previous positions
+        and the encoder output are taken from the cache.
+        """
+
+        self_cache, enc_cache = (None, None) if cache is None \
+            else (cache['self'], cache['enc'])
 
         norm_x = self.__norm_for_x_mha(x)
 
         h = x + self.__dropout_for_x_mha(
-            self.__x_mha(norm_x, norm_x, norm_x, trg_mask))
+            self.__x_mha(norm_x, norm_x, norm_x, trg_mask, cache=self_cache))
 
         norm_h = self.__norm_for_enc_mha(h)
 
         h = h + self.__dropout_for_enc_mha(
-            self.__enc_mha(norm_h, enc_out, enc_out, src_mask))
+            self.__enc_mha(norm_h, enc_out, enc_out, src_mask,
+                           cache=enc_cache, static_kv=True))
 
         norm_h = self.__norm_for_ff(h)
 
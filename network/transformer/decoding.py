@@ -0,0 +1,182 @@
+"""
+    File Name:          MoReL/decoding.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Batched autoregressive decoding with the Transformer, using the
+        cached keys and values of the decoder (Transformer.decode_step),
+        so that every step only computes the attention of the new token.
+
+        Greedy and top-k sampling drop the finished sequences (EOS) from
+        the batch as soon as they end. Beam search keeps the finished
+        beams and stops when all of them are finished.
+
+        All the functions return token tensors [batch_size, length] that
+        start with SOS, and are padded with PAD after EOS.
+"""
+import torch
+from typing import Optional
+
+from network.transformer.transformer import Transformer, reorder_cache
+from utils.dataset.featurizers import DEFAULT_TOKEN_DICT
+
+SOS_INDEX = DEFAULT_TOKEN_DICT['SOS']
+EOS_INDEX = DEFAULT_TOKEN_DICT['EOS']
+PAD_INDEX = DEFAULT_TOKEN_DICT['PAD']
+
+
+def __sample(model: Transformer,
+             src_indexed_sentence: torch.Tensor,
+             select_func: callable,
+             max_length: int,
+             src_mask: Optional[torch.Tensor]) -> torch.Tensor:
+
+    batch_size = src_indexed_sentence.size(0)
+    device = src_indexed_sentence.device
+
+    enc_out, src_mask = model.encode(src_indexed_sentence, src_mask)
+    cache = model.init_cache()
+
+    tokens = torch.full((batch_size, max_length), PAD_INDEX,
+                        dtype=torch.long, device=device)
+    tokens[:, 0] = SOS_INDEX
+
+    # Indices of the sequences that are still being decoded
+    active = torch.arange(batch_size, device=device)
+    last_tokens = tokens[:, :1]
+
+    for step in range(max_length - 1):
+
+        log_prob = model.decode_step(
+            last_tokens, enc_out, src_mask, cache, offset=step)[:, -1]
+        next_tokens = select_func(log_prob)
+        tokens[active, step + 1] = next_tokens
+
+        # Drop the finished sequences from the batch and the cache
+        __unfinished = (next_tokens != EOS_INDEX).nonzero().view(-1)
+        if len(__unfinished) == 0:
+            break
+        if len(__unfinished) < len(active):
+            active = active[__unfinished]
+            next_tokens = next_tokens[__unfinished]
+            enc_out = enc_out.index_select(0, __unfinished)
+            if src_mask is not None:
+                src_mask = src_mask.index_select(0, __unfinished)
+            cache = reorder_cache(cache, __unfinished)
+
+        last_tokens = next_tokens.unsqueeze(1)
+
+    return tokens
+
+
+def greedy_decode(model: Transformer,
+                  src_indexed_sentence: torch.Tensor,
+                  max_length: int = 128,
+                  src_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+
+    def __select(log_prob):
+        return log_prob.argmax(dim=-1)
+
+    with torch.no_grad():
+        return __sample(model, src_indexed_sentence, __select,
+                        max_length, src_mask)
+
+
+def top_k_sample(model: Transformer,
+                 src_indexed_sentence: torch.Tensor,
+                 k: int = 10,
+                 temperature: float = 1.0,
+                 max_length: int = 128,
+                 src_mask: Optional[torch.Tensor] = None,
+                 generator: Optional[torch.Generator] = None) \
+        -> torch.Tensor:
+
+    def __select(log_prob):
+        __top_log_prob, __top_index = \
+            (log_prob / temperature).topk(k, dim=-1)
+        __choice = torch.multinomial(
+            __top_log_prob.softmax(dim=-1), 1, generator=generator)
+        return __top_index.gather(-1, __choice).view(-1)
+
+    with torch.no_grad():
+        return __sample(model, src_indexed_sentence, __select,
+                        max_length, src_mask)
+
+
+def beam_search(model: Transformer,
+                src_indexed_sentence: torch.Tensor,
+                beam_size: int = 4,
+                length_penalty: float = 1.0,
+                max_length: int = 128,
+                src_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Beam search that returns the best sequence of every source, scored
+    by the sum of log probabilities divided by length ** length_penalty.
+    """
+
+    batch_size = src_indexed_sentence.size(0)
+    device = src_indexed_sentence.device
+
+    with torch.no_grad():
+
+        enc_out, src_mask = model.encode(src_indexed_sentence, src_mask)
+
+        # Flatten (batch, beam) into the batch dimension
+        __repeat = torch.arange(batch_size, device=device).repeat_interleave(
+            beam_size)
+        enc_out = enc_out.index_select(0, __repeat)
+        if src_mask is not None:
+            src_mask = src_mask.index_select(0, __repeat)
+        cache = model.init_cache()
+
+        tokens = torch.full((batch_size * beam_size, 1), SOS_INDEX,
+                            dtype=torch.long, device=device)
+        finished = torch.zeros(batch_size * beam_size, dtype=torch.bool,
+                               device=device)
+        lengths = torch.ones(batch_size * beam_size, device=device)
+
+        # Only the first beam is alive at the beginning to avoid duplicates
+        scores = torch.zeros(batch_size, beam_size, device=device)
+        scores[:, 1:] = float('-inf')
+
+        __beam_offset = (torch.arange(batch_size, device=device) *
+                         beam_size).unsqueeze(1)
+
+        for step in range(max_length - 1):
+
+            log_prob = model.decode_step(
+                tokens[:, -1:], enc_out, src_mask, cache, offset=step)[:, -1]
+            dict_size = log_prob.size(-1)
+
+            # Finished beams can only be extended by PAD without any cost
+            log_prob[finished] = float('-inf')
+            log_prob[finished, PAD_INDEX] = 0.
+
+            __candidates = (scores.view(-1, 1) + log_prob).view(
+                batch_size, beam_size * dict_size)
+            scores, __index = __candidates.topk(beam_size, dim=-1)
+
+            __src_beam = (__beam_offset + __index // dict_size).view(-1)
+            __next_tokens = (__index % dict_size).view(-1)
+
+            tokens = torch.cat((tokens.index_select(0, __src_beam),
+                                __next_tokens.unsqueeze(1)), dim=1)
+            finished = finished.index_select(0, __src_beam)
+            lengths = lengths.index_select(0, __src_beam) + (~finished).float()
+            finished = finished | (__next_tokens == EOS_INDEX)
+            cache = reorder_cache(cache, __src_beam)
+
+            if finished.all():
+                break
+
+        __normalized_scores = scores / lengths.view(
+            batch_size, beam_size) ** length_penalty
+        __best = __beam_offset.view(-1) + __normalized_scores.argmax(dim=-1)
+
+        ret = torch.full((batch_size, max_length), PAD_INDEX,
+                         dtype=torch.long, device=device)
+        ret[:, :tokens.size(1)] = tokens.index_select(0, __best)
+        return ret
@@ -8,6 +8,7 @@
 
 """
 import torch.nn as nn
+from typing import Optional
 
 from network.common.embedding import Embedding
 from network.transformer.encoder_layer import EncoderLayer
@@ -33,7 +34,8 @@ class Encoder(nn.Module):
                  ff_dropout: float = 0.0,
                  enc_dropout: float = 0.0,
 
-                 epsilon: float = 1e-6):
+                 epsilon: float = 1e-6,
+                 use_sdpa: Optional[bool] = None):
 
         super().__init__()
 
@@ -54,7 +56,8 @@ class Encoder(nn.Module):
                           mha_dropout=mha_dropout,
                           ff_dropout=ff_dropout,
                           enc_dropout=enc_dropout,
-                          epsilon=epsilon) for _ in range(num_layers)])
+                          epsilon=epsilon,
+                          use_sdpa=use_sdpa) for _ in range(num_layers)])
 
         self.__output_norm = nn.LayerNorm(normalized_shape=emb_dim,
                                           eps=epsilon)
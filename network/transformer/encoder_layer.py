@@ -8,6 +8,7 @@
 
 """
 import torch.nn as nn
+from typing import Optional
 
 from network.transformer.feed_forward import FeedForward
 from network.transformer.multi_head_attn import MultiHeadAttention
@@ -25,7 +26,8 @@ class EncoderLayer(nn.Module):
                  mha_dropout: float = 0.0,
                  ff_dropout: float = 0.0,
                  enc_dropout: float = 0.0,
-                 epsilon: float = 1e-6):
+                 epsilon: float = 1e-6,
+                 use_sdpa: Optional[bool] = None):
 
         super().__init__()
 
@@ -34,7 +36,8 @@ class EncoderLayer(nn.Module):
         self.__dropout_for_mha = nn.Dropout(enc_dropout)
         self.__mha = MultiHeadAttention(emb_dim=emb_dim,
                                         num_heads=num_heads,
-                                        dropout=mha_dropout)
+                                        dropout=mha_dropout,
+                                        use_sdpa=use_sdpa)
 
         self.__norm_for_ff = nn.LayerNorm(normalized_shape=emb_dim,
                                           eps=epsilon)
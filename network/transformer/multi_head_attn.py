@@ -6,18 +6,91 @@
     Python Version:     3.5.4
     File Description:   
 
+        Masks are boolean (or 0/1) tensors where True/1 means "attend",
+        and they are broadcast to (batch_size, num_heads, q_length,
+        k_length) by normalize_mask:
+            (batch_size, k_length)              key padding mask
+            (q_length, k_length)                e.g. subsequent mask
+            (batch_size, q_length, k_length)    e.g. padding & subsequent
+            (1, q_length, k_length)             e.g. subsequent mask
+
+        2D masks are key padding masks unless stated otherwise (with
+        key_padding=False), or unless their first dimension only matches
+        the query length and not the batch size.
+
+        The fused attention kernels (scaled_dot_product_attention) are
+        used if available, unless use_sdpa=False is given to the module.
 """
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from typing import Optional
+
+# Fused attention kernels (flash/memory-efficient) in PyTorch >= 2.0
+SDPA_AVAILABLE = hasattr(F, 'scaled_dot_product_attention')
+
+
+def padding_mask(indexed_sentence: torch.Tensor,
+                 pad_index: int) -> torch.Tensor:
+    """
+    Key padding mask of shape (batch_size, seq_length).
+    """
+    return indexed_sentence != pad_index
+
+
+def subsequent_mask(seq_length: int,
+                    device: torch.device = None) -> torch.Tensor:
+    """
+    Mask of shape (seq_length, seq_length) that prevents the positions
+    from attending to the following ones.
+    """
+    return torch.ones(seq_length, seq_length, dtype=torch.bool,
+                      device=device).tril()
+
+
+def normalize_mask(mask: Optional[torch.Tensor],
+                   batch_size: Optional[int] = None,
+                   q_length: Optional[int] = None,
+                   key_padding: Optional[bool] = None) \
+        -> Optional[torch.Tensor]:
+    """
+    Broadcast a mask to (batch_size, num_heads, q_length, k_length).
+    Whether a 2D mask is a (batch_size, k_length) key padding mask or a
+    (q_length, k_length) mask shared by the batch is given by key_padding,
+    or inferred from its shape if batch_size and q_length are given.
+    Ambiguous masks (batch_size == q_length) are key padding masks.
+    """
+    if mask is None:
+        return None
+    mask = mask.bool() if mask.dtype != torch.bool else mask
+    if mask.dim() == 2:
+        if key_padding is None:
+            key_padding = not ((mask.size(0) == q_length) and
+                               (mask.size(0) != batch_size))
+        return mask[:, None, None, :] if key_padding \
+            else mask[None, None, :, :]
+    if mask.dim() == 3:
+        return mask.unsqueeze(1)
+    return mask
 
 
 def attention(query: torch.Tensor,
               key: torch.Tensor,
               value: torch.Tensor,
               mask=None,
-              dropout: nn.Module = None):
+              dropout: nn.Module = None,
+              key_padding: Optional[bool] = None,
+              use_sdpa: bool = SDPA_AVAILABLE):
+
+    mask = normalize_mask(mask, batch_size=query.size(0),
+                          q_length=query.size(-2), key_padding=key_padding)
+
+    if use_sdpa:
+        return F.scaled_dot_product_attention(
+            query, key, value, attn_mask=mask,
+            dropout_p=(dropout.p if (dropout is not None) and
+                       dropout.training else 0.))
 
     # The shape of scores is
     # (batch_size, num_heads, seq_length, seq_length)
@@ -25,8 +98,7 @@ def attention(query: torch.Tensor,
              / math.sqrt(query.size(-1))
 
     if mask is not None:
-        mask = mask.unsqueeze(-1)
-        scores = scores.masked_fill(mask == 0, -1e9)
+        scores = scores.masked_fill(~mask, torch.finfo(scores.dtype).min)
 
     scores = F.softmax(scores, dim=-1)
 
@@ -44,10 +116,16 @@ class MultiHeadAttention(nn.Module):
     def __init__(self,
                  emb_dim: int,
                  num_heads: int,
-                 dropout: float = 0.0):
+                 dropout: float = 0.0,
+                 use_sdpa: Optional[bool] = None):
 
         super().__init__()
 
+        if use_sdpa and (not SDPA_AVAILABLE):
+            raise ValueError('Fused attention (scaled_dot_product_attention)'
+                             ' is not available in this version of PyTorch.')
+        self.__use_sdpa = SDPA_AVAILABLE if (use_sdpa is None) else use_sdpa
+
         self.__emb_dim = emb_dim
         self.__num_heads = num_heads
         self.__emb_dim_per_head = emb_dim // num_heads
@@ -61,7 +139,19 @@ class MultiHeadAttention(nn.Module):
         # Output layer of each attention cell
         self.__out_linear = nn.Linear(emb_dim, emb_dim)
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None,
+                cache: Optional[dict] = None,
+                static_kv: bool = False,
+                key_padding: Optional[bool] = None):
+        """
+        :param key_padding: whether a 2D mask is a key padding mask (see
+            normalize_mask), which is inferred from its shape if None.
+        :param cache: dict of projected keys and values from the previous
+            calls for incremental decoding, which is updated in place.
+            For self-attention, the new keys and values are appended to
+            the cached ones; with static_kv (e.g. encoder output for
+            cross-attention), they are only projected in the first call.
+        """
 
         # Input key, value, and query are all in the shape of
         # (batch_size, num_heads, emb_dim)
@@ -72,8 +162,16 @@ class MultiHeadAttention(nn.Module):
         shape = (batch_size, -1, self.__num_heads, self.__emb_dim_per_head)
 
         q = self.__q_linear(q).view(*shape).transpose(1, 2)
-        k = self.__k_linear(k).view(*shape).transpose(1, 2)
-        v = self.__v_linear(v).view(*shape).transpose(1, 2)
+        if (cache is not None) and static_kv and ('k' in cache):
+            k, v = cache['k'], cache['v']
+        else:
+            k = self.__k_linear(k).view(*shape).transpose(1, 2)
+            v = self.__v_linear(v).view(*shape).transpose(1, 2)
+            if cache is not None:
+                if (not static_kv) and ('k' in cache):
+                    k = torch.cat((cache['k'], k), dim=2)
+                    v = torch.cat((cache['v'], v), dim=2)
+                cache['k'], cache['v'] = k, v
 
         # Key, value, and query are all in the shape of
         # (batch_size, num_heads, seq_length, emb_dim_per_head)
@@ -81,7 +179,9 @@ class MultiHeadAttention(nn.Module):
         # Scores of attention have shape
         # (batch_size, num_heads, seq_length, emb_dim_per_head)
         scores = attention(query=q, key=k, value=v,
-                           mask=mask, dropout=self.__dropout)
+                           mask=mask, dropout=self.__dropout,
+                           key_padding=key_padding,
+                           use_sdpa=self.__use_sdpa)
 
         # Concatenate heads (as input of the last layer)
         # (batch_size, seq_length, emb_dim)
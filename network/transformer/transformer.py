@@ -7,11 +7,15 @@
     File Description:   
 
 """
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from typing import Optional, List
 
 from network.transformer.decoder import Decoder
 from network.transformer.encoder import Encoder
+from network.transformer.multi_head_attn import \
+    padding_mask, subsequent_mask
 
 
 class Transformer(nn.Module):
@@ -35,9 +39,17 @@ class Transformer(nn.Module):
                  ff_dropout: float = 0.0,
                  enc_dropout: float = 0.0,
 
-                 epsilon: float = 1e-6):
+                 epsilon: float = 1e-6,
+                 pad_index: Optional[int] = None,
+                 use_sdpa: Optional[bool] = None):
+        """
+        If pad_index is given, the masks that are not passed to forward
+        are derived from the padding tokens (and the subsequent mask for
+        the target).
+        """
 
         super().__init__()
+        self.__pad_index = pad_index
 
         network_kwargs = {
             'seq_length': seq_length,
@@ -55,19 +67,76 @@ class Transformer(nn.Module):
             'ff_dropout': ff_dropout,
             'enc_dropout': enc_dropout,
 
-            'epsilon': epsilon, }
+            'epsilon': epsilon,
+            'use_sdpa': use_sdpa, }
 
         self.__encoder = Encoder(dict_size=src_dict_size, **network_kwargs)
         self.__decoder = Decoder(dict_size=trg_dict_size, **network_kwargs)
         self.__output = nn.Linear(emb_dim, trg_dict_size)
 
+    def src_mask(self, src_indexed_sentence):
+        if self.__pad_index is None:
+            return None
+        return padding_mask(src_indexed_sentence, self.__pad_index)
+
+    def trg_mask(self, trg_indexed_sentence):
+        mask = subsequent_mask(trg_indexed_sentence.size(1),
+                               trg_indexed_sentence.device).unsqueeze(0)
+        if self.__pad_index is None:
+            return mask
+        return mask & padding_mask(
+            trg_indexed_sentence, self.__pad_index).unsqueeze(1)
+
     def forward(self,
                 src_indexed_sentence,
                 trg_indexed_sentence,
-                src_mask,
-                trg_mask):
+                src_mask=None,
+                trg_mask=None):
+
+        if src_mask is None:
+            src_mask = self.src_mask(src_indexed_sentence)
+        if trg_mask is None:
+            trg_mask = self.trg_mask(trg_indexed_sentence)
 
-        enc_out = self.__encoder(src_indexed_sentence, src_mask),
+        enc_out = self.__encoder(src_indexed_sentence, src_mask)
         h = self.__decoder(trg_indexed_sentence, enc_out, src_mask, trg_mask)
         return F.log_softmax(self.__output(h), dim=-1)
 
+    # Incremental decoding (see network/transformer/decoding.py) ##########
+    def encode(self, src_indexed_sentence, src_mask=None):
+        if src_mask is None:
+            src_mask = self.src_mask(src_indexed_sentence)
+        return self.__encoder(src_indexed_sentence, src_mask), src_mask
+
+    def init_cache(self) -> List[dict]:
+        return self.__decoder.init_cache()
+
+    def decode_step(self,
+                    trg_indexed_sentence,
+                    enc_out,
+                    src_mask,
+                    cache: List[dict],
+                    offset: int):
+        """
+        Log probabilities of the next tokens given the new target tokens
+        [batch_size, num_new_tokens] starting at position offset. The keys
+        and values of the previous positions are taken from the cache.
+        """
+        __length = trg_indexed_sentence.size(1)
+        trg_mask = None if __length == 1 else \
+            subsequent_mask(offset + __length, trg_indexed_sentence.device
+                            )[offset:].unsqueeze(0)
+        h = self.__decoder(trg_indexed_sentence, enc_out, src_mask, trg_mask,
+                           cache=cache, offset=offset)
+        return F.log_softmax(self.__output(h), dim=-1)
+
+
+def reorder_cache(cache: List[dict], indices: torch.Tensor) -> List[dict]:
+    """
+    Select (and reorder) the sequences in the cache by batch indices,
+    e.g. for beam search or for dropping finished sequences.
+    """
+    return [{__attn: {__k: __v.index_select(0, indices)
+                      for __k, __v in __layer_cache[__attn].items()}
+             for __attn in __layer_cache}
+            for __layer_cache in cache]
@@ -1,7 +1,7 @@
+import copy
 import torch
 import argparse
 import numpy as np
-from sklearn.metrics import r2_score
 from torch import nn
 import torch.nn.functional as F
 from typing import List
@@ -9,7 +9,18 @@ from typing import List
 import sys
 sys.path.extend(['/raid/xduan7/Projects/MoReL'])
 from network.simple_uno import SimpleUno
+from network.common.ensemble import StackedEnsemble, EnsembleOptimizer, \
+    EnsembleScheduler, member_losses
 from utils.misc.random_seeding import seed_random_state
+from utils.misc.quantization import \
+    quantize_for_inference, quantization_report
+from utils.misc.precision import PRECISIONS
+from utils.misc.metrics import RegressionMetrics
+from utils.misc.trainer import Trainer
+from utils.misc.compiling import CompiledForward
+from utils.misc.distributed import launch, default_threads_per_proc, \
+    get_world_size, is_main_process, main_print, wrap_model, \
+    distributed_sampler, broadcast_value
 from utils.dataset.drug_resp_dataset import DrugRespDataset, \
     trim_resp_array, \
     get_resp_array, ScalingMethod, NanProcessing, DrugFeatureType, \
@@ -74,19 +85,38 @@ def get_cross_study_datasets(
     return trn_dset, tst_dsets
 
 
+def uno_forward(model, batch):
+    _, cell, drug, trgt, dose = batch
+    return model(cell, drug, dose), trgt
+
+
+def ensemble_forward(ensemble, batch):
+    # Batch first ([batch_size, num_members, 1]) for the trainer
+    _, cell, drug, trgt, dose = batch
+    return ensemble(cell, drug, dose).transpose(0, 1), trgt
+
+
+def ensemble_losses(pred, trgt):
+    return member_losses(pred.transpose(0, 1), trgt)
+
+
 def run_instance(
         trn_sources: List[str],
         tst_sources: List[str],
         state_dim: int,
         subsample_on: str,
         subsample_percentage: float,
-        device: torch.device):
+        device: torch.device,
+        quantized_inference: bool = False,
+        quantization_holdout: float = 0.1,
+        precision: str = 'fp32',
+        compile: bool = False):
 
-    print('\n' + '#' * 80)
-    print('#' * 80)
+    main_print('\n' + '#' * 80)
+    main_print('#' * 80)
 
-    print(f'Training Sources: {trn_sources} '
-          f'(using only {subsample_percentage * 100: .0f}%% {subsample_on})')
+    main_print(f'Training Sources: {trn_sources} (using only '
+               f'{subsample_percentage * 100: .0f}%% {subsample_on})')
 
     trn_dset, tst_dsets = \
         get_cross_study_datasets(trn_sources=trn_sources,
@@ -94,19 +124,19 @@ def run_instance(
                                  subsample_on=subsample_on,
                                  subsample_percentage=subsample_percentage)
 
-    print('Datasets Summary:')
-    print('-' * 80)
-    print(f'Training Dataset ({trn_sources}):')
-    print(trn_dset)
+    main_print('Datasets Summary:')
+    main_print('-' * 80)
+    main_print(f'Training Dataset ({trn_sources}):')
+    main_print(trn_dset)
 
-    print('-' * 80)
-    print('Testing Dataset(s):')
+    main_print('-' * 80)
+    main_print('Testing Dataset(s):')
     for _i, _tst_dset in enumerate(tst_dsets):
-        print(f'Data Source [{tst_sources[_i]}]')
-        print(_tst_dset)
+        main_print(f'Data Source [{tst_sources[_i]}]')
+        main_print(_tst_dset)
 
-    print('-' * 80)
-    print('#' * 80)
+    main_print('-' * 80)
+    main_print('#' * 80)
 
     # Get the dimensions of features in the most awkward way possible
     _src, _cell, _drug, _tgt, _conc = trn_dset[0]
@@ -118,8 +148,24 @@ def run_instance(
         'num_workers': 4,
         'pin_memory': True}
 
+    # The testing sets are used for scheduling and early stopping, so the
+    # quantized model is scored on a held-out part of the training set,
+    # which is split in the same way in all the processes
+    hld_loader = None
+    if quantized_inference:
+        _num_hld = int(len(trn_dset) * quantization_holdout)
+        trn_dset, hld_dset = torch.utils.data.random_split(
+            trn_dset, [len(trn_dset) - _num_hld, _num_hld],
+            generator=torch.Generator().manual_seed(0))
+        hld_loader = torch.utils.data.DataLoader(
+            hld_dset, **{**dataloader_kwargs, 'shuffle': False})
+
+    # Every process trains on its own shard of the training set
+    trn_sampler = distributed_sampler(trn_dset)
     trn_loader = torch.utils.data.DataLoader(
-        trn_dset, **dataloader_kwargs)
+        trn_dset, **{**dataloader_kwargs,
+                     'shuffle': (trn_sampler is None),
+                     'sampler': trn_sampler})
     tst_loaders = [torch.utils.data.DataLoader(
         _tst_dset, **dataloader_kwargs) for _tst_dset in tst_dsets]
 
@@ -130,96 +176,97 @@ def run_instance(
                       drug_input_dim=drug_dim,
                       drug_state_dim=4096,
                       sigmoid_output=False).to(device)
+    # Gradients are averaged over the processes with DDP all-reduce
+    ddp_model = wrap_model(model)
 
     optimizer = optimizer = torch.optim.Adam(
         model.parameters(), lr=1e-4, amsgrad=True)
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
         optimizer, factor=0.8, patience=4, min_lr=1e-6)
 
-    def train():
-        model.train()
-        _trn_loss = 0.
-
-        for _, cell, drug, trgt, dose in trn_loader:
-
-            cell, drug, trgt, dose = cell.to(device), drug.to(device), \
-                                     trgt.to(device), dose.to(device)
-            optimizer.zero_grad()
-            pred = model(cell, drug, dose)
-            loss = F.mse_loss(pred, trgt)
-            loss.backward()
-            optimizer.step()
-
-            _trn_loss += loss.item() * trgt.shape[0]
-
-        return _trn_loss / len(trn_dset)
-
-    def test():
-        model.eval()
+    # The compiled forwards share the parameters with the (DDP) model
+    model_forward = CompiledForward(model) if compile else model
+    trn_forward = model_forward if ddp_model is model else \
+        CompiledForward(ddp_model) if compile else ddp_model
+    if compile:
+        main_print(f'Compiling the model forward ({model_forward.mode} mode)')
+
+    # Batches are prefetched in the background during the training steps
+    trainer = Trainer(trn_forward, optimizer, uno_forward, F.mse_loss,
+                      device, precision=precision, pin_memory=True)
+
+    def train(epoch):
+        trn_result = trainer.train_epoch(trn_loader, epoch)
+        main_print(f'Waiting for data {trn_result["wait_fraction"]:.1%} '
+                   f'of the training time')
+        return trn_result['loss']
+
+    def test(test_model=None, test_device=None, test_precision=None,
+             test_loaders=None):
+        test_model = model_forward if test_model is None else test_model
+        test_device = device if test_device is None else test_device
+        test_loaders = tst_loaders if test_loaders is None else test_loaders
         tst_r2, tst_mae, tst_mse = [], [], []
 
-        with torch.no_grad():
-            for _tst_loader in tst_loaders:
-
-                _tst_mse = 0.
-                _tst_mae = 0.
-                trgt_array = np.zeros(shape=(1,))
-                pred_array = np.zeros(shape=(1,))
+        for _tst_loader in test_loaders:
+            _metrics = RegressionMetrics(device=test_device)
+            trainer.accumulate(
+                _tst_loader, lambda _pred, _trgt, _: _metrics.update(
+                    _pred, _trgt),
+                test_model, test_device, test_precision)
+            _result = _metrics.result()
 
-                for _, cell, drug, trgt, dose in _tst_loader:
-
-                    cell, drug, trgt, concn = \
-                        cell.to(device), drug.to(device), \
-                        trgt.to(device), dose.to(device)
-
-                    pred = model(cell, drug, concn)
-
-                    _tst_mse += F.mse_loss(pred, trgt, reduction='sum')
-                    _tst_mae += F.l1_loss(pred, trgt, reduction='sum')
-
-                    trgt_array = np.concatenate(
-                        (trgt_array, trgt.cpu().numpy().reshape(-1)))
-                    pred_array = np.concatenate(
-                        (pred_array, pred.cpu().numpy().reshape(-1)))
-
-                tst_r2.append(r2_score(y_true=trgt_array, y_pred=pred_array))
-                tst_mae.append(_tst_mae / len(_tst_loader.dataset))
-                tst_mse.append(_tst_mse / len(_tst_loader.dataset))
+            tst_r2.append(_result['r2'].item())
+            tst_mae.append(_result['mae'].item())
+            tst_mse.append(_result['mse'].item())
 
         return tst_r2, tst_mae, tst_mse
 
     best_avg_r2 = float('-inf')
     best_epoch, early_stop_counter = 0, 0
+    best_state_dict = None
     tst_history = []
 
     for epoch in range(1, 101):
 
         lr = scheduler.optimizer.param_groups[0]['lr']
-        trn_loss = train()
-        tst_r2, tst_mae, tst_mse = test()
-        tst_history.append((tst_r2, tst_mae, tst_mse))
-
-        print(f'Epoch {epoch:03d}, '
-              f'LR = {lr:6f}, Training Loss = {trn_loss:.4f}.')
-        for _i, _tst_source in enumerate(tst_sources):
-            print(f'\tTest Results on {_tst_source}: '
-                  f'R2 = {tst_r2[_i]:.4f}, '
-                  f'MAE = {tst_mae[_i]:.4f}, '
-                  f'MSE = {tst_mse[_i]:.4f}.')
+        trn_loss = train(epoch)
+
+        # Testing on the main process, which broadcasts the average R2 for
+        # the same scheduling and early stopping in all the processes
+        avg_r2 = None
+        if is_main_process():
+            tst_r2, tst_mae, tst_mse = test()
+            tst_history.append((tst_r2, tst_mae, tst_mse))
+            avg_r2 = np.mean(tst_r2)
+
+            print(f'Epoch {epoch:03d}, '
+                  f'LR = {lr:6f}, Training Loss = {trn_loss:.4f}.')
+            for _i, _tst_source in enumerate(tst_sources):
+                print(f'\tTest Results on {_tst_source}: '
+                      f'R2 = {tst_r2[_i]:.4f}, '
+                      f'MAE = {tst_mae[_i]:.4f}, '
+                      f'MSE = {tst_mse[_i]:.4f}.')
+        avg_r2 = broadcast_value(avg_r2)
 
         # Using average R2 score for learning rate adjustment and early stop
-        scheduler.step(np.mean(tst_r2))
-        if np.mean(tst_r2) > best_avg_r2:
-            print(f'Best Avg R2: {np.mean(tst_r2)}')
-            best_avg_r2 = np.mean(tst_r2)
+        scheduler.step(avg_r2)
+        if avg_r2 > best_avg_r2:
+            main_print(f'Best Avg R2: {avg_r2}')
+            best_avg_r2 = avg_r2
             early_stop_counter = 0
             best_epoch = epoch
+            if quantized_inference:
+                best_state_dict = copy.deepcopy(model.state_dict())
         else:
             early_stop_counter += 1
             if early_stop_counter >= 5:
-                print('No improvement on testing results. Stopping ... ')
+                main_print('No improvement on testing results. Stopping ... ')
                 break
-        print('-' * 80)
+        main_print('-' * 80)
+
+    if not is_main_process():
+        return
 
     print('#' * 80)
     print(f'Training Sources: {trn_sources} '
@@ -234,10 +281,137 @@ def run_instance(
               f'MAE = {best_mae[_i]:.4f}, '
               f'MSE = {best_mse[_i]:.4f}.')
 
+    if quantized_inference:
+        print('-' * 80)
+        print(f'Quantized Inference (on {len(hld_loader.dataset)} '
+              f'held-out training samples):')
+        model.load_state_dict(best_state_dict)
+
+        def __eval_func(__model):
+            __r2, __mae, _ = test(__model, torch.device('cpu'), 'fp32',
+                                  [hld_loader])
+            return __r2[0], __mae[0]
+
+        quantization_report(
+            __eval_func, model, quantize_for_inference(model))
+
     print('#' * 80)
     print('#' * 80 + '\n')
 
 
+def run_ensemble_instance(
+        trn_sources: List[str],
+        tst_sources: List[str],
+        state_dim: int,
+        subsample_on: str,
+        subsample_percentage: float,
+        device: torch.device,
+        lrs: List[float],
+        rand_state: int = 0,
+        precision: str = 'fp32',
+        compile: bool = False):
+    """
+    Train len(lrs) SimpleUno models (seeds rand_state, rand_state + 1,
+    ...) with the given learning rates together as a StackedEnsemble, with
+    learning rate decay and early stopping per member.
+    """
+
+    print('\n' + '#' * 80)
+    print(f'Training Sources: {trn_sources} (using only '
+          f'{subsample_percentage * 100: .0f}%% {subsample_on}), '
+          f'ensemble of {len(lrs)} models with learning rates {lrs}')
+
+    trn_dset, tst_dsets = \
+        get_cross_study_datasets(trn_sources=trn_sources,
+                                 tst_sources=tst_sources,
+                                 subsample_on=subsample_on,
+                                 subsample_percentage=subsample_percentage)
+
+    _src, _cell, _drug, _tgt, _conc = trn_dset[0]
+    cell_dim, drug_dim = _cell.shape[0], _drug.shape[0]
+
+    dataloader_kwargs = {
+        'shuffle': 'True',
+        'batch_size': 32,
+        'num_workers': 4,
+        'pin_memory': True}
+
+    trn_loader = torch.utils.data.DataLoader(
+        trn_dset, **dataloader_kwargs)
+    tst_loaders = [torch.utils.data.DataLoader(
+        _tst_dset, **dataloader_kwargs) for _tst_dset in tst_dsets]
+
+    models = []
+    for _i in range(len(lrs)):
+        torch.manual_seed(rand_state + _i)
+        models.append(SimpleUno(state_dim=state_dim,
+                                dose_info=True,
+                                cell_input_dim=cell_dim,
+                                cell_state_dim=1024,
+                                drug_input_dim=drug_dim,
+                                drug_state_dim=4096,
+                                sigmoid_output=False))
+    ensemble = StackedEnsemble(models).to(device)
+    del models
+
+    optimizer = EnsembleOptimizer(
+        ensemble, torch.optim.Adam, lrs=lrs, amsgrad=True)
+    scheduler = EnsembleScheduler(
+        optimizer, factor=0.8, lr_patience=4, stop_patience=5, min_lr=1e-6)
+
+    # Members are independent, so the sum of the member losses (in the
+    # trainer) gives the gradients of every member w.r.t. its own loss
+    trainer = Trainer(CompiledForward(ensemble) if compile else ensemble,
+                      optimizer, ensemble_forward, ensemble_losses, device,
+                      precision=precision, pin_memory=True)
+
+    def train():
+        return trainer.train_epoch(trn_loader)['loss']
+
+    def test():
+        tst_r2 = []
+        for _tst_loader in tst_loaders:
+            # Members as the targets of the metrics
+            _metrics = RegressionMetrics(num_targets=len(lrs), device=device)
+            trainer.accumulate(
+                _tst_loader, lambda _pred, _trgt, _: _metrics.update(
+                    _pred, _trgt.expand(-1, len(lrs))))
+            tst_r2.append(_metrics.result()['r2'].tolist())
+
+        # R2 scores of shape [num_members, num_tst_sources]
+        return np.array(tst_r2).T
+
+    best_epochs = np.zeros(len(lrs), dtype=int)
+    best_r2 = np.zeros((len(lrs), len(tst_sources)))
+
+    for epoch in range(1, 101):
+
+        trn_loss = train()
+        tst_r2 = test()
+
+        # Using average R2 score for learning rate adjustment and early stop
+        improved = scheduler.step(np.mean(tst_r2, axis=1)).numpy()
+        best_epochs[improved] = epoch
+        best_r2[improved] = tst_r2[improved]
+
+        print(f'Epoch {epoch:03d}, '
+              f'LRs = {optimizer.lrs.tolist()}, '
+              f'Training Losses = {trn_loss}, '
+              f'Avg R2 = {np.mean(tst_r2, axis=1).tolist()}.')
+
+        if not optimizer.active.any():
+            print('No improvement on testing results. Stopping ... ')
+            break
+
+    print('-' * 80)
+    for _i, _lr in enumerate(lrs):
+        print(f'Member {_i} (LR = {_lr}), Best Epoch {best_epochs[_i]}:')
+        for _j, _tst_source in enumerate(tst_sources):
+            print(f'\tTest Results on {_tst_source}: '
+                  f'R2 = {best_r2[_i, _j]:.4f}.')
+    print('#' * 80 + '\n')
+
+
 def main():
 
     parser = argparse.ArgumentParser(description='Cross Study')
@@ -258,10 +432,48 @@ def main():
                         help='CUDA device ID')
     parser.add_argument('--rand_state', type=int, default=0,
                         help='random state of numpy/sklearn/pytorch')
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=PRECISIONS,
+                        help='precision of forward passes and loss '
+                             '(bf16 autocast on CPU or GPU)')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the model with torch.compile '
+                             '(or TorchScript, or eager as fallbacks)')
+    parser.add_argument('--quantized_inference', action='store_true',
+                        help='score the dynamic int8 quantized best model '
+                             'on CPU, on a held-out part of the training '
+                             'set (excluded from training)')
+    parser.add_argument('--quantization_holdout', type=float, default=0.1,
+                        help='fraction of the training set held out for '
+                             'the quantized inference report')
+    parser.add_argument('--num_procs', type=int, default=1,
+                        help='number of local processes for data-parallel '
+                             'training on CPU (torch.distributed with gloo)')
+    parser.add_argument('--threads_per_proc', type=int, default=None,
+                        help='number of intra-op threads per process '
+                             '(number of cores / num_procs by default)')
+    parser.add_argument('--ensemble_lrs', type=float, nargs='+',
+                        default=None,
+                        help='train an ensemble of models with these '
+                             'learning rates (and different seeds) '
+                             'together with stacked parameters')
 
     args = parser.parse_args()
+    if args.ensemble_lrs is not None and args.num_procs > 1:
+        parser.error('--ensemble_lrs does not support --num_procs > 1')
+
+    threads_per_proc = args.threads_per_proc
+    if threads_per_proc is None and args.num_procs > 1:
+        threads_per_proc = default_threads_per_proc(args.num_procs)
+    launch(run, args.num_procs, (args, ), threads_per_proc)
+
+
+def run(args: argparse.Namespace):
 
-    device = torch.device(f'cuda: {args.cuda_device}')
+    # Multi-process training is on CPU only
+    device = torch.device(f'cuda: {args.cuda_device}'
+                          if get_world_size() == 1 else 'cpu')
+    # All the processes subsample the training set in the same way
     seed_random_state(args.rand_state)
 
     subsample_percentage_array = np.arange(
@@ -270,12 +482,28 @@ def main():
         stop=args.higher_percentage + .01)
 
     for subsample_percentage in subsample_percentage_array:
+        if args.ensemble_lrs is not None:
+            run_ensemble_instance(trn_sources=args.train_on,
+                                  tst_sources=args.test_on,
+                                  state_dim=args.state_dim,
+                                  subsample_on=args.subsample_on,
+                                  subsample_percentage=subsample_percentage,
+                                  device=device,
+                                  lrs=args.ensemble_lrs,
+                                  rand_state=args.rand_state,
+                                  precision=args.precision,
+                                  compile=args.compile)
+            continue
         run_instance(trn_sources=args.train_on,
                      tst_sources=args.test_on,
                      state_dim=args.state_dim,
                      subsample_on=args.subsample_on,
                      subsample_percentage=subsample_percentage,
-                     device=device)
+                     device=device,
+                     quantized_inference=args.quantized_inference,
+                     quantization_holdout=args.quantization_holdout,
+                     precision=args.precision,
+                     compile=args.compile)
 
 
 if __name__ == '__main__':
@@ -8,9 +8,10 @@
 
 """
 from comet_ml import Optimizer
+import argparse
+import multiprocessing as mp
 import torch_geometric.data as pyg_data
 import torch.nn.functional as F
-from sklearn import metrics
 
 # Constant to modify
 PROJ_LOCATION = '/vol/ml/xduan7/Projects/MoReL'
@@ -23,6 +24,50 @@ from network.gnn.gat.gat import EdgeGATEncoder
 from network.gnn.gcn.gcn import EdgeGCNEncoder
 from network.gnn.mpnn.mpnn import MPNN
 from network.simple_uno import SimpleUno
+from utils.misc.precision import PRECISIONS, keep_fp32
+from utils.misc.metrics import RegressionMetrics, BinaryMetrics
+from utils.misc.trainer import Trainer
+from utils.misc.compiling import CompiledForward
+from utils.misc.lockstep_trainer import LockstepTrainer, LockstepMember
+from utils.dataset.feature_broadcast import FeatureBroadcaster, \
+    BroadcastConsumer
+
+parser = argparse.ArgumentParser(description='Drug Response with Graph Models')
+parser.add_argument('--precision', type=str, default='fp32',
+                    choices=PRECISIONS,
+                    help='precision of forward passes and loss '
+                         '(bf16 autocast with PyG layers in fp32)')
+parser.add_argument('--compile', action='store_true',
+                    help='compile the model with torch.compile '
+                         '(or TorchScript, or eager as fallbacks)')
+parser.add_argument('--pretrained_drug_tower', type=str, default=None,
+                    help='checkpoint of the graph model from '
+                         'graph_to_dscrptr.py (--checkpoint_path)')
+parser.add_argument('--freeze_drug_tower', action='store_true',
+                    help='freeze the drug tower and look up the cached '
+                         'drug embeddings instead of running it')
+parser.add_argument('--broadcast_trials', type=int, default=1,
+                    help='number of concurrent trials (on the visible '
+                         'GPUs) that train on a single stream of training '
+                         'batches featurized once')
+parser.add_argument('--broadcast_batch_size', type=int, default=32,
+                    help='batch size of the broadcast training batches, '
+                         'which must match batch_size of the trials')
+parser.add_argument('--broadcast_epochs', type=int, default=500,
+                    help='number of epochs of the broadcast stream')
+parser.add_argument('--broadcast_workers', type=int, default=8,
+                    help='number of dataloader workers of the producer')
+parser.add_argument('--broadcast_rand_state', type=int, default=0,
+                    help='random state of the order of broadcast batches')
+parser.add_argument('--lockstep_trials', type=int, default=1,
+                    help='number of experiments trained in lockstep on '
+                         'the same dataloaders in this process')
+args = parser.parse_args()
+if (args.broadcast_trials > 1) and (args.lockstep_trials > 1):
+    parser.error('--broadcast_trials and --lockstep_trials are exclusive.')
+if args.compile and (args.lockstep_trials > 1):
+    parser.error('--lockstep_trials does not support --compile.')
+device = torch.device('cuda')
 
 comet_opt = Optimizer(project_name='Drug Response with Graph Models')
 
@@ -34,7 +79,7 @@ bigrun_drug_id_list = pd.read_csv(
     DATA_LOCATION + '/bigrun_drug_ids.csv',
     index_col=None).values.reshape((-1)).tolist()
 
-trn_dset, tst_dset, _, _ = get_datasets(
+trn_dset, tst_dset, _, drug_dict = get_datasets(
     resp_data_path=(DATA_LOCATION +
                     '/combined_single_drug_response_aggregated.csv'),
     resp_aggregated=True,
@@ -65,11 +110,19 @@ node_attr_dim = trn_dset[0].x.shape[1]
 edge_attr_dim = trn_dset[0].edge_attr.shape[1]
 cell_input_dim = trn_dset[0].cell_data.shape[0]
 
-# Iterate through all different experiment configurations
-for experiment in comet_opt.get_experiments():
 
-    # Disable auto-collection of any metrics
-    experiment.disable_mp()
+def graph_uno_forward(model, batch_data):
+    __batch_size = batch_data.num_graphs
+    cell_data = batch_data.cell_data.view(__batch_size, -1)
+    trgt = batch_data.target_data.view(__batch_size, -1)
+    return model(cell_data=cell_data, drug_data=batch_data), trgt
+
+
+def build_model(experiment):
+    """
+    SimpleUno with the graph model (drug tower) of an experiment
+    configuration, and its optimizer and scheduler.
+    """
 
     graph_model = experiment.get_parameter(name='graph_model')
     graph_state_dim = experiment.get_parameter(name='graph_state_dim')
@@ -81,15 +134,7 @@ for experiment in comet_opt.get_experiments():
 
     uno_state_dim = experiment.get_parameter(name='uno_state_dim')
     cell_state_dim = experiment.get_parameter(name='cell_state_dim')
-
-    bin_auc_num = experiment.get_parameter(name='bin_auc_num')
-
-    batch_size = experiment.get_parameter(name='batch_size')
-    num_workers = experiment.get_parameter(name='num_workers')
-    max_num_epochs = experiment.get_parameter(name='max_num_epochs')
     learning_rate = experiment.get_parameter(name='learning_rate')
-    num_logs_per_epoch = experiment.get_parameter(name='num_logs_per_epoch')
-    early_step_patience = experiment.get_parameter(name='early_step_patience')
 
     # Construct a tag for the uno with graph model
     # pooling_tag = 'attention_pooling' if graph_attention_pooling \
@@ -103,50 +148,157 @@ for experiment in comet_opt.get_experiments():
         f'graph_model={graph_model}',
         f'graph_attention_pooling={graph_attention_pooling}', ])
 
+    # Construct graph model, might run into CUDA memory error
+    graph_model_kwargs = {
+        'node_attr_dim': node_attr_dim,
+        'edge_attr_dim': edge_attr_dim,
+        'state_dim': graph_state_dim,
+        'num_conv': graph_num_conv,
+        'out_dim': graph_out_dim,
+        'attention_pooling': graph_attention_pooling, }
+
+    if graph_model == 'gcn':
+        drug_tower = EdgeGCNEncoder(**graph_model_kwargs)
+    elif graph_model == 'gat':
+        drug_tower = EdgeGATEncoder(**graph_model_kwargs)
+    else:
+        drug_tower = MPNN(**graph_model_kwargs)
+
+    if args.pretrained_drug_tower is not None:
+        drug_tower.load_state_dict(torch.load(
+            args.pretrained_drug_tower, map_location='cpu')['model'])
+    if args.freeze_drug_tower:
+        for __param in drug_tower.parameters():
+            __param.requires_grad = False
+
+    model = keep_fp32(SimpleUno(
+        state_dim=uno_state_dim,
+        dose_info=False,
+        cell_state_dim=cell_state_dim,
+        drug_state_dim=graph_out_dim,
+        cell_input_dim=cell_input_dim,
+        drug_tower=drug_tower,
+        dropout_rate=uno_dropout,
+        sigmoid_output=True)).to('cuda')
+    if args.freeze_drug_tower:
+        # One forward pass of the graph model per unique drug
+        model.cache_drug_embeddings(list(drug_dict.values()))
+    experiment.set_model_graph(str(model))
+
+    # Construct optimizer and scheduler
+    optimizer = torch.optim.Adam(
+        model.parameters(), lr=learning_rate, amsgrad=True)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+        optimizer, factor=0.5, patience=10, min_lr=(learning_rate/100.))
+
+    return model, optimizer, scheduler
+
+
+def get_metrics(experiment):
+    """
+    Streaming metrics of all the data sources in the testing set.
+    """
+    bin_auc_num = experiment.get_parameter(name='bin_auc_num')
+    return (RegressionMetrics(num_groups=len(DATA_SOURCES), device=device),
+            BinaryMetrics(bin_auc_num, num_groups=len(DATA_SOURCES),
+                          device=device))
+
+
+def update_metrics(metrics, pred, trgt, batch_data):
+    __sources = batch_data.source_data.view(
+        batch_data.num_graphs, -1).argmax(dim=1)
+    for __metrics in metrics:
+        __metrics.update(pred, trgt, groups=__sources)
+
+
+def log_metrics(experiment, metrics) -> dict:
+    """
+    Log the testing metrics of an epoch and return them.
+    """
+
+    reg_metrics, bin_metrics = metrics
+    with experiment.test():
+        # Regression metrics
+        tst_metrics = {k: v.item() for k, v in reg_metrics.result().items()
+                       if k != 'count'}
+        if not np.isfinite(tst_metrics['mse']):
+            print(f'Predicted or target array contains NaN '
+                  f'(MSE = {tst_metrics["mse"]}).')
+
+        # Binary classification metrics (responsive if AUC is below
+        # bin_auc_num), with accuracy, balanced accuracy, MCC, and
+        # TPR/TNR/FPR/FNR
+        tst_metrics.update(
+            {k: v.item() for k, v in bin_metrics.result().items()})
+
+        # R2 of every data source in the testing set
+        __source_result = reg_metrics.result(grouped=True)
+        for __source, __r2, __count in zip(
+                DATA_SOURCES,
+                __source_result['r2'].view(-1).tolist(),
+                __source_result['count'].view(-1).tolist()):
+            if __count > 0:
+                experiment.log_metric(f'r2_{__source}', __r2)
+
+        # Comet log metrics
+        for __name, __value in tst_metrics.items():
+            experiment.log_metric(__name, __value)
+
+    return tst_metrics
+
+
+def log_best_metrics(experiment, tst_metrics: dict):
+    for __name, __value in tst_metrics.items():
+        if __name != 'r2':
+            experiment.log_metric(f'best_{__name}*', __value,
+                                  include_context=False)
+
+
+def get_dataloaders(experiment, trn_loader=None):
+    """
+    Training and testing dataloaders, with the given training dataloader
+    (e.g. a feature broadcast consumer) if any.
+    """
+    dataloader_kwargs = {
+        'pin_memory': True,
+        'batch_size': experiment.get_parameter(name='batch_size'),
+        'num_workers': experiment.get_parameter(name='num_workers'), }
+    if trn_loader is None:
+        trn_loader = pyg_data.DataLoader(trn_dset, shuffle=True,
+                                         **dataloader_kwargs)
+    elif dataloader_kwargs['batch_size'] != args.broadcast_batch_size:
+        raise ValueError(f'Batch size of the experiment '
+                         f'({dataloader_kwargs["batch_size"]}) does not '
+                         f'match the broadcast batch size '
+                         f'({args.broadcast_batch_size}).')
+    tst_loader = pyg_data.DataLoader(tst_dset, **dataloader_kwargs)
+    return trn_loader, tst_loader
+
+
+def run_experiment(experiment, trn_loader=None):
+
+    # Disable auto-collection of any metrics
+    experiment.disable_mp()
+
+    max_num_epochs = experiment.get_parameter(name='max_num_epochs')
+    num_logs_per_epoch = experiment.get_parameter(name='num_logs_per_epoch')
+    early_step_patience = experiment.get_parameter(name='early_step_patience')
+    if trn_loader is not None:
+        # The broadcast stream ends after the given number of epochs
+        max_num_epochs = min(max_num_epochs, args.broadcast_epochs)
+
     # Everything in the experiment will be put inside this try statement
     # If exception happens, clean things up and move to the next experiment
     try:
         # Dataloaders
-        dataloader_kwargs = {
-            'pin_memory': True,
-            'batch_size': batch_size,
-            'num_workers': num_workers, }
-        trn_loader = pyg_data.DataLoader(trn_dset, shuffle=True,
-                                         **dataloader_kwargs)
-        tst_loader = pyg_data.DataLoader(tst_dset, **dataloader_kwargs)
-
-        # Construct graph model, might run into CUDA memory error
-        graph_model_kwargs = {
-            'node_attr_dim': node_attr_dim,
-            'edge_attr_dim': edge_attr_dim,
-            'state_dim': graph_state_dim,
-            'num_conv': graph_num_conv,
-            'out_dim': graph_out_dim,
-            'attention_pooling': graph_attention_pooling, }
-
-        if graph_model == 'gcn':
-            drug_tower = EdgeGCNEncoder(**graph_model_kwargs)
-        elif graph_model == 'gat':
-            drug_tower = EdgeGATEncoder(**graph_model_kwargs)
-        else:
-            drug_tower = MPNN(**graph_model_kwargs)
-
-        model = SimpleUno(
-            state_dim=uno_state_dim,
-            dose_info=False,
-            cell_state_dim=cell_state_dim,
-            drug_state_dim=graph_out_dim,
-            cell_input_dim=cell_input_dim,
-            drug_tower=drug_tower,
-            dropout_rate=uno_dropout,
-            sigmoid_output=True).to('cuda')
-        experiment.set_model_graph(str(model))
-
-        # Construct optimizer and scheduler
-        optimizer = torch.optim.Adam(
-            model.parameters(), lr=learning_rate, amsgrad=True)
-        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
-            optimizer, factor=0.5, patience=10, min_lr=(learning_rate/100.))
+        trn_loader, tst_loader = get_dataloaders(experiment, trn_loader)
+        model, optimizer, scheduler = build_model(experiment)
+
+        # Batches are prefetched in the background during the training
+        # steps (and the gradients are zeroed before every step)
+        trainer = Trainer(CompiledForward(model) if args.compile else model,
+                          optimizer, graph_uno_forward, F.mse_loss, device,
+                          precision=args.precision, pin_memory=True)
 
         # Iterate through epochs
         best_r2 = float('-inf')
@@ -156,144 +308,46 @@ for experiment in comet_opt.get_experiments():
 
         for epoch in range(max_num_epochs):
             with experiment.train():
-                model.train()
-                __trn_loss, __batch_counter, __sample_counter = 0., 0, 0
-
-                for batch_data in trn_loader:
-
-                    __batch_size = batch_data.num_graphs
-                    batch_data = batch_data.to('cuda')
-                    cell_data = batch_data.cell_data.view(__batch_size, -1)
-                    trgt = batch_data.target_data.view(__batch_size, -1)
+                __trn_log = {'loss': 0., 'num_samples': 0}
 
-                    pred = model(cell_data=cell_data, drug_data=batch_data)
-                    loss = F.mse_loss(pred, trgt)
-                    loss.backward()
-                    optimizer.step()
-
-                    __trn_loss += loss.item() * __batch_size
-                    __batch_counter += 1
-                    __sample_counter += __batch_size
+                def __log_step(__step, __loss, __batch_size):
+                    __trn_log['loss'] += __loss.item() * __batch_size
+                    __trn_log['num_samples'] += __batch_size
+                    __batch_counter = __step + 1
 
                     if ((__batch_counter % num_batches_per_log) == 0) or \
                        (__batch_counter == len(trn_loader)):
 
-                        __avg_trn_loss = (__trn_loss / __sample_counter)
+                        __avg_trn_loss = \
+                            __trn_log['loss'] / __trn_log['num_samples']
                         # __step = epoch + (__batch_counter / len(trn_loader))
                         # __step = int(__step * num_logs_per_epoch)
 
                         experiment.log_metric(name='loss',
                                               value=__avg_trn_loss)
-                        __trn_loss, __sample_counter = 0., 0
-
-            with experiment.test():
-                model.eval()
-                trgt_array = np.zeros(shape=(1, ))
-                pred_array = np.zeros(shape=(1, ))
-
-                with torch.no_grad():
-                    for batch_data in tst_loader:
-
-                        __batch_size = batch_data.num_graphs
-                        batch_data = batch_data.to('cuda')
-                        cell_data = batch_data.cell_data.view(__batch_size, -1)
-                        trgt = batch_data.target_data.view(__batch_size, -1)
-
-                        pred = model(cell_data=cell_data,
-                                     drug_data=batch_data)
-
-                        trgt_array = np.concatenate(
-                            (trgt_array, trgt.cpu().numpy().reshape(-1)))
-                        pred_array = np.concatenate(
-                            (pred_array, pred.cpu().numpy().reshape(-1)))
-
-                    # Compute and log all the metrics
-                    # Regression metrics
-                    reg_kwargs = {'y_true': trgt_array,
-                                  'y_pred': pred_array}
-
-                    nan_indices = np.isnan(trgt_array)
-                    if any(nan_indices):
-                        print(f'Target array contains NaN: '
-                              f'{trgt_array[nan_indices]}:'
-                              f'{pred_array[nan_indices]}')
-                    nan_indices = np.isnan(pred_array)
-                    if any(nan_indices):
-                        print(f'Predicted array contains NaN: '
-                              f'{trgt_array[nan_indices]}:'
-                              f'{pred_array[nan_indices]}')
-
-                    tst_r2 = metrics.r2_score(**reg_kwargs)
-                    tst_mae = metrics.mean_absolute_error(**reg_kwargs)
-                    tst_mse = metrics.mean_squared_error(**reg_kwargs)
-
-                    # Binary classification metrics
-                    bin_trgt_array = \
-                        (~np.digitize(trgt_array, [bin_auc_num]).
-                         astype(np.bool)).astype(np.int)
-                    bin_pred_array = \
-                        (~np.digitize(pred_array, [bin_auc_num]).
-                         astype(np.bool)).astype(np.int)
-
-                    bin_kwargs = {'y_true': bin_trgt_array,
-                                  'y_pred': bin_pred_array}
-
-                    tst_acc = metrics.accuracy_score(**bin_kwargs)
-                    tst_bal_acc = metrics.balanced_accuracy_score(**bin_kwargs)
-                    tst_mcc = metrics.matthews_corrcoef(**bin_kwargs)
-                    # tst_auc = metrics.roc_auc_score(**bin_kwargs)
-
-                    __tn, __fp, __fn, __tp = \
-                        metrics.confusion_matrix(**bin_kwargs).ravel()
-
-                    tst_tpr = 1. if (__tp + __fn) == 0 \
-                        else (__tp / (__tp + __fn))
-                    tst_tnr = 1. if (__tn + __fp) == 0 \
-                        else (__tn / (__tn + __fp))
-                    tst_fpr, tst_fnr = (1 - tst_tnr), (1 - tst_tpr)
-
-                    # Comet log metrics
-                    experiment.log_metric('r2', tst_r2)
-                    experiment.log_metric('mae', tst_mae)
-                    experiment.log_metric('mse', tst_mse)
-
-                    experiment.log_metric('acc', tst_acc)
-                    experiment.log_metric('bal_acc', tst_bal_acc)
-                    experiment.log_metric('mcc', tst_mcc)
-                    # experiment.log_metric('auc', tst_auc)
-
-                    experiment.log_metric('tpr', tst_tpr)
-                    experiment.log_metric('tnr', tst_tnr)
-                    experiment.log_metric('fpr', tst_fpr)
-                    experiment.log_metric('fnr', tst_fnr)
+                        __trn_log['loss'], __trn_log['num_samples'] = 0., 0
+
+                __trn_result = trainer.train_epoch(
+                    trn_loader, step_callback=__log_step)
+                experiment.log_metric(name='data_wait_fraction',
+                                      value=__trn_result['wait_fraction'])
+                experiment.log_metric(
+                    name='samples_per_second',
+                    value=__trn_result['num_samples'] /
+                    __trn_result['seconds'])
+
+            metrics = get_metrics(experiment)
+            trainer.accumulate(
+                tst_loader, lambda __pred, __trgt, __batch: update_metrics(
+                    metrics, __pred, __trgt, __batch))
+            tst_metrics = log_metrics(experiment, metrics)
 
             experiment.log_epoch_end(epoch)
 
-            scheduler.step(tst_mse)
-            if tst_r2 > best_r2:
-                best_r2 = tst_r2
-
-                experiment.log_metric('best_mae*', tst_mae,
-                                      include_context=False)
-                experiment.log_metric('best_mse*', tst_mse,
-                                      include_context=False)
-
-                experiment.log_metric('best_acc*', tst_acc,
-                                      include_context=False)
-                experiment.log_metric('best_bal_acc*', tst_bal_acc,
-                                      include_context=False)
-                experiment.log_metric('best_mcc*', tst_mcc,
-                                      include_context=False)
-
-                experiment.log_metric('best_tpr*', tst_tpr,
-                                      include_context=False)
-                experiment.log_metric('best_tnr*', tst_tnr,
-                                      include_context=False)
-                experiment.log_metric('best_fpr*', tst_fpr,
-                                      include_context=False)
-                experiment.log_metric('best_fnr*', tst_fnr,
-                                      include_context=False)
-
+            scheduler.step(tst_metrics['mse'])
+            if tst_metrics['r2'] > best_r2:
+                best_r2 = tst_metrics['r2']
+                log_best_metrics(experiment, tst_metrics)
                 early_stop_counter = 0
             else:
                 early_stop_counter += 1
@@ -317,7 +371,153 @@ for experiment in comet_opt.get_experiments():
             pass
 
         torch.cuda.empty_cache()
-        experiment.end()
-        continue
 
     experiment.end()
+
+
+def run_lockstep_experiments(experiments: list):
+    """
+    Train the models of several experiments in lockstep on the same
+    dataloaders, with every training batch featurized and moved to the
+    device once for all the models.
+    """
+
+    experiment_dict = {e.id: e for e in experiments}
+    for experiment in experiments:
+        experiment.disable_mp()
+
+    max_num_epochs = experiments[0].get_parameter(name='max_num_epochs')
+    early_step_patience = \
+        experiments[0].get_parameter(name='early_step_patience')
+
+    try:
+        # The experiments share the (fixed) dataloader parameters
+        for __name in ['batch_size', 'num_workers', 'max_num_epochs']:
+            if len(set(e.get_parameter(name=__name)
+                       for e in experiments)) > 1:
+                raise ValueError(f'Lockstep experiments must share the '
+                                 f'same {__name}.')
+        trn_loader, tst_loader = get_dataloaders(experiments[0])
+
+        members, schedulers = [], {}
+        for experiment in experiments:
+            __model, __optimizer, schedulers[experiment.id] = \
+                build_model(experiment)
+            # Scheduled on MSE below, while early stopped on R2
+            members.append(LockstepMember(
+                __model, __optimizer, name=experiment.id,
+                early_stop_patience=early_step_patience))
+        trainer = LockstepTrainer(members, graph_uno_forward, F.mse_loss,
+                                  device, precision=args.precision)
+
+        for epoch in range(max_num_epochs):
+            active_members = trainer.active_members
+            if len(active_members) == 0:
+                break
+
+            trn_losses = trainer.train_epoch(trn_loader)
+
+            metrics = {m.name: get_metrics(experiment_dict[m.name])
+                       for m in active_members}
+
+            def __update_func(__name):
+                return lambda __pred, __trgt, __batch: update_metrics(
+                    metrics[__name], __pred, __trgt, __batch)
+
+            trainer.accumulate(tst_loader,
+                               {n: __update_func(n) for n in metrics})
+
+            tst_metrics = {}
+            for __member in active_members:
+                experiment = experiment_dict[__member.name]
+                with experiment.train():
+                    experiment.log_metric(name='loss',
+                                          value=trn_losses[__member.name])
+                    # Aggregate throughput of all the lockstep models
+                    experiment.log_metric(name='samples_per_second',
+                                          value=trainer.samples_per_second)
+                tst_metrics[__member.name] = \
+                    log_metrics(experiment, metrics[__member.name])
+                experiment.log_epoch_end(epoch)
+                schedulers[__member.name].step(
+                    tst_metrics[__member.name]['mse'])
+
+            for __member in trainer.step(
+                    {n: m['r2'] for n, m in tst_metrics.items()}, epoch):
+                log_best_metrics(experiment_dict[__member.name],
+                                 tst_metrics[__member.name])
+
+        for __member in trainer.members:
+            experiment_dict[__member.name].log_metric(
+                'best_r2', __member.best_metric, include_context=False)
+
+    except Exception as e:
+
+        print('Cannot finish the current lockstep experiments.')
+        print(f'Error message: {e}')
+
+        for experiment in experiments:
+            experiment.log_other('error_msg', str(e))
+            experiment.log_metric('best_r2', 0., include_context=False)
+
+        # Clear all the existing models if they exist
+        try:
+            del members, trainer, trn_loader, tst_loader
+        except NameError:
+            pass
+
+        torch.cuda.empty_cache()
+
+    for experiment in experiments:
+        experiment.end()
+
+
+def run_broadcast_trial(trial_id: int, consumer: BroadcastConsumer):
+    """
+    A single experiment (on one of the visible GPUs) that trains on the
+    training batches from the feature broadcaster.
+    """
+    torch.cuda.set_device(trial_id % torch.cuda.device_count())
+    try:
+        for experiment in comet_opt.get_experiments():
+            run_experiment(experiment, trn_loader=consumer)
+            break
+    finally:
+        # So that the producer no longer waits for this trial
+        consumer.close()
+
+
+if args.broadcast_trials > 1:
+    # The training batches are featurized and collated once (in a seeded
+    # order) for all the concurrent trials, which must share the batch
+    # size (fixed in graph_drug_response.config)
+    with FeatureBroadcaster(trn_dset,
+                            num_consumers=args.broadcast_trials,
+                            batch_size=args.broadcast_batch_size,
+                            collate_fn=pyg_data.Batch.from_data_list,
+                            num_epochs=args.broadcast_epochs,
+                            num_workers=args.broadcast_workers,
+                            rand_state=args.broadcast_rand_state,
+                            mp_context='fork') as broadcaster:
+        __ctx = mp.get_context('fork')
+        __trials = [__ctx.Process(target=run_broadcast_trial,
+                                  args=(__i, broadcaster.get_consumer(__i)))
+                    for __i in range(args.broadcast_trials)]
+        for __trial in __trials:
+            __trial.start()
+        for __trial in __trials:
+            __trial.join()
+elif args.lockstep_trials > 1:
+    # Groups of experiment configurations trained in lockstep
+    lockstep_experiments = []
+    for experiment in comet_opt.get_experiments():
+        lockstep_experiments.append(experiment)
+        if len(lockstep_experiments) == args.lockstep_trials:
+            run_lockstep_experiments(lockstep_experiments)
+            lockstep_experiments = []
+    if lockstep_experiments:
+        run_lockstep_experiments(lockstep_experiments)
+else:
+    # Iterate through all different experiment configurations
+    for experiment in comet_opt.get_experiments():
+        run_experiment(experiment)
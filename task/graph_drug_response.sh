@@ -5,3 +5,8 @@ CUDA_VISIBLE_DEVICES=4 python graph_drug_response.py &
 CUDA_VISIBLE_DEVICES=5 python graph_drug_response.py &
 CUDA_VISIBLE_DEVICES=6 python graph_drug_response.py &
 CUDA_VISIBLE_DEVICES=7 python graph_drug_response.py &
+
+# Alternatively, featurize the training batches once for 6 concurrent trials
+# (one experiment per GPU), which share a stream of batches in shared memory
+# CUDA_VISIBLE_DEVICES=2,3,4,5,6,7 python graph_drug_response.py \
+#     --broadcast_trials 6 --broadcast_batch_size 32 --broadcast_epochs 500
@@ -20,15 +20,19 @@
         https://github.com/rusty1s/pytorch_geometric/issues/147
         https://github.com/rusty1s/pytorch_geometric/issues/175
 """
+import copy
 import json
+import time
 import torch
 import argparse
 import numpy as np
 import pandas as pd
+import torch.nn as nn
 import torch.nn.functional as F
+from rdkit import Chem
 import torch_geometric.data as pyg_data
-from sklearn.metrics import r2_score
 from sklearn.model_selection import train_test_split
+from typing import Optional
 
 import sys
 sys.path.extend(['/home/xduan7/Projects/MoReL'])
@@ -40,7 +44,195 @@ from network.gnn.gcn.gcn import EdgeGCNEncoder
 from network.gnn.mpnn.mpnn import MPNN
 from utils.misc.random_seeding import seed_random_state
 from utils.misc.parameter_counting import count_parameters
-from utils.dataset.graph_to_dscrptr_dataset import GraphToDscrptrDataset
+from utils.misc.quantization import \
+    quantize_for_inference, quantization_report
+from utils.misc.precision import PRECISIONS, autocast, keep_fp32
+from utils.misc.compiling import CompiledForward
+from utils.misc.metrics import RegressionMetrics
+from utils.misc.trainer import Trainer
+from utils.misc.lockstep_trainer import LockstepTrainer, LockstepMember
+from utils.misc.distributed import launch, default_threads_per_proc, \
+    get_world_size, is_main_process, main_print, wrap_model, \
+    distributed_sampler, broadcast_value, save_checkpoint
+from utils.dataset.graph_to_dscrptr_dataset import \
+    GraphToDscrptrDataset, load_cid_smiles_dict, load_cid_dscrptr_dict
+from utils.dataset.cached_loader import CachedLoader
+from utils.dataset.featurizers import mol_to_graph
+from utils.dataset.embedding_store import EMBEDDING_DTYPES, \
+    EmbeddingStoreWriter
+
+
+def build_model(model_type: str,
+                node_attr_dim: int,
+                edge_attr_dim: int,
+                state_dim: int,
+                num_conv: int,
+                out_dim: int,
+                pooling: str) -> nn.Module:
+
+    model_kwargs = {
+        'node_attr_dim': node_attr_dim,
+        'edge_attr_dim': edge_attr_dim,
+        'state_dim': state_dim,
+        'num_conv': num_conv,
+        'out_dim': out_dim,
+        'attention_pooling': (pooling == 'attention'), }
+
+    if model_type.upper() == 'GCN':
+        return EdgeGCNEncoder(**model_kwargs)
+    elif model_type.upper() == 'GAT':
+        return EdgeGATEncoder(**model_kwargs)
+    else:
+        return MPNN(**model_kwargs)
+
+
+def export_embeddings(model: nn.Module,
+                      id_smiles_dict: dict,
+                      store_dir: str,
+                      device: torch.device,
+                      batch_size: int = 1024,
+                      dtype: str = 'float32',
+                      precision: str = 'fp32',
+                      featurizer_kwargs: Optional[dict] = None) -> int:
+    """
+    Write the graph embeddings (model.embed, the output of the pooling
+    layer) of molecules into an embedding store, in large inference
+    batches. Molecules that cannot be featurized are skipped.
+
+    :param featurizer_kwargs: keyword arguments of mol_to_graph, which
+        must be the same as in training (featurizer_kwargs of the
+        training dataset), and the defaults of mol_to_graph if not given
+
+    :return: number of molecules in the store
+    """
+
+    model.eval()
+    with EmbeddingStoreWriter(store_dir, len(id_smiles_dict), dtype) \
+            as writer:
+
+        id_list, graph_list = [], []
+
+        def __write_batch():
+            __batch = pyg_data.Batch.from_data_list(graph_list).to(device)
+            with torch.no_grad(), autocast(precision, device):
+                __embeddings = model.embed(__batch).float()
+            writer.write(id_list, __embeddings.cpu().numpy())
+            id_list.clear()
+            graph_list.clear()
+
+        for __id, __smiles in id_smiles_dict.items():
+            __mol = Chem.MolFromSmiles(__smiles)
+            __graph = None if __mol is None else \
+                mol_to_graph(mol=__mol, **(featurizer_kwargs or {}))
+            if __graph is None:
+                continue
+
+            id_list.append(__id)
+            graph_list.append(__graph)
+            if len(graph_list) == batch_size:
+                __write_batch()
+        if graph_list:
+            __write_batch()
+
+        return writer.num_records
+
+
+def run_lockstep(args: argparse.Namespace,
+                 trn_loader,
+                 val_loader,
+                 tst_loader,
+                 node_attr_dim: int,
+                 edge_attr_dim: int,
+                 target_list: list,
+                 dscrptr_mean: np.array,
+                 dscrptr_std: np.array,
+                 device: torch.device):
+    """
+    Train the model configurations in args.lockstep_configs together,
+    with every batch of the training dataloader featurized once.
+    """
+
+    lockstep_keys = ['model_type', 'pooling', 'state_dim', 'num_conv',
+                     'init_lr']
+    members = []
+    for __config in args.lockstep_configs:
+        if not set(__config.keys()).issubset(lockstep_keys):
+            raise ValueError(f'Lockstep configuration {__config} has keys '
+                             f'other than {lockstep_keys}.')
+        __kwargs = {**{k: getattr(args, k) for k in lockstep_keys},
+                    **__config}
+
+        __model = keep_fp32(build_model(
+            __kwargs['model_type'],
+            node_attr_dim=node_attr_dim,
+            edge_attr_dim=edge_attr_dim,
+            state_dim=__kwargs['state_dim'],
+            num_conv=__kwargs['num_conv'],
+            out_dim=len(target_list),
+            pooling=__kwargs['pooling']))
+        __optimizer = torch.optim.RMSprop(
+            __model.parameters(), lr=__kwargs['init_lr'])
+        __scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+            __optimizer, factor=args.lr_decay_factor,
+            patience=args.lr_decay_patience, min_lr=1e-6)
+        members.append(LockstepMember(__model, __optimizer, __scheduler,
+                                      name=json.dumps(__config)))
+
+    def forward(m, data):
+        return m(data), data.y.view(-1, len(target_list))
+
+    trainer = LockstepTrainer(members, forward, F.mse_loss, device,
+                              precision=args.precision)
+
+    def test(loader) -> dict:
+        # Average R2 and MAE of the denormalized descriptors per member
+        __mean = torch.as_tensor(dscrptr_mean, dtype=torch.float32,
+                                 device=device)
+        __std = torch.as_tensor(dscrptr_std, dtype=torch.float32,
+                                device=device)
+        __metrics = {m.name: RegressionMetrics(num_targets=len(target_list),
+                                               device=device)
+                     for m in trainer.active_members}
+
+        def __update_func(__name):
+            return lambda __pred, __trgt, _: __metrics[__name].update(
+                __pred * __std + __mean, __trgt * __std + __mean)
+
+        trainer.accumulate(loader, {n: __update_func(n) for n in __metrics})
+        __results = {n: m.result() for n, m in __metrics.items()}
+        return {n: (r['r2'].mean().item(), r['mae'].mean().item())
+                for n, r in __results.items()}
+
+    tst_results = {}
+    for epoch in range(1, args.max_num_epochs + 1):
+        if len(trainer.active_members) == 0:
+            break
+
+        trn_losses = trainer.train_epoch(trn_loader)
+        val_results = test(val_loader)
+        improved_members = trainer.step(
+            {n: r[0] for n, r in val_results.items()}, epoch)
+        if improved_members:
+            __tst_results = test(tst_loader)
+            tst_results.update({m.name: __tst_results[m.name]
+                                for m in improved_members})
+
+        print(f'Epoch: {epoch:03d}, Training Throughput: '
+              f'{trainer.samples_per_second:.1f} samples/s '
+              f'({len(trn_losses)} models in lockstep)')
+        for __name, __loss in trn_losses.items():
+            print(f'\tModel: {__name}, Loss: {__loss:.4f}, '
+                  f'Validation R2: {val_results[__name][0]:.4f} '
+                  f'MAE: {val_results[__name][1]:.4f}; '
+                  f'Testing R2: {tst_results[__name][0]:.4f} '
+                  f'MAE: {tst_results[__name][1]:.4f}')
+
+    print('Best Results ' + '#' * 80)
+    for __member in trainer.members:
+        print(f'Model: {__member.name}, Best Epoch: {__member.best_epoch}, '
+              f'Validation R2: {__member.best_metric:.4f}, '
+              f'Testing R2: {tst_results[__member.name][0]:.4f} '
+              f'MAE: {tst_results[__member.name][1]:.4f}')
 
 
 def main():
@@ -80,35 +272,87 @@ def main():
                         help='CUDA device ID')
     parser.add_argument('--rand_state', type=int, default=0,
                         help='random state of numpy/sklearn/pytorch')
+    parser.add_argument('--precision', type=str, default='fp32',
+                        choices=PRECISIONS,
+                        help='precision of forward passes and loss '
+                             '(bf16 autocast on CPU or GPU)')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the model with torch.compile '
+                             '(or TorchScript, or eager as fallbacks)')
+    parser.add_argument('--quantized_inference', action='store_true',
+                        help='score the testing set with the dynamic int8 '
+                             'quantized best model on CPU')
+    parser.add_argument('--num_procs', type=int, default=1,
+                        help='number of local processes for data-parallel '
+                             'training on CPU (torch.distributed with gloo)')
+    parser.add_argument('--threads_per_proc', type=int, default=None,
+                        help='number of intra-op threads per process '
+                             '(number of cores / num_procs by default)')
+    parser.add_argument('--checkpoint_path', type=str, default=None,
+                        help='path to save the best model checkpoint')
+
+    parser.add_argument('--embedding_store_dir', type=str, default=None,
+                        help='write the graph embeddings of the best model '
+                             'into an embedding store after training')
+    parser.add_argument('--embedding_smiles_csv', type=str, default=None,
+                        help='CSV of (ID, SMILES) of the molecules to embed '
+                             '(e.g. drugs); all the CIDs by default')
+    parser.add_argument('--embedding_dtype', type=str, default='float32',
+                        choices=EMBEDDING_DTYPES)
+    parser.add_argument('--embedding_batch_size', type=int, default=1024)
+
+    parser.add_argument('--eval_cache_mb', type=float, default=1024.,
+                        help='memory budget (in MB) of the collated '
+                             'validation and testing batches cached '
+                             'across epochs (no caching if 0)')
+    parser.add_argument('--eval_cache_dir', type=str, default=None,
+                        help='directory of the spill files for the cached '
+                             'batches beyond the memory budget')
+
+    parser.add_argument('--lockstep_configs', type=json.loads, default=None,
+                        help='JSON list of model configurations (e.g. '
+                             '\'[{"state_dim": 128}, {"init_lr": 1e-4}]\','
+                             ' which override model_type, pooling, '
+                             'state_dim, num_conv and init_lr) trained in '
+                             'lockstep on a single training dataloader')
 
     args = parser.parse_args()
     print('Training Arguments:\n' + json.dumps(vars(args), indent=4))
+    if (args.lockstep_configs is not None) and \
+            (args.num_procs > 1 or args.compile or args.quantized_inference
+             or args.checkpoint_path or args.embedding_store_dir):
+        raise ValueError('Lockstep training only supports a single process '
+                         'without compiling, quantized inference, '
+                         'checkpoints or embedding export.')
+
+    threads_per_proc = args.threads_per_proc
+    if threads_per_proc is None and args.num_procs > 1:
+        threads_per_proc = default_threads_per_proc(args.num_procs)
+    launch(run, args.num_procs, (args, ), threads_per_proc)
+
+
+def run(args: argparse.Namespace):
 
     # Constants and initializations ###########################################
-    use_cuda = torch.cuda.is_available() and (not args.no_cuda)
+    # Multi-process training is on CPU only
+    use_cuda = torch.cuda.is_available() and (not args.no_cuda) and \
+        (get_world_size() == 1)
     device = torch.device(f'cuda: {args.cuda_device}' if use_cuda else 'cpu')
-    print(f'Training on device {device}')
+    main_print(f'Training on device {device}')
 
     # It seems that NVidia Apex is not compatible with PyG
     # amp_handle = amp.init(enabled=False)
+    # Use --precision bf16 instead (autocast with PyG layers in fp32)
 
     seed_random_state(args.rand_state)
 
     target_list = c.TARGET_D7_DSCRPTR_NAMES[: args.num_dscrptr]
 
     # Get the trn/val/tst dataset and dataloaders #############################
-    print('Preparing CID-SMILES dictionary ... ')
-    cid_smiles_csv_path = c.PCBA_CID_SMILES_CSV_PATH
-    cid_smiles_df = pd.read_csv(cid_smiles_csv_path,
-                                sep='\t',
-                                header=0,
-                                index_col=0,
-                                dtype=str)
-    cid_smiles_df.index = cid_smiles_df.index.map(str)
-    cid_smiles_dict = cid_smiles_df.to_dict()['SMILES']
-    del cid_smiles_df
-
-    print('Preparing CID-dscrptr dictionary ... ')
+    main_print('Preparing CID-SMILES dictionary ... ')
+    cid_smiles_dict = load_cid_smiles_dict(pcba_only=True)
+
+    main_print('Preparing CID-dscrptr dictionary ... ')
     # cid_dscrptr_dict has a structure of dict[target_name][str(cid)]
 
     # cid_dscrptr_df = pd.read_csv(c.PCBA_CID_TARGET_D7DSCPTR_CSV_PATH,
@@ -128,31 +372,11 @@ def main():
     # cid_dscrptr_dict = cid_dscrptr_df.to_dict()
     # del cid_dscrptr_df
 
-    cid_list = []
-    dscrptr_array = np.array([], dtype=np.float32).reshape(0, len(target_list))
-    for chunk_cid_dscrptr_df in pd.read_csv(
-            c.PCBA_CID_TARGET_D7DSCPTR_CSV_PATH,
-            sep='\t',
-            header=0,
-            index_col=0,
-            usecols=['CID'] + target_list,
-            dtype={**{'CID': str}, **{t: np.float32 for t in target_list}},
-            chunksize=2 ** 16):
-
-        chunk_cid_dscrptr_df.index = chunk_cid_dscrptr_df.index.map(str)
-        cid_list.extend(list(chunk_cid_dscrptr_df.index))
-        dscrptr_array = np.vstack((dscrptr_array, chunk_cid_dscrptr_df.values))
-
-    # Perform STD normalization for multi-target regression
-    dscrptr_mean = np.mean(dscrptr_array, axis=0)
-    dscrptr_std = np.std(dscrptr_array, axis=0)
-    dscrptr_array = (dscrptr_array - dscrptr_mean) / dscrptr_std
-
-    assert len(cid_list) == len(dscrptr_array)
-    cid_dscrptr_dict = {cid: dscrptr
-                        for cid, dscrptr in zip(cid_list, dscrptr_array)}
-
-    print('Preparing datasets and dataloaders ... ')
+    # STD normalized descriptors, with the mean and STD for the metrics
+    cid_dscrptr_dict, dscrptr_mean, dscrptr_std = \
+        load_cid_dscrptr_dict(target_list)
+
+    main_print('Preparing datasets and dataloaders ... ')
     # List of CIDs for training, validation, and testing
     # Make sure that all entries in the CID list is valid
     smiles_cid_set = set(list(cid_smiles_dict.keys()))
@@ -190,41 +414,51 @@ def main():
         'timeout': 1,
         'pin_memory': True if use_cuda else False,
         'num_workers': 4 if use_cuda else 0}
+    # Every process trains on its own shard of the training set
+    trn_sampler = distributed_sampler(trn_dataset, seed=args.rand_state)
     trn_loader = pyg_data.DataLoader(trn_dataset,
-                                     shuffle=True,
+                                     shuffle=(trn_sampler is None),
+                                     sampler=trn_sampler,
                                      **dataloader_kwargs)
     val_loader = pyg_data.DataLoader(val_dataset,
                                      **dataloader_kwargs)
     tst_loader = pyg_data.DataLoader(tst_dataset,
                                      **dataloader_kwargs)
+    # Validation and testing sets never change, so the molecules are
+    # featurized and collated only in the first pass
+    if args.eval_cache_mb > 0:
+        val_loader = CachedLoader(val_loader, args.eval_cache_mb / 2,
+                                  args.eval_cache_dir)
+        tst_loader = CachedLoader(tst_loader, args.eval_cache_mb / 2,
+                                  args.eval_cache_dir)
 
     # Model, optimizer, and scheduler #########################################
-    attention_pooling = (args.pooling == 'attention')
-
-    if args.model_type.upper() == 'GCN':
-        model = EdgeGCNEncoder(node_attr_dim=trn_dataset.node_attr_dim,
-                               edge_attr_dim=trn_dataset.edge_attr_dim,
-                               state_dim=args.state_dim,
-                               num_conv=args.num_conv,
-                               out_dim=len(target_list),
-                               attention_pooling=attention_pooling).to(device)
-    elif args.model_type.upper() == 'GAT':
-        model = EdgeGATEncoder(node_attr_dim=trn_dataset.node_attr_dim,
-                               edge_attr_dim=trn_dataset.edge_attr_dim,
-                               state_dim=args.state_dim,
-                               num_conv=args.num_conv,
-                               out_dim=len(target_list),
-                               attention_pooling=attention_pooling).to(device)
-    else:
-        model = MPNN(node_attr_dim=trn_dataset.node_attr_dim,
-                     edge_attr_dim=trn_dataset.edge_attr_dim,
-                     state_dim=args.state_dim,
-                     num_conv=args.num_conv,
-                     out_dim=len(target_list),
-                     attention_pooling=attention_pooling).to(device)
-
+    if args.lockstep_configs is not None:
+        run_lockstep(args, trn_loader, val_loader, tst_loader,
+                     trn_dataset.node_attr_dim, trn_dataset.edge_attr_dim,
+                     target_list, dscrptr_mean, dscrptr_std, device)
+        return
+
+    model = build_model(args.model_type,
+                        node_attr_dim=trn_dataset.node_attr_dim,
+                        edge_attr_dim=trn_dataset.edge_attr_dim,
+                        state_dim=args.state_dim,
+                        num_conv=args.num_conv,
+                        out_dim=len(target_list),
+                        pooling=args.pooling).to(device)
+
+    model = keep_fp32(model)
     num_params = count_parameters(model)
-    print(f'Model Summary (Number of Parameters: {num_params})\n{model}')
+    main_print(f'Model Summary (Number of Parameters: {num_params})\n{model}')
+
+    # Gradients are averaged over the processes with DDP all-reduce, while
+    # the evaluation is on the main process with the model itself
+    ddp_model = wrap_model(model)
+    model_forward = CompiledForward(model) if args.compile else model
+    trn_forward = model_forward if ddp_model is model else \
+        CompiledForward(ddp_model) if args.compile else ddp_model
+    if args.compile:
+        main_print(f'Compiling the model forward ({model_forward.mode} mode)')
 
     # optimizer = torch.optim.Adam(
     #     model.parameters(), lr=args.init_lr, amsgrad=True)
@@ -234,51 +468,38 @@ def main():
         optimizer, factor=args.lr_decay_factor,
         patience=args.lr_decay_patience, min_lr=1e-6)
 
-    def train(loader):
-        model.train()
-        loss_all = 0
-
-        for data in loader:
-            data = data.to(device)
-            optimizer.zero_grad()
-            loss = F.mse_loss(model(data), data.y.view(-1, len(target_list)))
-            # with amp_handle.scale_loss(loss, optimizer) as scaled_loss:
-            #     scaled_loss.backward()
-            loss.backward()
-            loss_all += loss.item() * data.num_graphs
-            optimizer.step()
-        return loss_all / len(trn_loader.dataset)
-
-    def test(loader):
-        model.eval()
-        mae_array = np.zeros(shape=(len(target_list)))
-        trgt_array = np.zeros(shape=(0, len(target_list)))
-        pred_array = np.zeros(shape=(0, len(target_list)))
-
-        for data in loader:
-
-            data = data.to(device)
-            pred = model(data)
-
-            trgt = data.y.cpu().numpy().reshape(-1, len(target_list))
-            pred = pred.detach().cpu().numpy().reshape(-1, len(target_list))
-
-            trgt = trgt * dscrptr_std + dscrptr_mean
-            pred = pred * dscrptr_std + dscrptr_mean
-
-            trgt_array = np.vstack((trgt_array, trgt))
-            pred_array = np.vstack((pred_array, pred))
-            mae_array += np.sum(np.abs(trgt - pred), axis=0)
-
-        mae_array = mae_array / len(loader.dataset)
-
-        # # Save the results
-        #     np.save(c.PROCESSED_DATA_DIR + '/pred_array.npy', pred_array)
-        #     np.save(c.PROCESSED_DATA_DIR + '/trgt_array.npy', trgt_array)
-
-        r2_array = np.array(
-            [r2_score(y_pred=pred_array[:, i], y_true=trgt_array[:, i])
-             for i, t in enumerate(target_list)])
+    def forward(m, data):
+        return m(data), data.y.view(-1, len(target_list))
+
+    # Batches are prefetched in the background during the training steps
+    trainer = Trainer(trn_forward, optimizer, forward, F.mse_loss, device,
+                      precision=args.precision, pin_memory=use_cuda)
+
+    def train(loader, epoch):
+        trn_result = trainer.train_epoch(loader, epoch)
+        main_print(f'Waiting for data {trn_result["wait_fraction"]:.1%} '
+                   f'of the training time, training throughput: '
+                   f'{trn_result["num_samples"] / trn_result["seconds"]:.1f}'
+                   f' samples/s')
+        return trn_result['loss']
+
+    def test(loader, test_model=model_forward, test_device=device,
+             test_precision=args.precision):
+        # Metrics of the denormalized descriptors, accumulated per batch
+        __mean = torch.as_tensor(dscrptr_mean, dtype=torch.float32,
+                                 device=test_device)
+        __std = torch.as_tensor(dscrptr_std, dtype=torch.float32,
+                                device=test_device)
+        __metrics = RegressionMetrics(num_targets=len(target_list),
+                                      device=test_device)
+        trainer.accumulate(
+            loader, lambda __pred, __trgt, _: __metrics.update(
+                __pred * __std + __mean, __trgt * __std + __mean),
+            test_model, test_device, test_precision)
+
+        __result = __metrics.result()
+        r2_array = __result['r2'].cpu().numpy()
+        mae_array = __result['mae'].cpu().numpy()
 
         for i, target in enumerate(target_list):
             print(f'Target Descriptor Name: {target:15s}, '
@@ -286,27 +507,76 @@ def main():
 
         return np.mean(r2_array), np.mean(mae_array)
 
-    print('Training started.')
+    main_print('Training started.')
     best_val_r2 = None
+    best_state_dict = None
     for epoch in range(1, args.max_num_epochs + 1):
 
         # scheduler.step()
         lr = scheduler.optimizer.param_groups[0]['lr']
-        loss = train(trn_loader)
-        print('Validation ' + '#' * 80)
-        val_r2, val_mae = test(val_loader)
-        print('#' * 80)
+        epoch_start_time = time.perf_counter()
+        loss = train(trn_loader, epoch)
+
+        # Validation and testing on the main process, which broadcasts the
+        # validation R2 for the same scheduling in all the processes
+        val_r2 = None
+        if is_main_process():
+            print('Validation ' + '#' * 80)
+            val_cached = getattr(val_loader, 'cached', False)
+            val_start_time = time.perf_counter()
+            val_r2, val_mae = test(val_loader)
+            print(f'Validation time: '
+                  f'{time.perf_counter() - val_start_time:.2f}s '
+                  f'({"cached" if val_cached else "uncached"} batches)')
+            print('#' * 80)
+        val_r2 = broadcast_value(val_r2)
         scheduler.step(val_r2)
 
         if best_val_r2 is None or val_r2 > best_val_r2:
             best_val_r2 = val_r2
-            print('Testing ' + '#' * 80)
-            tst_r2, tst_mae = test(tst_loader)
-            print('#' * 80)
+            if args.quantized_inference or \
+                    (args.embedding_store_dir is not None):
+                best_state_dict = copy.deepcopy(model.state_dict())
+            if args.checkpoint_path is not None:
+                save_checkpoint(args.checkpoint_path, model, epoch=epoch,
+                                optimizer=optimizer.state_dict())
+            if is_main_process():
+                print('Testing ' + '#' * 80)
+                tst_r2, tst_mae = test(tst_loader)
+                print('#' * 80)
+
+        if is_main_process():
+            print(f'Epoch: {epoch:03d}, LR: {lr:6f}, Loss: {loss:.4f}, ',
+                  f'Validation R2: {val_r2:.4f} MAE: {val_mae:.4f}; ',
+                  f'Testing R2: {tst_r2:.4f} MAE: {tst_mae:.4f}; ',
+                  f'Time: {time.perf_counter() - epoch_start_time:.2f}s')
+
+    if args.quantized_inference and is_main_process():
+        print('Quantized Inference ' + '#' * 80)
+        model.load_state_dict(best_state_dict)
+        quantization_report(
+            lambda m: test(tst_loader, m, torch.device('cpu'), 'fp32'),
+            model, quantize_for_inference(model))
+        print('#' * 80)
 
-        print(f'Epoch: {epoch:03d}, LR: {lr:6f}, Loss: {loss:.4f}, ',
-              f'Validation R2: {val_r2:.4f} MAE: {val_mae:.4f}; ',
-              f'Testing R2: {tst_r2:.4f} MAE: {tst_mae:.4f};')
+    if (args.embedding_store_dir is not None) and is_main_process():
+        print('Exporting Embeddings ' + '#' * 80)
+        model.load_state_dict(best_state_dict)
+        if args.embedding_smiles_csv is None:
+            id_smiles_dict = {cid: cid_smiles_dict[cid] for cid in cid_list}
+        else:
+            id_smiles_df = pd.read_csv(args.embedding_smiles_csv,
+                                       header=0, index_col=0, dtype=str)
+            id_smiles_dict = id_smiles_df.iloc[:, 0].to_dict()
+        num_records = export_embeddings(
+            model, id_smiles_dict, args.embedding_store_dir, device,
+            batch_size=args.embedding_batch_size,
+            dtype=args.embedding_dtype, precision=args.precision,
+            featurizer_kwargs=trn_dataset.featurizer_kwargs)
+        print(f'Wrote the embeddings of {num_records} molecules '
+              f'(out of {len(id_smiles_dict)}) into '
+              f'{args.embedding_store_dir}')
+        print('#' * 80)
 
 
 if __name__ == '__main__':
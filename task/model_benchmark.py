@@ -0,0 +1,1244 @@
+"""
+    File Name:          MoReL/model_benchmark.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Benchmarks (and equivalence checks) of the network implementations
+        on synthetic molecule-like graphs, so that they can be run without
+        the PubChem data.
+
+        Usage:
+            python -m task.model_benchmark edge_gcn --device cuda:0
+"""
+import time
+import torch
+import argparse
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.nn.functional as F
+import torch_geometric.data as pyg_data
+from typing import List, Optional
+
+from network.gnn.gat.gat import EdgeGAT, EdgeGATEncoder, FusedEdgeGAT
+from network.gnn.gcn.gcn import EdgeGCN, EdgeGCNEncoder, FusedEdgeGCN
+from network.gnn.ggnn.ggnn import GGNN, SparseGGNN
+from network.gnn.mpnn.mpnn import MPNN
+from network.simple_uno import SimpleUno
+from network.common.ensemble import StackedEnsemble, member_losses
+from network.common.embedding_cache import DrugEmbeddingCache
+from network.gnn.gcn.__graph_conv_layer import GraphConvLayer
+from utils.dataset.graph_collate import GraphCollate
+from utils.dataset.featurizers import DEFAULT_TOKEN_DICT
+from utils.dataset.token_batching import \
+    PAD_INDEX, LengthBucketBatchSampler, TokenCollate
+from network.transformer.multi_head_attn import SDPA_AVAILABLE
+from network.transformer.encoder import Encoder
+from network.transformer.transformer import Transformer
+from network.transformer.decoding import \
+    greedy_decode, top_k_sample, beam_search
+from network.common.relational_graph import relational_edges
+from utils.misc.precision import autocast, keep_fp32
+from utils.misc.compiling import CompiledForward, num_compiled_graphs
+from utils.misc.random_seeding import seed_random_state
+from utils.misc.lockstep_trainer import LockstepTrainer, LockstepMember
+from utils.misc.distributed import launch, default_threads_per_proc, \
+    get_rank, get_world_size, wrap_model, barrier
+
+
+# Helper functions ############################################################
+def random_graph_batch(num_graphs: int,
+                       num_nodes: int,
+                       node_attr_dim: int,
+                       edge_attr_dim: int,
+                       num_edges_per_node: int = 2,
+                       num_edge_types: Optional[int] = None,
+                       device: torch.device = torch.device('cpu')):
+    """
+    Batch of random undirected graphs with binary node attributes and
+    multi-hot edge attributes, where the first edge attribute channel is
+    always on (like the master bond of the featurizer).
+
+    If num_edge_types is given, the edge attributes are drawn from that
+    many distinct vectors, like the bond features of molecules.
+    """
+
+    palette = None
+    if num_edge_types is not None:
+        palette = (torch.rand(num_edge_types, edge_attr_dim) < 0.3).float()
+        palette[:, 0] = 1.
+
+    data_list = []
+    for _ in range(num_graphs):
+        __num_edges = num_nodes * num_edges_per_node // 2
+        __src = torch.randint(num_nodes, (__num_edges, ))
+        __dst = torch.randint(num_nodes, (__num_edges, ))
+        if palette is None:
+            __edge_attr = \
+                (torch.rand(__num_edges, edge_attr_dim) < 0.3).float()
+            __edge_attr[:, 0] = 1.
+        else:
+            __edge_attr = palette[torch.randint(num_edge_types,
+                                                (__num_edges, ))]
+
+        data_list.append(pyg_data.Data(
+            x=(torch.rand(num_nodes, node_attr_dim) < 0.2).float(),
+            edge_index=torch.cat([torch.stack([__src, __dst]),
+                                  torch.stack([__dst, __src])], dim=1),
+            edge_attr=torch.cat([__edge_attr, __edge_attr], dim=0)))
+
+    return pyg_data.Batch.from_data_list(data_list).to(device)
+
+
+def default_forward(model: nn.Module, data):
+    return model(data)
+
+
+def synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_forward_backward(model: nn.Module,
+                          data: pyg_data.Data,
+                          device: torch.device,
+                          num_iters: int = 20,
+                          num_warmups: int = 3,
+                          forward_func: callable = None) -> (float, float):
+    """
+    Average forward and forward + backward time in milliseconds.
+    forward_func(model, data) replaces model(data) if given.
+    """
+
+    if forward_func is None:
+        forward_func = default_forward
+
+    model.train()
+    for _ in range(num_warmups):
+        forward_func(model, data).sum().backward()
+
+    synchronize(device)
+    __start_time = time.perf_counter()
+    with torch.no_grad():
+        for _ in range(num_iters):
+            forward_func(model, data)
+    synchronize(device)
+    fwd_time = (time.perf_counter() - __start_time) / num_iters * 1e3
+
+    __start_time = time.perf_counter()
+    for _ in range(num_iters):
+        model.zero_grad()
+        forward_func(model, data).sum().backward()
+    synchronize(device)
+    fwd_bwd_time = (time.perf_counter() - __start_time) / num_iters * 1e3
+
+    return fwd_time, fwd_bwd_time
+
+
+def time_inference(model: nn.Module,
+                   inputs: tuple,
+                   device: torch.device,
+                   num_iters: int = 20,
+                   num_warmups: int = 3) -> float:
+    """
+    Average inference time in milliseconds of model(*inputs).
+    """
+    with torch.no_grad():
+        for _ in range(num_warmups):
+            model(*inputs)
+        synchronize(device)
+        __start_time = time.perf_counter()
+        for _ in range(num_iters):
+            model(*inputs)
+        synchronize(device)
+    return (time.perf_counter() - __start_time) / num_iters * 1e3
+
+
+def peak_memory(model: nn.Module,
+                data: pyg_data.Data,
+                device: torch.device,
+                forward_func: callable = None) -> str:
+    """
+    Peak allocated memory (MB) of a forward + backward pass on GPU.
+    """
+    if device.type != 'cuda':
+        return '-'
+    if forward_func is None:
+        forward_func = default_forward
+    model.train()
+    model.zero_grad()
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    __base_memory = torch.cuda.memory_allocated(device)
+    forward_func(model, data).sum().backward()
+    synchronize(device)
+    return fmt((torch.cuda.max_memory_allocated(device) - __base_memory)
+               / 2 ** 20)
+
+
+def saved_activation_memory(model: nn.Module,
+                            data: pyg_data.Data,
+                            forward_func: callable = None) -> str:
+    """
+    Size (MB) of the tensors saved for backward in a forward pass, which
+    is the activation memory on any device (including CPU).
+    """
+    if forward_func is None:
+        forward_func = default_forward
+    __num_bytes = 0
+
+    def __pack(tensor):
+        nonlocal __num_bytes
+        __num_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    model.train()
+    with torch.autograd.graph.saved_tensors_hooks(__pack, lambda t: t):
+        forward_func(model, data)
+    return fmt(__num_bytes / 2 ** 20)
+
+
+def random_token_batch(num_seqs: int,
+                       len_tokens: int = 128,
+                       mean_length: float = 48.,
+                       dict_size: int = 64) -> torch.Tensor:
+    """
+    Token arrays padded to len_tokens (like mol_to_tokens), with
+    log-normally distributed lengths like the SMILES strings in PubChem.
+    """
+    lengths = torch.empty(num_seqs).log_normal_(
+        mean=float(torch.log(torch.tensor(mean_length))), std=0.4)
+    lengths = lengths.long().clamp(min=2, max=len_tokens)
+    tokens = torch.randint(1, dict_size, (num_seqs, len_tokens))
+    tokens[:, 0] = 0
+    tokens[torch.arange(len_tokens).unsqueeze(0) >= lengths.unsqueeze(1)] = \
+        PAD_INDEX
+    return tokens
+
+
+def print_table(header: List[str], rows: List[list]):
+    __widths = [max(len(str(r[i])) for r in [header] + rows)
+                for i in range(len(header))]
+    for __row in [header] + rows:
+        print(' | '.join(str(v).rjust(w) for v, w in zip(__row, __widths)))
+
+
+def fmt(value: float) -> str:
+    return f'{value:.2f}'
+
+
+# Benchmarks ##################################################################
+def benchmark_edge_gcn(args, device: torch.device):
+    """
+    EdgeGCN (one GCN per edge type) against FusedEdgeGCN (all edge types
+    in one message passing call) across edge_attr_dim and state_dim.
+    """
+
+    rows = []
+    for edge_attr_dim in args.edge_attr_dims:
+        for state_dim in args.state_dims:
+
+            __kwargs = {'node_attr_dim': args.node_attr_dim,
+                        'edge_attr_dim': edge_attr_dim,
+                        'state_dim': state_dim,
+                        'num_conv': args.num_conv,
+                        'out_dim': state_dim}
+            data = random_graph_batch(
+                args.batch_size, args.num_nodes, args.node_attr_dim,
+                edge_attr_dim, device=device)
+
+            edge_gcn = EdgeGCN(**__kwargs).to(device)
+            fused_edge_gcn = FusedEdgeGCN.from_edge_gcn(
+                edge_gcn, **__kwargs).to(device)
+            fused_basis_edge_gcn = FusedEdgeGCN(
+                num_bases=max(edge_attr_dim // 2, 1), **__kwargs).to(device)
+
+            # Equivalence check in evaluation mode (no dropout)
+            edge_gcn.eval()
+            fused_edge_gcn.eval()
+            with torch.no_grad():
+                __max_diff = (edge_gcn(data) -
+                              fused_edge_gcn(data)).abs().max().item()
+
+            __times = [time_forward_backward(m, data, device, args.num_iters)
+                       for m in [edge_gcn, fused_edge_gcn,
+                                 fused_basis_edge_gcn]]
+            rows.append([edge_attr_dim, state_dim, f'{__max_diff:.2e}'] +
+                        [fmt(t) for __t in __times for t in __t])
+
+    print_table(['edge_attr_dim', 'state_dim', 'max_abs_diff',
+                 'loop_fwd(ms)', 'loop_fwd_bwd(ms)',
+                 'fused_fwd(ms)', 'fused_fwd_bwd(ms)',
+                 'basis_fwd(ms)', 'basis_fwd_bwd(ms)'], rows)
+
+
+def benchmark_edge_gat(args, device: torch.device):
+    """
+    EdgeGAT (one GAT per edge type) against FusedEdgeGAT with per-type
+    attention (equivalent) and with merged relations, in graphs per second
+    and peak memory.
+    """
+
+    rows = []
+    for edge_attr_dim in args.edge_attr_dims:
+        for state_dim in args.state_dims:
+
+            __kwargs = {'node_attr_dim': args.node_attr_dim,
+                        'edge_attr_dim': edge_attr_dim,
+                        'state_dim': state_dim,
+                        'num_heads': args.num_heads,
+                        'num_conv': args.num_conv,
+                        'out_dim': state_dim}
+            data = random_graph_batch(
+                args.batch_size, args.num_nodes, args.node_attr_dim,
+                edge_attr_dim, device=device)
+
+            edge_gat = EdgeGAT(**__kwargs).to(device)
+            fused_edge_gat = FusedEdgeGAT.from_edge_gat(
+                edge_gat, **__kwargs).to(device)
+            merged_edge_gat = FusedEdgeGAT(
+                merge_relations=True, **__kwargs).to(device)
+
+            edge_gat.eval()
+            fused_edge_gat.eval()
+            with torch.no_grad():
+                __max_diff = (edge_gat(data) -
+                              fused_edge_gat(data)).abs().max().item()
+
+            __row = [edge_attr_dim, state_dim, f'{__max_diff:.2e}']
+            for __model in [edge_gat, fused_edge_gat, merged_edge_gat]:
+                _, __fwd_bwd_time = time_forward_backward(
+                    __model, data, device, args.num_iters)
+                __row.append(fmt(args.batch_size / __fwd_bwd_time * 1e3))
+                __row.append(peak_memory(__model, data, device))
+            rows.append(__row)
+
+    print_table(['edge_attr_dim', 'state_dim', 'max_abs_diff',
+                 'loop(graphs/s)', 'loop(MB)',
+                 'fused(graphs/s)', 'fused(MB)',
+                 'merged(graphs/s)', 'merged(MB)'], rows)
+
+
+def benchmark_mpnn(args, device: torch.device):
+    """
+    MPNN with NNConv (one weight matrix per edge) against edge-type
+    weights (one weight matrix per distinct edge attribute vector) and
+    their low-rank factorization, across state_dim.
+    """
+
+    edge_attr_dim = args.edge_attr_dims[0]
+    data = random_graph_batch(
+        args.batch_size, args.num_nodes, args.node_attr_dim, edge_attr_dim,
+        num_edge_types=args.num_edge_types, device=device)
+
+    rows = []
+    for state_dim in args.state_dims:
+
+        __kwargs = {'node_attr_dim': args.node_attr_dim,
+                    'edge_attr_dim': edge_attr_dim,
+                    'state_dim': state_dim,
+                    'num_conv': args.num_conv}
+        mpnn = MPNN(**__kwargs).to(device)
+        typed_mpnn = MPNN(edge_type_weights=True, **__kwargs).to(device)
+        typed_mpnn.load_state_dict(mpnn.state_dict())
+        low_rank_mpnn = MPNN(edge_type_weights=True,
+                             weight_rank=args.weight_rank,
+                             **__kwargs).to(device)
+
+        mpnn.eval()
+        typed_mpnn.eval()
+        with torch.no_grad():
+            __max_diff = (mpnn(data) - typed_mpnn(data)).abs().max().item()
+
+        __row = [state_dim, f'{__max_diff:.2e}']
+        for __model in [mpnn, typed_mpnn, low_rank_mpnn]:
+            _, __fwd_bwd_time = time_forward_backward(
+                __model, data, device, args.num_iters)
+            __row.append(fmt(__fwd_bwd_time))
+            __row.append(peak_memory(__model, data, device))
+        rows.append(__row)
+
+    print_table(['state_dim', 'max_abs_diff',
+                 'nn_conv(ms)', 'nn_conv(MB)',
+                 'typed(ms)', 'typed(MB)',
+                 f'rank_{args.weight_rank}(ms)',
+                 f'rank_{args.weight_rank}(MB)'], rows)
+
+
+def benchmark_ggnn(args, device: torch.device):
+    """
+    Dense GGNN (padded to max_num_atoms, [N, N * E] adjacency bmm) against
+    SparseGGNN (edge list and scatter) on the same graphs.
+    """
+
+    edge_attr_dim = args.edge_attr_dims[0]
+    data = random_graph_batch(
+        args.batch_size, args.num_nodes, args.node_attr_dim, edge_attr_dim,
+        device=device)
+    edge_index, edge_type = relational_edges(data.edge_index, data.edge_attr)
+
+    # Dense (padded) version of the same batch
+    num_nodes = torch.bincount(data.batch)
+    node_offset = torch.cumsum(num_nodes, dim=0) - num_nodes
+    local_index = torch.arange(data.num_nodes, device=device) - \
+        node_offset[data.batch]
+    src, dst = edge_index
+    adj_matrix = torch.zeros(args.batch_size, args.max_num_atoms,
+                             args.max_num_atoms, edge_attr_dim,
+                             device=device)
+    adj_matrix.index_put_((data.batch[dst], local_index[dst],
+                           local_index[src], edge_type),
+                          torch.ones_like(src, dtype=torch.float),
+                          accumulate=True)
+
+    rows = []
+    for state_dim in args.state_dims:
+
+        __kwargs = {'state_dim': state_dim,
+                    'num_edge_types': edge_attr_dim,
+                    'annotation_dim': state_dim,
+                    'propagation_steps': args.num_conv}
+        ggnn = GGNN(num_nodes=args.max_num_atoms, **__kwargs).to(device)
+        sparse_ggnn = SparseGGNN.from_ggnn(ggnn, **__kwargs).to(device)
+
+        state = torch.randn(data.num_nodes, state_dim, device=device)
+        dense_state = torch.zeros(args.batch_size, args.max_num_atoms,
+                                  state_dim, device=device)
+        dense_state[data.batch, local_index] = state
+
+        def __dense_forward():
+            return ggnn(dense_state, dense_state, adj_matrix)
+
+        def __sparse_forward():
+            return sparse_ggnn(state, state, edge_index, edge_type)
+
+        with torch.no_grad():
+            __max_diff = (__dense_forward()[data.batch, local_index] -
+                          __sparse_forward()).abs().max().item()
+
+        __row = [state_dim, f'{__max_diff:.2e}']
+        for __model, __forward in [(ggnn, __dense_forward),
+                                   (sparse_ggnn, __sparse_forward)]:
+            _, __fwd_bwd_time = time_forward_backward(
+                __model, None, device, args.num_iters,
+                forward_func=lambda m, d: __forward())
+            __row.append(fmt(__fwd_bwd_time))
+            __row.append(peak_memory(__model, None, device,
+                                     forward_func=lambda m, d: __forward()))
+        rows.append(__row)
+
+    print(f'{args.batch_size} graphs with {args.num_nodes} nodes, '
+          f'padded to {args.max_num_atoms} for the dense GGNN')
+    print_table(['state_dim', 'max_abs_diff',
+                 'dense(ms)', 'dense(MB)', 'sparse(ms)', 'sparse(MB)'], rows)
+
+
+def benchmark_graph_conv(args, device: torch.device):
+    """
+    Crossover between the dense (bmm over padded adjacency matrices) and
+    the sparse (sparse-dense matmul over block-diagonal COO/CSR adjacency
+    matrix) GraphConvLayer across graph sizes. The dense version is
+    timed with both bucketed padding and padding to max_num_atoms.
+    """
+
+    edge_attr_dim = args.edge_attr_dims[0]
+    state_dim = args.state_dims[0]
+    layer = GraphConvLayer(in_state_dim=args.node_attr_dim,
+                           out_state_dim=state_dim,
+                           num_nodes=None,
+                           num_edge_types=edge_attr_dim).to(device)
+
+    rows = []
+    for num_nodes in args.graph_sizes:
+
+        data_list = random_graph_batch(
+            args.batch_size, num_nodes, args.node_attr_dim,
+            edge_attr_dim).to_data_list()
+
+        __row = [num_nodes]
+        for __collate in [GraphCollate(sparse=False,
+                                       num_edge_types=edge_attr_dim),
+                          GraphCollate(sparse=False,
+                                       bucket_sizes=[args.max_num_atoms],
+                                       num_edge_types=edge_attr_dim),
+                          GraphCollate(sparse=True, layout='coo',
+                                       num_edge_types=edge_attr_dim),
+                          GraphCollate(sparse=True, layout='csr',
+                                       num_edge_types=edge_attr_dim)]:
+            __x, __adj_matrix, _ = __collate(data_list)
+            __x, __adj_matrix = __x.to(device), __adj_matrix.to(device)
+            _, __fwd_bwd_time = time_forward_backward(
+                layer, (__x, __adj_matrix), device, args.num_iters,
+                forward_func=lambda m, d: m(*d))
+            __row.append(fmt(__fwd_bwd_time))
+        rows.append(__row)
+
+    print(f'{args.batch_size} graphs per batch, edge_attr_dim='
+          f'{edge_attr_dim}, state_dim={state_dim}')
+    print_table(['num_nodes', 'dense_bucketed(ms)',
+                 f'dense_{args.max_num_atoms}(ms)',
+                 'sparse_coo(ms)', 'sparse_csr(ms)'], rows)
+
+
+def benchmark_transformer(args, device: torch.device):
+    """
+    Tokens per second of the Transformer encoder (forward + backward over
+    an epoch of synthetic SMILES tokens) with the explicit attention and
+    full padding (before), fused attention (SDPA) and full padding, and
+    fused attention with length bucketing and dynamic padding.
+    """
+
+    tokens = random_token_batch(args.num_seqs, args.max_num_atoms)
+    num_real_tokens = int((tokens != PAD_INDEX).sum())
+    dataset = torch.utils.data.TensorDataset(tokens)
+
+    def __tokens_per_second(encoder, loader) -> str:
+        encoder.train()
+        synchronize(device)
+        __start_time = time.perf_counter()
+        for __batch in loader:
+            __src = __batch[0].to(device)
+            encoder.zero_grad()
+            encoder(__src, __src != PAD_INDEX).sum().backward()
+        synchronize(device)
+        return fmt(num_real_tokens / (time.perf_counter() - __start_time))
+
+    __lengths = (tokens != PAD_INDEX).sum(dim=1).tolist()
+    padded_loader = torch.utils.data.DataLoader(
+        dataset, batch_size=args.batch_size, shuffle=True)
+    bucketed_loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_sampler=LengthBucketBatchSampler(__lengths, args.batch_size),
+        collate_fn=TokenCollate(token_position=0))
+
+    rows = []
+    for emb_dim in args.state_dims:
+        # Same weights with the explicit and the fused attention
+        __encoders = {}
+        for __use_sdpa in [False, True] if SDPA_AVAILABLE else [False]:
+            __encoders[__use_sdpa] = Encoder(
+                dict_size=256,
+                seq_length=args.max_num_atoms,
+                base_feq=8.,
+                emb_scale=None,
+                emb_dim=emb_dim,
+                num_layers=args.num_conv,
+                num_heads=args.num_heads,
+                ff_mid_dim=4 * emb_dim,
+                use_sdpa=__use_sdpa).to(device)
+            __encoders[__use_sdpa].load_state_dict(
+                __encoders[False].state_dict())
+
+        __row = [emb_dim, __tokens_per_second(__encoders[False],
+                                              padded_loader)]
+        if SDPA_AVAILABLE:
+            __row += [__tokens_per_second(__encoders[True], padded_loader),
+                      __tokens_per_second(__encoders[True], bucketed_loader)]
+        else:
+            __row += ['-',
+                      __tokens_per_second(__encoders[False], bucketed_loader)]
+        rows.append(__row)
+
+    print(f'{args.num_seqs} sequences with {num_real_tokens} tokens, '
+          f'padded to {args.max_num_atoms}')
+    print_table(['emb_dim', 'explicit_padded(tokens/s)',
+                 'sdpa_padded(tokens/s)', 'bucketed(tokens/s)'], rows)
+
+
+def benchmark_decoding(args, device: torch.device):
+    """
+    Generated molecules (token sequences) per second of the Transformer
+    with full recomputation of the decoder at every step (before), and
+    with the cached keys and values for greedy, top-k, and beam search.
+    The model is untrained, so most sequences run to the maximum length.
+    """
+
+    dict_size = len(DEFAULT_TOKEN_DICT)
+    src = random_token_batch(args.batch_size, args.max_num_atoms,
+                             dict_size=dict_size).to(device)
+    max_length = args.max_decode_length
+
+    def __full_recompute_greedy(model, __src):
+        __src_mask = model.src_mask(__src)
+        __tokens = __src[:, :1]
+        for __step in range(max_length - 1):
+            __log_prob = model(__src, __tokens, src_mask=__src_mask)
+            __tokens = torch.cat(
+                (__tokens, __log_prob[:, -1].argmax(-1, keepdim=True)),
+                dim=1)
+        return __tokens
+
+    decoders = [
+        ('full_recompute', __full_recompute_greedy),
+        ('cached_greedy',
+         lambda m, s: greedy_decode(m, s, max_length=max_length)),
+        ('cached_top_10',
+         lambda m, s: top_k_sample(m, s, k=10, max_length=max_length)),
+        ('cached_beam_4',
+         lambda m, s: beam_search(m, s, beam_size=4, max_length=max_length)),
+    ]
+
+    rows = []
+    for emb_dim in args.state_dims:
+        model = Transformer(src_dict_size=dict_size,
+                            trg_dict_size=dict_size,
+                            seq_length=args.max_num_atoms,
+                            base_feq=8.,
+                            emb_scale=None,
+                            emb_dim=emb_dim,
+                            num_layers=args.num_conv,
+                            num_heads=args.num_heads,
+                            ff_mid_dim=4 * emb_dim,
+                            pad_index=PAD_INDEX).to(device)
+        model.eval()
+
+        __row = [emb_dim]
+        for __name, __decode in decoders:
+            with torch.no_grad():
+                __decode(model, src)
+                synchronize(device)
+                __start_time = time.perf_counter()
+                for _ in range(args.num_iters):
+                    __decode(model, src)
+                synchronize(device)
+            __row.append(fmt(args.batch_size * args.num_iters /
+                             (time.perf_counter() - __start_time)))
+        rows.append(__row)
+
+    print(f'Batches of {args.batch_size} sources, '
+          f'decoded up to {max_length} tokens')
+    print_table(['emb_dim'] + [f'{n}(mols/s)' for n, _ in decoders], rows)
+
+
+def benchmark_simple_uno_export(args, device: torch.device):
+    """
+    Latency and throughput of SimpleUno (cross_study.py configuration)
+    in eval mode, with folded BatchNorm layers, and with folded BatchNorm
+    layers in TorchScript, together with the maximum output difference.
+    """
+
+    cell_input_dim, drug_input_dim = 942, 4096
+    model = SimpleUno(state_dim=args.uno_state_dim,
+                      dose_info=True,
+                      cell_input_dim=cell_input_dim,
+                      cell_state_dim=1024,
+                      drug_input_dim=drug_input_dim,
+                      drug_state_dim=4096,
+                      sigmoid_output=False).to(device)
+
+    # Update the running statistics of BatchNorm so that folding is not
+    # an identity transformation
+    model.train()
+    with torch.no_grad():
+        for _ in range(8):
+            model(torch.randn(256, cell_input_dim, device=device) * 2 + 1,
+                  torch.randn(256, drug_input_dim, device=device) * 2 + 1,
+                  torch.rand(256, 1, device=device))
+    model.eval()
+
+    exported = {
+        'eval': model,
+        'folded': model.export(script=False),
+        'folded_scripted': model.export(script=True), }
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        __inputs = (torch.randn(batch_size, cell_input_dim, device=device),
+                    torch.randn(batch_size, drug_input_dim, device=device),
+                    torch.rand(batch_size, 1, device=device))
+        with torch.no_grad():
+            __ref = model(*__inputs)
+            __diff = max(float((m(*__inputs) - __ref).abs().max())
+                         for m in exported.values())
+
+        __row = [batch_size]
+        for __model in exported.values():
+            __time = time_inference(__model, __inputs, device, args.num_iters)
+            __row += [fmt(__time), fmt(batch_size / __time * 1e3)]
+        rows.append(__row + [f'{__diff:.2e}'])
+
+    print_table(['batch_size'] +
+                [f'{n}({u})' for n in exported for u in ['ms', 'samples/s']] +
+                ['max_abs_diff'], rows)
+
+
+def benchmark_ensemble(args, device: torch.device):
+    """
+    Training step time of K small SimpleUno models (sweep trials) one
+    after another versus together as a StackedEnsemble, together with the
+    maximum output difference of the ensemble members in eval mode.
+    """
+
+    cell_input_dim, drug_input_dim, batch_size = 942, 4096, args.batch_size
+    inputs = (torch.randn(batch_size, cell_input_dim, device=device),
+              torch.randn(batch_size, drug_input_dim, device=device),
+              torch.rand(batch_size, 1, device=device))
+    trgt = torch.randn(batch_size, 1, device=device)
+
+    def __step_time(models: list, optimizers: list) -> float:
+        for __model in models:
+            __model.train()
+        synchronize(device)
+        __start_time = time.perf_counter()
+        for _ in range(args.num_iters):
+            for __model, __optimizer in zip(models, optimizers):
+                __optimizer.zero_grad()
+                member_losses(__model(*inputs).view(-1, batch_size, 1),
+                              trgt).sum().backward()
+                __optimizer.step()
+        synchronize(device)
+        return (time.perf_counter() - __start_time) / args.num_iters * 1e3
+
+    rows = []
+    for __ensemble_size in args.ensemble_sizes:
+        __models = [SimpleUno(state_dim=args.uno_state_dim,
+                              dose_info=True,
+                              cell_input_dim=cell_input_dim,
+                              cell_state_dim=args.uno_state_dim,
+                              drug_input_dim=drug_input_dim,
+                              drug_state_dim=args.uno_state_dim,
+                              sigmoid_output=False).to(device)
+                    for _ in range(__ensemble_size)]
+        __ensemble = StackedEnsemble(__models).to(device)
+
+        with torch.no_grad():
+            __ensemble.eval()
+            __diff = max(float((__ensemble(*inputs)[__i] -
+                                __model.eval()(*inputs)).abs().max())
+                         for __i, __model in enumerate(__models))
+
+        __separate_time = __step_time(
+            __models, [torch.optim.Adam(m.parameters()) for m in __models])
+        __stacked_time = __step_time(
+            [__ensemble], [torch.optim.Adam(__ensemble.parameters())])
+        rows.append([__ensemble_size, fmt(__separate_time),
+                     fmt(__stacked_time),
+                     fmt(__separate_time / __stacked_time),
+                     f'{__diff:.2e}'])
+
+    print(f'SimpleUno with state dimensions {args.uno_state_dim}, '
+          f'batch size {batch_size}')
+    print_table(['ensemble_size', 'separate(ms)', 'stacked(ms)',
+                 'speedup', 'max_abs_diff'], rows)
+
+
+def benchmark_drug_cache(args, device: torch.device):
+    """
+    Training step time of SimpleUno with a frozen MPNN drug tower, with
+    and without the drug embedding cache, compared to descriptor drugs
+    (the default MLP drug tower), together with the maximum difference of
+    the cached and the computed drug embeddings.
+    """
+
+    cell_input_dim, num_drugs = 942, 256
+    edge_attr_dim = args.edge_attr_dims[0]
+    drug_data_list = random_graph_batch(
+        num_drugs, args.num_nodes, args.node_attr_dim, edge_attr_dim,
+        num_edge_types=args.num_edge_types).to_data_list()
+
+    drug_idx = torch.randint(num_drugs, (args.batch_size, ))
+    graph_batch = pyg_data.Batch.from_data_list(
+        [drug_data_list[__i] for __i in drug_idx.tolist()]).to(device)
+    graph_batch.drug_idx = drug_idx.to(device)
+    cell_data = torch.randn(args.batch_size, cell_input_dim, device=device)
+    trgt = torch.rand(args.batch_size, 1, device=device)
+
+    def __uno(drug_tower: Optional[nn.Module] = None) -> SimpleUno:
+        return SimpleUno(state_dim=args.uno_state_dim,
+                         dose_info=False,
+                         cell_state_dim=args.uno_state_dim,
+                         drug_state_dim=args.num_dscrptr,
+                         cell_input_dim=cell_input_dim,
+                         drug_input_dim=args.num_dscrptr,
+                         drug_tower=drug_tower).to(device).train()
+
+    def __step_time(model: SimpleUno, drug_data) -> float:
+        __optimizer = torch.optim.Adam(
+            [p for p in model.parameters() if p.requires_grad])
+        for __iter in range(args.num_iters + 3):
+            if __iter == 3:
+                synchronize(device)
+                __start_time = time.perf_counter()
+            __optimizer.zero_grad()
+            F.mse_loss(model(cell_data, drug_data), trgt).backward()
+            __optimizer.step()
+        synchronize(device)
+        return (time.perf_counter() - __start_time) / args.num_iters * 1e3
+
+    rows = []
+    for state_dim in args.state_dims:
+        __tower = MPNN(node_attr_dim=args.node_attr_dim,
+                       edge_attr_dim=edge_attr_dim,
+                       state_dim=state_dim,
+                       num_conv=args.num_conv,
+                       out_dim=args.num_dscrptr).to(device)
+        for __param in __tower.parameters():
+            __param.requires_grad = False
+        __model = __uno(__tower)
+
+        __graph_time = __step_time(__model, graph_batch)
+        __model.cache_drug_embeddings(drug_data_list)
+        __cached_time = __step_time(__model, graph_batch)
+        __dscrptr_time = __step_time(
+            __uno(), torch.randn(args.batch_size, args.num_dscrptr,
+                                 device=device))
+
+        __cache = DrugEmbeddingCache(__tower, drug_data_list)
+        with torch.no_grad():
+            __diff = float((__cache(graph_batch) -
+                            __tower.eval()(graph_batch)).abs().max())
+        rows.append([state_dim, fmt(__graph_time), fmt(__cached_time),
+                     fmt(__dscrptr_time), f'{__diff:.2e}'])
+
+    print(f'Batch size {args.batch_size}, {num_drugs} unique drugs')
+    print_table(['state_dim', 'graph(ms)', 'cached(ms)', 'dscrptr(ms)',
+                 'max_abs_diff'], rows)
+
+
+def benchmark_precision(args, device: torch.device):
+    """
+    Forward + backward time and activation memory of the graph encoders
+    in fp32 and in bf16 autocast (with the PyG layers kept in fp32), and
+    a convergence check of MPNN regressing the outputs of a random MPNN
+    (teacher) in both precisions from the same initialization.
+    """
+
+    edge_attr_dim = args.edge_attr_dims[0]
+    data = random_graph_batch(
+        args.batch_size, args.num_nodes, args.node_attr_dim, edge_attr_dim,
+        num_edge_types=args.num_edge_types, device=device)
+
+    def __forward_func(precision: str):
+        def __forward(model, __data):
+            with autocast(precision, device):
+                return model(__data).float()
+        return __forward
+
+    rows = []
+    for __name, __model_class in [('mpnn', MPNN),
+                                  ('gcn', EdgeGCNEncoder),
+                                  ('gat', EdgeGATEncoder)]:
+        for state_dim in args.state_dims:
+            __model = keep_fp32(__model_class(
+                node_attr_dim=args.node_attr_dim,
+                edge_attr_dim=edge_attr_dim,
+                state_dim=state_dim,
+                num_conv=args.num_conv,
+                out_dim=args.num_dscrptr).to(device))
+            __row = [__name, state_dim]
+            for __precision in ['fp32', 'bf16']:
+                _, __fwd_bwd_time = time_forward_backward(
+                    __model, data, device, args.num_iters,
+                    forward_func=__forward_func(__precision))
+                __row += [fmt(__fwd_bwd_time), saved_activation_memory(
+                    __model, data, __forward_func(__precision))]
+            rows.append(__row)
+
+    print_table(['model', 'state_dim', 'fp32(ms)', 'fp32(MB)',
+                 'bf16(ms)', 'bf16(MB)'], rows)
+
+    # Convergence check #######################################################
+    __kwargs = {'node_attr_dim': args.node_attr_dim,
+                'edge_attr_dim': edge_attr_dim,
+                'state_dim': args.state_dims[0],
+                'num_conv': args.num_conv,
+                'out_dim': args.num_dscrptr}
+    batches = [random_graph_batch(
+        args.batch_size, args.num_nodes, args.node_attr_dim, edge_attr_dim,
+        num_edge_types=args.num_edge_types, device=device)
+        for _ in range(8)]
+    teacher = MPNN(**__kwargs).to(device).eval()
+    with torch.no_grad():
+        targets = [teacher(b) for b in batches]
+
+    initial_state_dict = MPNN(**__kwargs).state_dict()
+    losses = {}
+    for __precision in ['fp32', 'bf16']:
+        __model = keep_fp32(MPNN(**__kwargs).to(device))
+        __model.load_state_dict(initial_state_dict)
+        __optimizer = torch.optim.Adam(__model.parameters(), lr=1e-3)
+        losses[__precision] = []
+        for __step in range(args.num_train_steps):
+            __i = __step % len(batches)
+            __optimizer.zero_grad()
+            with autocast(__precision, device):
+                __loss = F.mse_loss(__model(batches[__i]).float(),
+                                    targets[__i])
+            __loss.backward()
+            __optimizer.step()
+            losses[__precision].append(__loss.item())
+
+    __interval = max(args.num_train_steps // 10, 1)
+    print_table(['step', 'fp32_loss', 'bf16_loss'],
+                [[__step + 1,
+                  f'{losses["fp32"][__step]:.4e}',
+                  f'{losses["bf16"][__step]:.4e}']
+                 for __step in range(__interval - 1, args.num_train_steps,
+                                     __interval)])
+
+
+def benchmark_compile(args, device: torch.device):
+    """
+    Forward + backward time of MPNN, EdgeGCNEncoder and EdgeGATEncoder in
+    eager mode and compiled (CompiledForward), over batches with varying
+    numbers of nodes and edges (dynamic shapes). The time of the first
+    pass over the batches (including compilation) is reported separately,
+    together with the final mode and the number of compiled graphs.
+    """
+
+    edge_attr_dim = args.edge_attr_dims[0]
+    batches = [random_graph_batch(
+        args.batch_size, __num_nodes, args.node_attr_dim, edge_attr_dim,
+        num_edge_types=args.num_edge_types, device=device)
+        for __num_nodes in args.graph_sizes]
+
+    def __epoch_time(forward) -> float:
+        synchronize(device)
+        __start_time = time.perf_counter()
+        for __data in batches:
+            forward(__data).sum().backward()
+        synchronize(device)
+        return (time.perf_counter() - __start_time) / len(batches) * 1e3
+
+    rows = []
+    for __name, __model_class in [('mpnn', MPNN),
+                                  ('gcn', EdgeGCNEncoder),
+                                  ('gat', EdgeGATEncoder)]:
+        for state_dim in args.state_dims:
+            __model = __model_class(
+                node_attr_dim=args.node_attr_dim,
+                edge_attr_dim=edge_attr_dim,
+                state_dim=state_dim,
+                num_conv=args.num_conv,
+                out_dim=state_dim).to(device).train()
+
+            __eager_time = min(__epoch_time(__model)
+                               for _ in range(args.num_iters))
+
+            __num_graphs = num_compiled_graphs()
+            __compiled = CompiledForward(
+                __model, recompile_limit=args.recompile_limit).train()
+            __first_time = __epoch_time(__compiled)
+            __compiled_time = min(__epoch_time(__compiled)
+                                  for _ in range(args.num_iters))
+
+            rows.append([__name, state_dim, __compiled.mode,
+                         num_compiled_graphs() - __num_graphs,
+                         fmt(__first_time), fmt(__eager_time),
+                         fmt(__compiled_time),
+                         fmt(__eager_time / __compiled_time)])
+
+    print(f'Graph sizes (nodes per graph) of the batches: {args.graph_sizes}')
+    print_table(['model', 'state_dim', 'mode', 'num_graphs',
+                 'first_pass(ms)', 'eager(ms)', 'compiled(ms)',
+                 'speedup'], rows)
+
+
+def benchmark_checkpointing(args, device: torch.device):
+    """
+    Memory/time trade-off of activation checkpointing (checkpoint_every)
+    in MPNN (blocks of conv steps) and EdgeGCN/EdgeGAT encoders (blocks
+    of edge types). The memory per graph is estimated as the tensors
+    saved for backward plus the activations of one recomputed block,
+    which gives the largest batch size within the memory budget.
+    """
+
+    edge_attr_dim = args.edge_attr_dims[0]
+    data = random_graph_batch(
+        args.batch_size, args.num_nodes, args.node_attr_dim, edge_attr_dim,
+        num_edge_types=args.num_edge_types, device=device)
+
+    rows = []
+    for __name, __model_class, __num_steps in [
+            ('mpnn', MPNN, args.num_conv),
+            ('gcn', EdgeGCNEncoder, edge_attr_dim),
+            ('gat', EdgeGATEncoder, edge_attr_dim)]:
+        for state_dim in args.state_dims:
+
+            __full_memory = None
+            for __checkpoint_every in [None] + args.checkpoint_every:
+                __model = __model_class(
+                    node_attr_dim=args.node_attr_dim,
+                    edge_attr_dim=edge_attr_dim,
+                    state_dim=state_dim,
+                    num_conv=args.num_conv,
+                    out_dim=state_dim,
+                    checkpoint_every=__checkpoint_every).to(device)
+
+                _, __fwd_bwd_time = time_forward_backward(
+                    __model, data, device, args.num_iters)
+                __memory = float(saved_activation_memory(__model, data))
+                if __checkpoint_every is None:
+                    __full_memory = __memory
+                else:
+                    __memory += __full_memory * \
+                        min(__checkpoint_every, __num_steps) / __num_steps
+
+                __memory_per_graph = __memory / args.batch_size
+                rows.append([
+                    __name, state_dim,
+                    '-' if __checkpoint_every is None
+                    else __checkpoint_every,
+                    fmt(__fwd_bwd_time), fmt(__memory),
+                    peak_memory(__model, data, device),
+                    int(args.memory_budget_mb / __memory_per_graph)])
+
+    print(f'Batch size {args.batch_size}, memory budget '
+          f'{args.memory_budget_mb} MB for activations')
+    print_table(['model', 'state_dim', 'checkpoint_every', 'fwd_bwd(ms)',
+                 'est_memory(MB)', 'cuda_peak(MB)', 'max_batch_size'],
+                rows)
+
+
+def distributed_train_worker(args, queue):
+    """
+    Training steps of MPNN in a process of the distributed benchmark, on
+    batch_size / world_size graphs per step; the main process puts the
+    number of graphs per second into the queue.
+    """
+
+    seed_random_state(args.rand_state + get_rank())
+    __batch_size = max(args.batch_size // get_world_size(), 1)
+    data = random_graph_batch(
+        __batch_size, args.num_nodes, args.node_attr_dim,
+        args.edge_attr_dims[0], num_edge_types=args.num_edge_types)
+
+    # The same initial parameters in all the processes
+    torch.manual_seed(args.rand_state)
+    model = wrap_model(MPNN(node_attr_dim=args.node_attr_dim,
+                            edge_attr_dim=args.edge_attr_dims[0],
+                            state_dim=args.state_dims[0],
+                            num_conv=args.num_conv,
+                            out_dim=args.num_dscrptr).train())
+    optimizer = torch.optim.RMSprop(model.parameters(), lr=1e-4)
+
+    def __step():
+        optimizer.zero_grad()
+        model(data).pow(2).mean().backward()
+        optimizer.step()
+
+    for _ in range(3):
+        __step()
+    barrier()
+    __start_time = time.perf_counter()
+    for _ in range(args.num_iters):
+        __step()
+    barrier()
+    __seconds = time.perf_counter() - __start_time
+
+    if get_rank() == 0:
+        queue.put(__batch_size * get_world_size() * args.num_iters /
+                  __seconds)
+
+
+def benchmark_distributed(args, device: torch.device):
+    """
+    Scaling of the data-parallel training on CPU (torch.distributed with
+    gloo) over the numbers of local processes, with the same global batch
+    size (batch_size graphs per step) and the cores partitioned among the
+    processes. A single process runs without DDP.
+    """
+
+    if device.type != 'cpu':
+        print('Distributed benchmark is on CPU only.')
+
+    queue = mp.get_context('spawn').SimpleQueue()
+    rows, __base_throughput = [], None
+    for __num_procs in args.num_procs:
+        __threads_per_proc = default_threads_per_proc(__num_procs) \
+            if args.threads_per_proc is None else args.threads_per_proc
+        launch(distributed_train_worker, __num_procs, (args, queue),
+               threads_per_proc=__threads_per_proc)
+        __throughput = queue.get()
+
+        # Throughput per process of the first (smallest) configuration
+        if __base_throughput is None:
+            __base_throughput = __throughput / __num_procs
+        __speedup = __throughput / __base_throughput
+        rows.append([__num_procs, __threads_per_proc,
+                     fmt(__throughput), fmt(__speedup),
+                     fmt(__speedup / __num_procs)])
+
+    print(f'MPNN (state_dim {args.state_dims[0]}), global batch size '
+          f'{args.batch_size}, {args.num_nodes} nodes per graph')
+    print_table(['num_procs', 'threads_per_proc', 'graphs/s',
+                 'speedup', 'efficiency'], rows)
+
+
+class RandomGraphDataset(torch.utils.data.Dataset):
+    """
+    Random molecule-like graphs generated on access, which stands in for
+    the featurization (SMILES to graph) cost of the dataloaders.
+    """
+
+    def __init__(self, num_graphs: int, args):
+        self.__num_graphs = num_graphs
+        self.__args = args
+
+    def __len__(self) -> int:
+        return self.__num_graphs
+
+    def __getitem__(self, index: int) -> pyg_data.Data:
+        __data = random_graph_batch(
+            1, self.__args.num_nodes, self.__args.node_attr_dim,
+            self.__args.edge_attr_dims[0],
+            num_edge_types=self.__args.num_edge_types).get_example(0)
+        __data.y = torch.randn(1, self.__args.num_dscrptr)
+        return __data
+
+
+def benchmark_lockstep(args, device: torch.device):
+    """
+    Aggregate training throughput of several MPNN configurations (sweep
+    trials with the state dimensions in --state_dims) trained one after
+    another, each with its own pass over the dataloader, versus trained
+    in lockstep with a single pass.
+    """
+
+    loader = pyg_data.DataLoader(
+        RandomGraphDataset(args.batch_size * args.num_iters, args),
+        batch_size=args.batch_size)
+
+    def __forward(model, data):
+        return model(data), data.y
+
+    def __members() -> List[LockstepMember]:
+        __member_list = []
+        for __state_dim in args.state_dims:
+            __model = MPNN(node_attr_dim=args.node_attr_dim,
+                           edge_attr_dim=args.edge_attr_dims[0],
+                           state_dim=__state_dim,
+                           num_conv=args.num_conv,
+                           out_dim=args.num_dscrptr)
+            __member_list.append(LockstepMember(
+                __model, torch.optim.RMSprop(__model.parameters(), lr=1e-4),
+                name=f'mpnn(state_dim={__state_dim})'))
+        return __member_list
+
+    # Sequential: a trainer (and a pass over the dataloader) per model
+    synchronize(device)
+    __start_time = time.perf_counter()
+    for __member in __members():
+        LockstepTrainer([__member], __forward, device=device).train_epoch(
+            loader)
+    synchronize(device)
+    __sequential_time = time.perf_counter() - __start_time
+
+    __trainer = LockstepTrainer(__members(), __forward, device=device)
+    synchronize(device)
+    __start_time = time.perf_counter()
+    __trainer.train_epoch(loader)
+    synchronize(device)
+    __lockstep_time = time.perf_counter() - __start_time
+
+    __num_samples = len(loader.dataset) * len(args.state_dims)
+    print(f'MPNN with state dimensions {args.state_dims}, batch size '
+          f'{args.batch_size}, {len(loader)} batches per epoch')
+    print_table(['method', 'seconds', 'samples/s', 'speedup'], [
+        ['sequential', fmt(__sequential_time),
+         fmt(__num_samples / __sequential_time), fmt(1.)],
+        ['lockstep', fmt(__lockstep_time),
+         fmt(__num_samples / __lockstep_time),
+         fmt(__sequential_time / __lockstep_time)], ])
+
+
+BENCHMARKS = {
+    'edge_gcn': benchmark_edge_gcn,
+    'edge_gat': benchmark_edge_gat,
+    'mpnn': benchmark_mpnn,
+    'ggnn': benchmark_ggnn,
+    'graph_conv': benchmark_graph_conv,
+    'transformer': benchmark_transformer,
+    'decoding': benchmark_decoding,
+    'simple_uno_export': benchmark_simple_uno_export,
+    'ensemble': benchmark_ensemble,
+    'drug_cache': benchmark_drug_cache,
+    'precision': benchmark_precision,
+    'compile': benchmark_compile,
+    'checkpointing': benchmark_checkpointing,
+    'distributed': benchmark_distributed,
+    'lockstep': benchmark_lockstep,
+}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Model benchmarks')
+
+    parser.add_argument('benchmark', type=str, choices=list(BENCHMARKS))
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--rand_state', type=int, default=0)
+    parser.add_argument('--num_iters', type=int, default=20)
+
+    # Synthetic graph arguments
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_nodes', type=int, default=32)
+    parser.add_argument('--node_attr_dim', type=int, default=64)
+    parser.add_argument('--max_num_atoms', type=int, default=128,
+                        help='padded graph size for the dense ggnn')
+    parser.add_argument('--num_seqs', type=int, default=4096,
+                        help='number of token sequences for the '
+                             'transformer benchmark')
+    parser.add_argument('--max_decode_length', type=int, default=64,
+                        help='maximum number of generated tokens for the '
+                             'decoding benchmark')
+    parser.add_argument('--graph_sizes', type=int, nargs='+',
+                        default=[8, 16, 32, 64, 128],
+                        help='number of nodes per graph for the graph_conv '
+                             'crossover benchmark')
+    parser.add_argument('--num_edge_types', type=int, default=8,
+                        help='number of distinct edge attribute vectors '
+                             'for the mpnn benchmark')
+
+    # Model arguments
+    parser.add_argument('--edge_attr_dims', type=int, nargs='+',
+                        default=[4, 8, 16])
+    parser.add_argument('--state_dims', type=int, nargs='+',
+                        default=[16, 64, 256])
+    parser.add_argument('--num_conv', type=int, default=2)
+    parser.add_argument('--num_heads', type=int, default=8)
+    parser.add_argument('--weight_rank', type=int, default=16)
+    parser.add_argument('--uno_state_dim', type=int, default=1024)
+    parser.add_argument('--num_dscrptr', type=int, default=100,
+                        help='output dimension of the encoders for the '
+                             'precision benchmark')
+    parser.add_argument('--recompile_limit', type=int, default=8,
+                        help='recompilation budget per frame for the '
+                             'compile benchmark')
+    parser.add_argument('--checkpoint_every', type=int, nargs='+',
+                        default=[1, 2],
+                        help='checkpoint block sizes for the checkpointing '
+                             'benchmark')
+    parser.add_argument('--memory_budget_mb', type=float, default=4096.,
+                        help='activation memory budget for the '
+                             'checkpointing benchmark')
+    parser.add_argument('--num_train_steps', type=int, default=200,
+                        help='training steps of the convergence check')
+    parser.add_argument('--batch_sizes', type=int, nargs='+',
+                        default=[1, 16, 128, 1024],
+                        help='inference batch sizes for simple_uno_export')
+    parser.add_argument('--ensemble_sizes', type=int, nargs='+',
+                        default=[1, 4, 16],
+                        help='numbers of SimpleUno models for the ensemble '
+                             'benchmark (with --uno_state_dim 256, etc.)')
+    parser.add_argument('--num_procs', type=int, nargs='+',
+                        default=[1, 2, 4],
+                        help='numbers of local processes for the '
+                             'distributed benchmark')
+    parser.add_argument('--threads_per_proc', type=int, default=None,
+                        help='intra-op threads per process for the '
+                             'distributed benchmark (cores / num_procs '
+                             'by default)')
+
+    args = parser.parse_args()
+    print('Benchmark Parameters:\n' + str(vars(args)))
+
+    seed_random_state(args.rand_state)
+    device = torch.device(args.device)
+    BENCHMARKS[args.benchmark](args, device)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,58 @@
-""" 
+"""
     File Name:          MoReL/molecule_generation.py
     Author:             Xiaotian Duan (xduan7)
     Email:              xduan7@uchicago.edu
     Date:               5/23/19
     Python Version:     3.5.4
-    File Description:   
+    File Description:
+
+        Evaluation of generative models with validity, uniqueness and
+        novelty scores (Guimaraes et al., 2017):
+            - validity:     valid / sampled
+            - uniqueness:   unique valid / valid
+            - novelty:      unique valid not in training set / unique valid
+
+        The sampler produces token batches in the main process, while the
+        SMILES strings are validated and canonicalized by a process pool
+        (RDKit does not release the GIL). The training molecules (SMILES
+        in the PubChem shards, canonicalized in the same way as the
+        samples) are kept as 64-bit hashes, either in a sorted array
+        (exact up to hash collisions) or in a Bloom filter (low memory
+        mode, with false positives that slightly underestimate the
+        novelty).
+
+        The sources are tokenized as Kekule SMILES, since the tokenizer
+        does not distinguish aromatic atoms (e.g. 'c' from 'C'), which
+        would make aromatic molecules invalid or different after
+        detokenization.
 
+        Usage:
+            python task/molecule_generation.py --model_path model.pt \\
+                --num_samples 100000 --top_k 10
 """
+import os
+import json
+import time
+import torch
+import hashlib
+import argparse
+import numpy as np
+from rdkit import Chem, RDLogger
+from collections import deque
+from typing import Iterable, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+
+import utils.dataset.config as c
+from network.transformer.decoding import top_k_sample
+from utils.dataset.featurizers import mol_to_tokens, tokens_to_smiles
+from utils.dataset.sharded_dataset import \
+    INDEX_FILE_NAME, decode_string, read_shard
+from utils.misc.random_seeding import seed_random_state
+
+RDLogger.logger().setLevel(RDLogger.CRITICAL)
+
+# Tokenization without aromatic atoms, which mol_to_tokens cannot tell
+TOKEN_SMILES_KWARGS = {'kekuleSmiles': True}
 
 ###############################################################################
 # Models
@@ -20,3 +66,286 @@
 # * MOSES
 # * Unique, valid, novel scores from Guimaraes et al., 2017
 ###############################################################################
+
+
+# Helper functions ############################################################
+def canonicalize(smiles_list: List[str]) -> List[Optional[str]]:
+    """
+    Canonical SMILES of a list of SMILES strings, or None for the invalid
+    ones. Runs in the worker processes, on a whole batch at a time to
+    amortize the inter-process communication.
+    """
+    ret = []
+    for __smiles in smiles_list:
+        __mol = Chem.MolFromSmiles(__smiles) if __smiles else None
+        ret.append(None if __mol is None else Chem.MolToSmiles(__mol))
+    return ret
+
+
+def hash_smiles(smiles_list: List[str]) -> np.array:
+    return np.array([int.from_bytes(
+        hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little')
+        for s in smiles_list], dtype=np.uint64)
+
+
+def hash_shard(shard_path: str) -> np.array:
+    """
+    Hashes of the canonical SMILES (see canonicalize) of the valid
+    molecules in a shard. Runs in the worker processes.
+    """
+    __columns = read_shard(shard_path)
+    __smiles = canonicalize(
+        [decode_string(__columns['smiles'], __columns['smiles_offsets'], __i)
+         for __i in range(len(__columns['cid']))])
+    return hash_smiles([s for s in __smiles if s is not None])
+
+
+# Reference sets ##############################################################
+class HashedSmilesSet:
+    """
+    Sorted array of 64-bit SMILES hashes (8 bytes per molecule).
+    """
+
+    def __init__(self, hashes: np.array):
+        self.__hashes = np.unique(hashes)
+
+    def __len__(self):
+        return len(self.__hashes)
+
+    def contains(self, hashes: np.array) -> np.array:
+        if len(self.__hashes) == 0:
+            return np.zeros(len(hashes), dtype=np.bool_)
+        __index = np.searchsorted(self.__hashes, hashes)
+        __index[__index == len(self.__hashes)] = 0
+        return self.__hashes[__index] == hashes
+
+
+class BloomFilter:
+    """
+    Bloom filter over 64-bit hashes with double hashing (the lower and
+    upper 32 bits of the hash), which takes about 1.2 bytes per molecule
+    for a false positive rate of 1e-3.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 1e-3):
+
+        self.__num_bits = max(int(np.ceil(
+            - capacity * np.log(error_rate) / np.log(2) ** 2)), 8)
+        self.__num_hashes = max(int(round(
+            self.__num_bits / max(capacity, 1) * np.log(2))), 1)
+        self.__bits = np.zeros((self.__num_bits + 7) // 8, dtype=np.uint8)
+
+    def __positions(self, hashes: np.array) -> np.array:
+        __h1 = hashes & np.uint64(0xffffffff)
+        __h2 = hashes >> np.uint64(32)
+        __i = np.arange(self.__num_hashes, dtype=np.uint64)
+        return (__h1[:, None] + __i[None, :] * __h2[:, None]) \
+            % np.uint64(self.__num_bits)
+
+    def add(self, hashes: np.array):
+        __positions = self.__positions(hashes).reshape(-1)
+        __masks = np.uint64(1) << (__positions & np.uint64(7))
+        np.bitwise_or.at(self.__bits, __positions >> np.uint64(3),
+                         __masks.astype(np.uint8))
+
+    def contains(self, hashes: np.array) -> np.array:
+        __positions = self.__positions(hashes)
+        __bits = (self.__bits[__positions >> np.uint64(3)] >>
+                  (__positions & np.uint64(7)).astype(np.uint8)) & 1
+        return __bits.all(axis=1)
+
+
+def load_reference(shard_dir: str,
+                   low_memory: bool = False,
+                   error_rate: float = 1e-3,
+                   num_workers: int = c.NUM_CORES):
+    """
+    Reference set of the training molecules from the SMILES in the shards
+    of a sharded dataset (see utils/dataset/pubchem_prep.py), which are
+    canonicalized (by a process pool) in the same way as the samples.
+    """
+
+    with open(os.path.join(shard_dir, INDEX_FILE_NAME)) as f:
+        index = json.load(f)
+
+    bloom_filter = BloomFilter(index['num_records'], error_rate) \
+        if low_memory else None
+    hash_list = []
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for __hashes in executor.map(
+                hash_shard, [os.path.join(shard_dir, s['name'])
+                             for s in index['shards']]):
+            if low_memory:
+                bloom_filter.add(__hashes)
+            else:
+                hash_list.append(__hashes)
+
+    if low_memory:
+        return bloom_filter
+    return HashedSmilesSet(np.concatenate(hash_list) if hash_list
+                           else np.array([], dtype=np.uint64))
+
+
+# Metrics #####################################################################
+class GenerationMetrics:
+    """
+    Streaming validity, uniqueness and novelty. Only the hashes of the
+    unique molecules are kept.
+    """
+
+    def __init__(self, reference=None):
+        self.__reference = reference
+        self.__unique_hashes = set()
+        self.num_samples = 0
+        self.num_valid = 0
+        self.num_novel = 0
+
+    def update(self, canonical_smiles: List[Optional[str]]):
+
+        self.num_samples += len(canonical_smiles)
+        __valid = [s for s in canonical_smiles if s is not None]
+        self.num_valid += len(__valid)
+
+        __new_hashes = []
+        for __hash in hash_smiles(__valid).tolist():
+            if __hash not in self.__unique_hashes:
+                self.__unique_hashes.add(__hash)
+                __new_hashes.append(__hash)
+
+        if (self.__reference is not None) and __new_hashes:
+            self.num_novel += int((~self.__reference.contains(
+                np.array(__new_hashes, dtype=np.uint64))).sum())
+
+    @property
+    def num_unique(self) -> int:
+        return len(self.__unique_hashes)
+
+    def result(self) -> dict:
+        ret = {
+            'num_samples': self.num_samples,
+            'validity': self.num_valid / max(self.num_samples, 1),
+            'uniqueness': self.num_unique / max(self.num_valid, 1), }
+        if self.__reference is not None:
+            ret['novelty'] = self.num_novel / max(self.num_unique, 1)
+        return ret
+
+
+def evaluate(token_batches: Iterable[torch.Tensor],
+             reference=None,
+             num_workers: int = c.NUM_CORES) -> dict:
+    """
+    Score the token batches from a sampler. The batches are detokenized
+    in the main process and validated in the process pool while the
+    sampler produces the next batches; the number of batches in flight
+    is bounded so that a slow pool applies back pressure to the sampler.
+    """
+
+    metrics = GenerationMetrics(reference)
+    max_num_pending = 2 * num_workers
+    pending = deque()
+    start_time = time.time()
+    wait_time = 0.
+
+    def __pop():
+        nonlocal wait_time
+        __wait_start_time = time.time()
+        __result = pending.popleft().result()
+        wait_time += time.time() - __wait_start_time
+        metrics.update(__result)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for __tokens in token_batches:
+            pending.append(
+                executor.submit(canonicalize, tokens_to_smiles(__tokens)))
+            while pending and (pending[0].done() or
+                               len(pending) > max_num_pending):
+                __pop()
+        while pending:
+            __pop()
+
+    ret = metrics.result()
+    ret['samples_per_second'] = \
+        metrics.num_samples / max(time.time() - start_time, 1e-9)
+    # Time that the sampler spent waiting for the metrics
+    ret['wait_seconds'] = wait_time
+    return ret
+
+
+def sample_token_batches(model: torch.nn.Module,
+                         src_tokens: torch.Tensor,
+                         batch_size: int,
+                         top_k: int,
+                         max_length: int,
+                         device: torch.device):
+    model.eval()
+    for __start in range(0, len(src_tokens), batch_size):
+        __src = src_tokens[__start: __start + batch_size].to(device)
+        yield top_k_sample(model, __src, k=top_k,
+                           max_length=max_length).cpu()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Molecule Generation Evaluation')
+
+    parser.add_argument('--model_path', type=str, required=True,
+                        help='path to a saved (torch.save) Transformer')
+    parser.add_argument('--shard_dir', type=str, default=c.PCBA_SHARD_DIR,
+                        help='sharded dataset of the training molecules')
+    parser.add_argument('--num_samples', type=int, default=10000)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--top_k', type=int, default=10)
+    parser.add_argument('--len_tokens', type=int, default=128)
+    parser.add_argument('--low_memory', action='store_true',
+                        help='use a Bloom filter for the novelty check')
+    parser.add_argument('--num_workers', type=int, default=c.NUM_CORES)
+
+    parser.add_argument('--no_cuda', action='store_true',
+                        help='disables CUDA inference')
+    parser.add_argument('--cuda_device', type=int, default=0,
+                        help='CUDA device ID')
+    parser.add_argument('--rand_state', type=int, default=0,
+                        help='random state of numpy/sklearn/pytorch')
+
+    args = parser.parse_args()
+    print('Evaluation Arguments:\n' + json.dumps(vars(args), indent=4))
+
+    use_cuda = torch.cuda.is_available() and (not args.no_cuda)
+    device = torch.device(f'cuda: {args.cuda_device}' if use_cuda else 'cpu')
+    seed_random_state(args.rand_state)
+
+    print('Preparing the reference set of training molecules ... ')
+    __start_time = time.time()
+    reference = load_reference(args.shard_dir, args.low_memory,
+                               num_workers=args.num_workers)
+    print(f'Reference set prepared in {time.time() - __start_time:.1f} s')
+
+    # The sources are random training molecules, which are only read from
+    # the first shard, as the number of samples is usually much smaller
+    with open(os.path.join(args.shard_dir, INDEX_FILE_NAME)) as f:
+        __shard_name = json.load(f)['shards'][0]['name']
+    __columns = read_shard(os.path.join(args.shard_dir, __shard_name))
+    __indices = np.random.randint(0, len(__columns['cid']),
+                                  size=args.num_samples)
+    src_tokens = []
+    for __i in __indices:
+        __tokens = mol_to_tokens(Chem.MolFromSmiles(decode_string(
+            __columns['smiles'], __columns['smiles_offsets'], __i)),
+            args.len_tokens, smiles_kwargs=TOKEN_SMILES_KWARGS)
+        if __tokens is not None:
+            src_tokens.append(__tokens.long())
+    src_tokens = torch.stack(src_tokens)
+
+    model = torch.load(args.model_path, map_location=device)
+    result = evaluate(
+        sample_token_batches(model, src_tokens, args.batch_size,
+                             args.top_k, args.len_tokens, device),
+        reference=reference,
+        num_workers=args.num_workers)
+    print(json.dumps(result, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+    File Name:          MoReL/cached_loader.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Cache of the collated batches of an evaluation dataloader (without
+        shuffling), for the validation and testing sets that are scored
+        every epoch but never change. The first pass iterates over the
+        dataloader as usual (featurization and collation) and keeps the
+        batches, and the following passes replay them.
+
+        The batches are kept in RAM up to a memory budget, and the rest
+        are spilled to a file (pickled one after another) if a spill
+        directory is given. Otherwise, the loader stops caching and
+        iterates over the dataloader every time.
+
+        The cache is invalidated if the signature of the dataset changes,
+        which is dataset.signature() if the dataset implements it (e.g.
+        GraphToDscrptrDataset), or the identity and the length of the
+        dataset otherwise.
+
+        Usage:
+            val_loader = CachedLoader(
+                pyg_data.DataLoader(val_dataset, batch_size=32),
+                memory_budget_mb=1024, spill_dir='/tmp')
+            for batch in val_loader:    # featurized and collated
+                ...
+            for batch in val_loader:    # replayed from the cache
+                ...
+"""
+import os
+import copy
+import torch
+import pickle
+import logging
+import tempfile
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def batch_nbytes(batch) -> int:
+    """
+    Number of bytes of the tensors in a batch (tensors, PyG batches, and
+    nested tuples, lists and dicts of them).
+    """
+    if isinstance(batch, torch.Tensor):
+        return batch.element_size() * batch.nelement()
+    if isinstance(batch, (tuple, list)):
+        return sum(batch_nbytes(b) for b in batch)
+    if isinstance(batch, dict):
+        return sum(batch_nbytes(v) for v in batch.values())
+    if hasattr(batch, 'to_dict'):
+        return batch_nbytes(batch.to_dict())
+    return 0
+
+
+class CachedLoader:
+
+    def __init__(self,
+                 loader: Iterable,
+                 memory_budget_mb: float = 1024.,
+                 spill_dir: Optional[str] = None):
+        """
+        :param loader: evaluation dataloader, which must iterate in the
+            same order every time (no shuffling)
+        :param memory_budget_mb: maximum size of the batches kept in RAM
+        :param spill_dir: directory of the spill file for the batches
+            beyond the memory budget (no spilling if None)
+        """
+
+        self.__loader = loader
+        self.__memory_budget = int(memory_budget_mb * 2 ** 20)
+        self.__spill_dir = spill_dir
+
+        self.__batches = []
+        self.__nbytes = 0
+        self.__spill_path = None
+        self.__num_spilled = 0
+        self.__signature = None
+        self.__cached = False
+        self.__disabled = False
+
+    def __len__(self) -> int:
+        return len(self.__loader)
+
+    @property
+    def dataset(self):
+        return getattr(self.__loader, 'dataset', None)
+
+    @property
+    def cached(self) -> bool:
+        """
+        Whether the next pass replays the batches from the cache.
+        """
+        return self.__cached and \
+            (self.__signature == self.__dataset_signature())
+
+    @property
+    def nbytes(self) -> int:
+        return self.__nbytes
+
+    @property
+    def num_spilled(self) -> int:
+        return self.__num_spilled
+
+    def __dataset_signature(self):
+        __dataset = self.dataset
+        if hasattr(__dataset, 'signature'):
+            return __dataset.signature()
+        return id(__dataset), (len(__dataset) if __dataset is not None else 0)
+
+    def invalidate(self):
+        self.__batches = []
+        self.__nbytes = 0
+        if self.__spill_path is not None:
+            os.remove(self.__spill_path)
+        self.__spill_path = None
+        self.__num_spilled = 0
+        self.__signature = None
+        self.__cached = False
+
+    def __iter__(self):
+        if self.cached:
+            return self.__replay()
+        self.invalidate()
+        return self.__iter_and_cache()
+
+    def __replay(self):
+        # Shallow copies, as moving a PyG batch to a device is in place
+        for __batch in self.__batches:
+            yield copy.copy(__batch)
+        if self.__num_spilled > 0:
+            with open(self.__spill_path, 'rb') as f:
+                for _ in range(self.__num_spilled):
+                    yield pickle.load(f)
+
+    def __iter_and_cache(self):
+
+        if self.__disabled:
+            yield from self.__loader
+            return
+
+        __signature = self.__dataset_signature()
+        __spill_file = None
+        __complete = False
+        try:
+            for __batch in self.__loader:
+                __nbytes = batch_nbytes(__batch)
+
+                if self.__nbytes + __nbytes <= self.__memory_budget and \
+                        __spill_file is None:
+                    self.__batches.append(__batch)
+                    self.__nbytes += __nbytes
+                    __batch = copy.copy(__batch)
+
+                elif self.__spill_dir is not None:
+                    if __spill_file is None:
+                        __spill_fd, self.__spill_path = tempfile.mkstemp(
+                            suffix='.pkl', dir=self.__spill_dir)
+                        __spill_file = os.fdopen(__spill_fd, 'wb')
+                    pickle.dump(__batch, __spill_file,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+                    self.__num_spilled += 1
+
+                elif not self.__disabled:
+                    logger.warning(
+                        f'Batches exceed the memory budget of the cache '
+                        f'({self.__memory_budget / 2 ** 20:.0f} MB) without '
+                        f'a spill directory. Caching is disabled.')
+                    self.__disabled = True
+                    self.__batches = []
+                    self.__nbytes = 0
+
+                yield __batch
+            __complete = not self.__disabled
+        finally:
+            if __spill_file is not None:
+                __spill_file.close()
+            if __complete:
+                self.__signature = __signature
+                self.__cached = True
+            else:
+                # Incomplete pass (e.g. breaking out of the loop)
+                self.invalidate()
+
+    def __del__(self):
+        try:
+            self.invalidate()
+        except (AttributeError, OSError):
+            pass
@@ -91,3 +91,13 @@ PCBA_CID_TARGET_D7DSCPTR_CSV_PATH = \
     join(PROCESSED_DATA_DIR, 'CID-target_DD(PCBA).csv')
 PCBA_CID_D7DSCPTR_CSV_PATH = \
     join(PROCESSED_DATA_DIR, 'CID-DD(PCBA).csv')
+
+# Gzipped raw files, which are streamed directly by the prep pipeline
+PCBA_CID_GZ_FILE_PATH = PCBA_CID_FILE_PATH + '.gz'
+CID_INCHI_GZ_FILE_PATH = CID_INCHI_FILE_PATH + '.gz'
+
+# Chunked intermediate outputs and sharded datasets (see sharded_dataset.py)
+PCBA_PREP_DIR = join(PROCESSED_DATA_DIR, 'PCBA-prep/')
+PC_PREP_DIR = join(PROCESSED_DATA_DIR, 'PC-prep/')
+PCBA_SHARD_DIR = join(PROCESSED_DATA_DIR, 'PCBA-shards/')
+PC_SHARD_DIR = join(PROCESSED_DATA_DIR, 'PC-shards/')
@@ -28,27 +28,32 @@ def create_dir():
         raise
 
 
-def download():
+def download(unpack: bool = True):
     """
-    Download and unpack if raw data does not exist.
+    Download and unpack if raw data does not exist. The gzipped files are
+    kept as they are if not unpack (see pubchem_prep.py).
     """
 
     # Take care of all the data directories
     create_dir()
 
     # All the CID in PCBA dataset
-    if not os.path.exists(c.PCBA_CID_FILE_PATH):
+    if not (os.path.exists(c.PCBA_CID_FILE_PATH) or
+            ((not unpack) and os.path.exists(c.PCBA_CID_GZ_FILE_PATH))):
         os.system('wget -r -nd -nc %s -P %s'
                   % (c.PCBA_CID_FTP_ADDRESS, c.RAW_DATA_DIR))
-        os.system('find %s -type f -iname \"*.gz\" -exec gunzip {} +' %
-                  c.RAW_DATA_DIR)
+        if unpack:
+            os.system('find %s -type f -iname \"*.gz\" -exec gunzip {} +' %
+                      c.RAW_DATA_DIR)
 
     # All the CID-InChI one-on-one lookup
-    if not os.path.exists(c.CID_INCHI_FILE_PATH):
+    if not (os.path.exists(c.CID_INCHI_FILE_PATH) or
+            ((not unpack) and os.path.exists(c.CID_INCHI_GZ_FILE_PATH))):
         os.system('wget -r -nd -nc %s -P %s'
                   % (c.CID_INCHI_FTP_ADDRESS, c.RAW_DATA_DIR))
-        os.system('find %s -type f -iname \"*.gz\" -exec gunzip {} +'
-                  % c.RAW_DATA_DIR)
+        if unpack:
+            os.system('find %s -type f -iname \"*.gz\" -exec gunzip {} +'
+                      % c.RAW_DATA_DIR)
 
     # CID-Dragon7 descriptor dataframe
     if not os.path.exists(c.PCBA_CID_D7_DSCPTR_FILE_PATH):
@@ -25,6 +25,7 @@ from sklearn.preprocessing import MinMaxScaler, StandardScaler, \
 import sys
 sys.path.extend(['/raid/xduan7/Projects/MoReL'])
 from utils.dataset.featurizers import mol_to_tokens, mol_to_graph
+from utils.dataset.embedding_store import EmbeddingStore
 # from utils.dataset.featurizers import mol_to_image, mol_to_jtnn
 
 # Suppress unnecessary RDkit warnings and errors
@@ -207,6 +208,8 @@ class DrugDataType(Enum):
     DRAGON7_ECFP = 'dragon7_ECFP'
     DRAGON7_DESCRIPTOR = 'dragon7_descriptors'
     MORDRED_DESCRIPTOR = 'mordred_descriptors'
+    # Embedding store (directory) of a pretrained graph encoder
+    GRAPH_EMBEDDING = 'graph_embeddings'
 
 
 class DrugFeatureType(Enum):
@@ -220,6 +223,7 @@ class DrugFeatureType(Enum):
     DRAGON7_ECFP = (DrugDataType.DRAGON7_ECFP, None)
     DRAGON7_DESCRIPTOR = (DrugDataType.DRAGON7_DESCRIPTOR, None)
     MORDRED_DESCRIPTOR = (DrugDataType.MORDRED_DESCRIPTOR, None)
+    GRAPH_EMBEDDING = (DrugDataType.GRAPH_EMBEDDING, None)
 
 
 class NanProcessing(Enum):
@@ -238,11 +242,17 @@ def load_drug_data(data_dir: str,
     data_type = DrugDataType(data_type)
     nan_processing = NanProcessing(nan_processing)
 
-    file_name = '_'.join(['combined', data_type.value]) + '.csv'
+    file_name = '_'.join(['combined', data_type.value])
+    if data_type != DrugDataType.GRAPH_EMBEDDING:
+        file_name += '.csv'
     file_path = os.path.join(data_dir, file_name)
 
     if os.path.exists(file_path):
-        drug_df = pd.read_csv(file_path, header=0, index_col=0)
+        if data_type == DrugDataType.GRAPH_EMBEDDING:
+            drug_df = EmbeddingStore(file_path).to_dataframe(
+                id_list if id_list else None)
+        else:
+            drug_df = pd.read_csv(file_path, header=0, index_col=0)
 
         if id_list:
             drug_df = drug_df[drug_df.index.isin(id_list)]
@@ -485,6 +495,13 @@ class DrugRespDataset(Dataset):
         self.__resp_array = resp_array
         self.__source_dict = deepcopy(DATA_SOURCE_DICT)
 
+        # Indices of drugs in the order of drug_dict, for the lookup of
+        # cached drug embeddings (DrugEmbeddingCache). Note that the name
+        # of the graph attribute (drug_idx) must not contain 'index', or
+        # PyG increments it by the number of nodes in batching
+        self.__drug_index_dict = {
+            d: torch.LongTensor([i]) for i, d in enumerate(drug_dict)}
+
         self.__aggregated = aggregated
         self.__graph_feature = graph_feature
 
@@ -543,6 +560,7 @@ class DrugRespDataset(Dataset):
             ret_data.cell_data = cell_data
             ret_data.target_data = target_data
             ret_data.dose_data = dose_data
+            ret_data.drug_idx = self.__drug_index_dict[drug_id]
 
             return ret_data
         else:
@@ -0,0 +1,182 @@
+"""
+    File Name:          MoReL/embedding_store.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        On-disk store of molecule embeddings (e.g. from the pooling layer
+        of the graph encoders trained in graph_to_dscrptr.py), keyed by
+        CIDs or drug IDs, so that the downstream tasks can reuse the
+        learned representations without featurizing molecules.
+
+        Layout of an embedding store directory:
+            embeddings.npy      [num_records, embedding_dim] float16/32
+            ids.npy             [total_length] uint8 (UTF-8 bytes)
+            id_offsets.npy      [num_records + 1] int64
+            meta.json           number of records, dimension and dtype
+
+        The embeddings are written into a memory-mapped .npy (allocated
+        for the maximum number of records, of which only the first
+        num_records rows are valid), and the directory is written into a
+        temporary directory and renamed when complete.
+
+        Usage:
+            with EmbeddingStoreWriter(store_dir, max_num_records) as w:
+                w.write(id_list, embedding_array)
+            store = EmbeddingStore(store_dir)
+            drug_df = store.to_dataframe(drug_id_list)
+"""
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from typing import List, Optional
+
+from utils.dataset.sharded_dataset import encode_strings, decode_string, \
+    write_json
+
+EMBEDDINGS_FILE_NAME = 'embeddings.npy'
+IDS_FILE_NAME = 'ids.npy'
+ID_OFFSETS_FILE_NAME = 'id_offsets.npy'
+META_FILE_NAME = 'meta.json'
+EMBEDDING_DTYPES = ['float16', 'float32']
+
+
+class EmbeddingStoreWriter:
+
+    def __init__(self,
+                 store_dir: str,
+                 max_num_records: int,
+                 dtype: str = 'float32'):
+
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f'Embedding dtype {dtype} is not supported.')
+
+        self.__store_dir = store_dir.rstrip('/')
+        self.__tmp_dir = self.__store_dir + '.tmp'
+        self.__max_num_records = max_num_records
+        self.__dtype = dtype
+
+        if os.path.exists(self.__tmp_dir):
+            shutil.rmtree(self.__tmp_dir)
+        os.makedirs(self.__tmp_dir)
+
+        # The memory-mapped array is allocated with the first batch, which
+        # gives the embedding dimension
+        self.__embeddings = None
+        self.__id_list = []
+
+    @property
+    def num_records(self) -> int:
+        return len(self.__id_list)
+
+    def write(self, id_list: List[str], embedding_array: np.array):
+
+        if self.__embeddings is None:
+            self.__embeddings = np.lib.format.open_memmap(
+                os.path.join(self.__tmp_dir, EMBEDDINGS_FILE_NAME),
+                mode='w+', dtype=self.__dtype,
+                shape=(self.__max_num_records, embedding_array.shape[1]))
+
+        __start = len(self.__id_list)
+        if __start + len(id_list) > self.__max_num_records:
+            raise ValueError(f'Number of records exceeds the maximum '
+                             f'({self.__max_num_records}).')
+        self.__embeddings[__start: __start + len(id_list)] = embedding_array
+        self.__id_list.extend([str(i) for i in id_list])
+
+    def close(self):
+
+        if self.__embeddings is None:
+            raise ValueError('No embeddings were written.')
+        self.__embeddings.flush()
+        __embedding_dim = self.__embeddings.shape[1]
+        del self.__embeddings
+        self.__embeddings = None
+
+        __id_data, __id_offsets = encode_strings(self.__id_list)
+        np.save(os.path.join(self.__tmp_dir, IDS_FILE_NAME), __id_data)
+        np.save(os.path.join(self.__tmp_dir, ID_OFFSETS_FILE_NAME),
+                __id_offsets)
+        write_json(os.path.join(self.__tmp_dir, META_FILE_NAME), {
+            'num_records': len(self.__id_list),
+            'embedding_dim': __embedding_dim,
+            'dtype': self.__dtype, })
+
+        if os.path.exists(self.__store_dir):
+            shutil.rmtree(self.__store_dir)
+        os.replace(self.__tmp_dir, self.__store_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__embeddings = None
+            shutil.rmtree(self.__tmp_dir, ignore_errors=True)
+
+
+class EmbeddingStore:
+
+    def __init__(self, store_dir: str, mmap: bool = True):
+
+        with open(os.path.join(store_dir, META_FILE_NAME), 'r') as f:
+            self.__meta = json.load(f)
+        __num_records = self.__meta['num_records']
+
+        self.__embeddings = np.load(
+            os.path.join(store_dir, EMBEDDINGS_FILE_NAME),
+            mmap_mode='r' if mmap else None)[: __num_records]
+
+        __id_data = np.load(os.path.join(store_dir, IDS_FILE_NAME))
+        __id_offsets = np.load(os.path.join(store_dir, ID_OFFSETS_FILE_NAME))
+        self.__ids = [decode_string(__id_data, __id_offsets, i)
+                      for i in range(__num_records)]
+        self.__id_index_dict = {i: __index
+                                for __index, i in enumerate(self.__ids)}
+
+    def __len__(self) -> int:
+        return len(self.__ids)
+
+    def __contains__(self, id_: str) -> bool:
+        return str(id_) in self.__id_index_dict
+
+    def __getitem__(self, id_: str) -> np.array:
+        return self.__embeddings[self.__id_index_dict[str(id_)]]
+
+    @property
+    def ids(self) -> List[str]:
+        return self.__ids
+
+    @property
+    def embedding_dim(self) -> int:
+        return self.__meta['embedding_dim']
+
+    @property
+    def embeddings(self) -> np.array:
+        return self.__embeddings
+
+    def get(self, id_list: List[str]) -> np.array:
+        """
+        Embeddings of the given IDs (which must be in the store), in the
+        same order.
+        """
+        __indices = np.array([self.__id_index_dict[str(i)] for i in id_list],
+                             dtype=np.int64)
+        return self.__embeddings[__indices]
+
+    def to_dataframe(self,
+                     id_list: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Float32 dataframe of the embeddings indexed by IDs, like the drug
+        feature dataframes; IDs that are not in the store are skipped.
+        """
+        __ids = self.__ids if id_list is None else \
+            [str(i) for i in id_list if str(i) in self.__id_index_dict]
+        return pd.DataFrame(self.get(__ids).astype(np.float32),
+                            index=__ids)
@@ -0,0 +1,443 @@
+"""
+    File Name:          MoReL/feature_broadcast.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Featurize once, train many times.
+
+        A single producer process iterates through a dataset in a seeded
+        (deterministic) order, collates the batches and publishes them into
+        a ring buffer of fixed-size slots in shared memory. Any number of
+        consumer (trainer) processes read the very same stream of batches.
+        The producer blocks whenever the slowest consumer is num_slots
+        batches behind, so the memory footprint is bounded.
+
+        Usage:
+            broadcaster = FeatureBroadcaster(dataset, num_consumers=4, ...)
+            broadcaster.start()
+            # Pass broadcaster.get_consumer(i) to the i-th trainer process,
+            # which then uses it like a dataloader:
+            #     for batch in consumer: ...
+            broadcaster.join()
+"""
+import sys
+import time
+import pickle
+import logging
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from typing import Optional
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
+
+logger = logging.getLogger(__name__)
+
+# Status of the producer, stored in the shared header
+_RUNNING, _FINISHED, _FAILED = 0, 1, -1
+
+# Cursor of a consumer that has detached from the stream
+_DETACHED = np.iinfo(np.int64).max
+
+
+# Helper functions ############################################################
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # Python 3.13+ is able to skip the resource tracker for attached blocks
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    # Older versions register attached blocks with the resource tracker,
+    # which unlinks the block of the producer when this process exits
+    shm = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _header_views(buf, num_slots: int, num_consumers: int):
+    """
+    Header of the ring buffer (all int64):
+        [slot sequence numbers | slot payload lengths | consumer cursors |
+         total number of published batches, producer status]
+    """
+    header = np.ndarray(shape=(2 * num_slots + num_consumers + 2, ),
+                        dtype=np.int64, buffer=buf)
+    seqs = header[:num_slots]
+    lengths = header[num_slots: 2 * num_slots]
+    cursors = header[2 * num_slots: 2 * num_slots + num_consumers]
+    meta = header[2 * num_slots + num_consumers:]
+    return seqs, lengths, cursors, meta
+
+
+def _produce(dataset: Dataset,
+             loader_kwargs: dict,
+             num_epochs: int,
+             rand_state: int,
+             header_name: str,
+             data_name: str,
+             num_slots: int,
+             slot_size: int,
+             num_consumers: int,
+             condition):
+
+    header_shm, data_shm = _attach(header_name), _attach(data_name)
+    seqs, lengths, cursors, meta = \
+        _header_views(header_shm.buf, num_slots, num_consumers)
+
+    # The generator makes the order of batches (and the seeds of the
+    # dataloader workers) identical for the same random state
+    generator = torch.Generator()
+    generator.manual_seed(rand_state)
+    loader = DataLoader(dataset, generator=generator, **loader_kwargs)
+
+    seq, status = 0, _FAILED
+    try:
+        for _ in range(num_epochs):
+            for batch in loader:
+
+                payload = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+                if len(payload) > slot_size:
+                    raise ValueError(
+                        f'Collated batch of {len(payload)} bytes does not '
+                        f'fit into a slot of {slot_size} bytes. Please '
+                        f'increase the slot size of the broadcaster.')
+
+                # Back-pressure: wait until all the consumers have read the
+                # batch that previously occupied this slot
+                slot = seq % num_slots
+                with condition:
+                    condition.wait_for(
+                        lambda: cursors.min() > seq - num_slots)
+
+                    # Stop featurizing if every consumer has detached
+                    if cursors.min() == _DETACHED:
+                        status = _FINISHED
+                        return
+
+                # No consumer reads this slot before the new sequence number
+                # is published, so the copy can happen outside of the lock
+                offset = slot * slot_size
+                data_shm.buf[offset: offset + len(payload)] = payload
+
+                with condition:
+                    lengths[slot] = len(payload)
+                    seqs[slot] = seq
+                    condition.notify_all()
+                seq += 1
+
+        status = _FINISHED
+    finally:
+        with condition:
+            meta[0], meta[1] = seq, status
+            condition.notify_all()
+        del seqs, lengths, cursors, meta
+        header_shm.close()
+        data_shm.close()
+
+
+# Broadcaster and consumer ####################################################
+class BroadcastConsumer:
+    """
+    Read-only view of the batch stream for a single trainer process.
+    Iterating through a consumer yields one epoch worth of batches.
+    """
+
+    def __init__(self,
+                 consumer_id: int,
+                 header_name: str,
+                 data_name: str,
+                 num_slots: int,
+                 slot_size: int,
+                 num_consumers: int,
+                 batches_per_epoch: int,
+                 condition):
+
+        self.__consumer_id = consumer_id
+        self.__header_name = header_name
+        self.__data_name = data_name
+        self.__num_slots = num_slots
+        self.__slot_size = slot_size
+        self.__num_consumers = num_consumers
+        self.__batches_per_epoch = batches_per_epoch
+        self.__condition = condition
+
+        # Shared memory handles, attached lazily in the consumer process
+        self.__shm = None
+        self.__views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_BroadcastConsumer__shm'] = None
+        state['_BroadcastConsumer__views'] = None
+        return state
+
+    def __len__(self):
+        return self.__batches_per_epoch
+
+    def __iter__(self):
+        for _ in range(self.__batches_per_epoch):
+            batch = self.__next_batch()
+            if batch is None:
+                return
+            yield batch
+
+    def __attach(self):
+        if self.__shm is None:
+            self.__shm = (_attach(self.__header_name),
+                          _attach(self.__data_name))
+            self.__views = _header_views(self.__shm[0].buf,
+                                         self.__num_slots,
+                                         self.__num_consumers)
+
+    def __next_batch(self):
+
+        self.__attach()
+        seqs, lengths, cursors, meta = self.__views
+
+        cursor = int(cursors[self.__consumer_id])
+        if cursor == _DETACHED:
+            raise RuntimeError(f'Consumer {self.__consumer_id} has already '
+                               f'been closed.')
+        slot = cursor % self.__num_slots
+
+        with self.__condition:
+            self.__condition.wait_for(
+                lambda: (seqs[slot] == cursor) or (meta[1] != _RUNNING))
+
+            if seqs[slot] != cursor:
+                if meta[1] == _FAILED:
+                    raise RuntimeError('Feature broadcast producer failed.')
+                # Producer has finished and there is nothing left
+                return None
+            length = int(lengths[slot])
+
+        # The producer will not overwrite the slot before the cursor moves
+        offset = slot * self.__slot_size
+        payload = bytes(self.__shm[1].buf[offset: offset + length])
+
+        with self.__condition:
+            cursors[self.__consumer_id] = cursor + 1
+            self.__condition.notify_all()
+
+        return pickle.loads(payload)
+
+    def close(self):
+        """
+        Detach from the stream (e.g. early stopping), so that the producer
+        no longer waits for this consumer.
+        """
+        self.__attach()
+        with self.__condition:
+            self.__views[2][self.__consumer_id] = _DETACHED
+            self.__condition.notify_all()
+
+        self.__views = None
+        for shm in self.__shm:
+            shm.close()
+        self.__shm = None
+
+
+class FeatureBroadcaster:
+
+    def __init__(self,
+                 dataset: Dataset,
+                 num_consumers: int,
+                 batch_size: int = 32,
+                 collate_fn: callable = None,
+                 num_epochs: int = 1,
+                 num_slots: int = 8,
+                 slot_size: int = 2 ** 24,
+                 shuffle: bool = True,
+                 drop_last: bool = False,
+                 num_workers: int = 0,
+                 rand_state: int = 0,
+                 mp_context: Optional[str] = None):
+
+        if num_slots < 1 or num_consumers < 1:
+            raise ValueError('The broadcaster requires at least one slot '
+                             'and one consumer.')
+
+        self.__dataset = dataset
+        self.__num_consumers = num_consumers
+        self.__num_epochs = num_epochs
+        self.__num_slots = num_slots
+        self.__slot_size = slot_size
+        self.__rand_state = rand_state
+        self.__ctx = mp.get_context(mp_context)
+
+        self.__loader_kwargs = {
+            'batch_size': batch_size,
+            'shuffle': shuffle,
+            'drop_last': drop_last,
+            'num_workers': num_workers,
+            'collate_fn': default_collate if collate_fn is None
+            else collate_fn, }
+
+        self.__batches_per_epoch = (len(dataset) // batch_size) if drop_last \
+            else int(np.ceil(len(dataset) / batch_size))
+
+        # Shared memory blocks for header and data, and the condition that
+        # protects the header
+        __header_size = \
+            (2 * num_slots + num_consumers + 2) * np.dtype(np.int64).itemsize
+        self.__header_shm = shared_memory.SharedMemory(
+            create=True, size=__header_size)
+        self.__data_shm = shared_memory.SharedMemory(
+            create=True, size=num_slots * slot_size)
+
+        seqs, lengths, cursors, meta = _header_views(
+            self.__header_shm.buf, num_slots, num_consumers)
+        seqs[:], lengths[:], cursors[:] = -1, 0, 0
+        meta[0], meta[1] = -1, _RUNNING
+        del seqs, lengths, cursors, meta
+
+        self.__condition = self.__ctx.Condition()
+        self.__producer = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def batches_per_epoch(self) -> int:
+        return self.__batches_per_epoch
+
+    def start(self):
+        # Note that the producer is not daemonic, otherwise it cannot use
+        # dataloader workers for featurization
+        self.__producer = self.__ctx.Process(
+            target=_produce,
+            args=(self.__dataset,
+                  self.__loader_kwargs,
+                  self.__num_epochs,
+                  self.__rand_state,
+                  self.__header_shm.name,
+                  self.__data_shm.name,
+                  self.__num_slots,
+                  self.__slot_size,
+                  self.__num_consumers,
+                  self.__condition))
+        self.__producer.start()
+
+    def get_consumer(self, consumer_id: int) -> BroadcastConsumer:
+        if not (0 <= consumer_id < self.__num_consumers):
+            raise IndexError(f'Consumer ID {consumer_id} out of range '
+                             f'[0, {self.__num_consumers})')
+        return BroadcastConsumer(consumer_id=consumer_id,
+                                 header_name=self.__header_shm.name,
+                                 data_name=self.__data_shm.name,
+                                 num_slots=self.__num_slots,
+                                 slot_size=self.__slot_size,
+                                 num_consumers=self.__num_consumers,
+                                 batches_per_epoch=self.__batches_per_epoch,
+                                 condition=self.__condition)
+
+    def join(self, timeout: Optional[float] = None):
+        if self.__producer is not None:
+            self.__producer.join(timeout)
+
+    def close(self):
+        if (self.__producer is not None) and self.__producer.is_alive():
+            self.__producer.terminate()
+            self.__producer.join()
+        self.__producer = None
+
+        for __shm in (self.__header_shm, self.__data_shm):
+            __shm.close()
+            try:
+                # Attaching (before Python 3.13) unregisters the block, so
+                # register it again for unlink to unregister
+                if sys.version_info < (3, 13):
+                    resource_tracker.register(__shm._name, 'shared_memory')
+                __shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+# Testing segment for featurization cost with multiple training processes
+# The output follows the format of the 'computing' method in README.md
+if __name__ == '__main__':
+
+    import torch.nn.functional as F
+    import torch_geometric.data as pyg_data
+
+    # Run from the project directory: python -m utils.dataset.feature_broadcast
+    import utils.dataset.config as c
+    from network.gnn.mpnn.mpnn import MPNN
+    from utils.dataset.graph_to_dscrptr_dataset import \
+        GraphToDscrptrDataset, load_cid_smiles_dict, load_cid_dscrptr_dict
+
+    NUM_PROCESSES = 2
+    NUM_BATCHES = 2048
+    BATCH_SIZE = 32
+    TARGET_LIST = c.TARGET_D7_DSCRPTR_NAMES
+
+    def __train(process_id, loader):
+
+        torch.set_num_threads(1)
+        model = MPNN(node_attr_dim=loader_dataset.node_attr_dim,
+                     edge_attr_dim=loader_dataset.edge_attr_dim,
+                     out_dim=len(TARGET_LIST))
+        optimizer = torch.optim.RMSprop(model.parameters(), lr=5e-4)
+
+        trn_time, start_time = 0., time.time()
+        for i, data in enumerate(loader):
+            if i >= NUM_BATCHES:
+                break
+            __step_start_time = time.time()
+            optimizer.zero_grad()
+            loss = F.mse_loss(model(data), data.y.view(-1, len(TARGET_LIST)))
+            loss.backward()
+            optimizer.step()
+            trn_time += time.time() - __step_start_time
+
+        if isinstance(loader, BroadcastConsumer):
+            loader.close()
+
+        ttl_time = time.time() - start_time
+        print(f'[Process {process_id}] Training Utilization = '
+              f'{100. * trn_time / ttl_time:.2f}% '
+              f'({int(trn_time * 1e3)} msec / {int(ttl_time * 1e3)} msec)')
+
+    # Same dictionaries and CIDs as in task/graph_to_dscrptr.py
+    cid_smiles_dict = load_cid_smiles_dict()
+    cid_dscrptr_dict, _, _ = load_cid_dscrptr_dict(TARGET_LIST)
+    loader_dataset = GraphToDscrptrDataset(
+        target_list=TARGET_LIST,
+        cid_list=sorted(list(set(cid_smiles_dict.keys()) &
+                             set(cid_dscrptr_dict.keys())), key=int),
+        cid_smiles_dict=cid_smiles_dict,
+        cid_dscrptr_dict=cid_dscrptr_dict)
+
+    print('#' * 80)
+    print('Getting features with computing method ... ')
+    processes = [mp.Process(target=__train, args=(
+        i, pyg_data.DataLoader(loader_dataset, batch_size=BATCH_SIZE,
+                               shuffle=True)))
+                 for i in range(NUM_PROCESSES)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    print('#' * 80)
+    print('Getting features with broadcast method ... ')
+    with FeatureBroadcaster(loader_dataset,
+                            num_consumers=NUM_PROCESSES,
+                            batch_size=BATCH_SIZE,
+                            collate_fn=pyg_data.Batch.from_data_list,
+                            num_workers=1) as broadcaster:
+        processes = [mp.Process(target=__train,
+                                args=(i, broadcaster.get_consumer(i)))
+                     for i in range(NUM_PROCESSES)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
@@ -0,0 +1,408 @@
+"""
+    File Name:          MoReL/featurization_job.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Multi-node featurization of a sharded dataset (see
+        sharded_dataset.py), coordinated only through a shared filesystem.
+
+        Commands:
+            plan        split the source shards into work units of CID
+                        ranges and write the manifest
+            work        claim and featurize work units until none is
+                        left; run this on as many nodes as available
+            merge       build the global index over the output shards
+
+        Job directory layout:
+            manifest.json           source, featurizer settings and units
+            locks/unit_00000.lock   claimed unit, with a heartbeat (mtime)
+            done/unit_00000.json    finished unit and its output shard
+
+        A unit is claimed by creating its lock file exclusively. The owner
+        touches the lock file periodically, and a lock whose heartbeat is
+        older than the stale timeout is re-claimed by renaming it away.
+        Output shards are deterministic and written atomically, so in the
+        rare case that a unit is processed twice the result is the same.
+
+        Usage (e.g. in a batch job array):
+            python -m utils.dataset.featurization_job plan \\
+                --source_dir <shards> --job_dir <job>
+            python -m utils.dataset.featurization_job work --job_dir <job>
+            python -m utils.dataset.featurization_job merge --job_dir <job>
+"""
+import os
+import json
+import time
+import socket
+import logging
+import argparse
+import threading
+import numpy as np
+import multiprocessing
+from rdkit import Chem, RDLogger
+from typing import Optional
+
+import utils.dataset.config as c
+from utils.dataset.featurizers import mol_to_graph, graph_feat_dims
+from utils.dataset.sharded_dataset import \
+    INDEX_FILE_NAME, SHARD_NAME_FORMAT, decode_string, write_json, \
+    write_shard, read_shard, build_index, encode_graphs
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = 'manifest.json'
+UNIT_NAME_FORMAT = 'unit_%05d'
+
+
+# Manifest ####################################################################
+def plan(job_dir: str,
+         source_dir: str,
+         output_dir: Optional[str] = None,
+         unit_size: int = 2 ** 14,
+         master_atom: bool = True,
+         master_bond: bool = True,
+         max_num_atoms: int = 128,
+         atom_feat_list: list = None,
+         bond_feat_list: list = None) -> dict:
+    """
+    Split the source shards into work units of at most unit_size records.
+    Source shards are ordered by CID, so every unit covers a CID range.
+    """
+
+    if os.path.exists(os.path.join(job_dir, MANIFEST_FILE_NAME)):
+        raise FileExistsError(f'Job {job_dir} has already been planned.')
+
+    with open(os.path.join(source_dir, INDEX_FILE_NAME)) as f:
+        index = json.load(f)
+
+    units = []
+    for __shard in index['shards']:
+        __cid = read_shard(os.path.join(source_dir, __shard['name']))['cid']
+        for __start in range(0, __shard['num_records'], unit_size):
+            __stop = min(__start + unit_size, __shard['num_records'])
+            units.append({'unit': len(units),
+                          'shard': __shard['name'],
+                          'start': __start,
+                          'stop': __stop,
+                          'cid_min': int(__cid[__start: __stop].min()),
+                          'cid_max': int(__cid[__start: __stop].max()), })
+
+    manifest = {
+        'source_dir': os.path.abspath(source_dir),
+        'output_dir': os.path.abspath(
+            output_dir if output_dir else os.path.join(job_dir, 'shards')),
+        'target_list': index['target_list'],
+        'featurizer': {
+            'master_atom': master_atom,
+            'master_bond': master_bond,
+            'max_num_atoms': max_num_atoms,
+            'atom_feat_list': atom_feat_list,
+            'bond_feat_list': bond_feat_list, },
+        'units': units, }
+
+    os.makedirs(os.path.join(job_dir, 'locks'), exist_ok=True)
+    os.makedirs(os.path.join(job_dir, 'done'), exist_ok=True)
+    os.makedirs(manifest['output_dir'], exist_ok=True)
+    write_json(os.path.join(job_dir, MANIFEST_FILE_NAME), manifest)
+    logger.info(f'Planned {len(units)} work units over '
+                f'{index["num_records"]} records.')
+    return manifest
+
+
+def load_manifest(job_dir: str) -> dict:
+    with open(os.path.join(job_dir, MANIFEST_FILE_NAME)) as f:
+        return json.load(f)
+
+
+# Claiming and heartbeat ######################################################
+class UnitLock:
+    """
+    Exclusive claim of a work unit through a lock file on the shared
+    filesystem, kept alive by a heartbeat thread while the unit is being
+    processed.
+
+    with UnitLock(lock_path, owner, stale_timeout) as lock:
+        if lock.acquired:
+            ...
+    """
+
+    def __init__(self,
+                 lock_path: str,
+                 owner: str,
+                 stale_timeout: float = 600.,
+                 heartbeat_interval: float = 60.):
+
+        self.__lock_path = lock_path
+        self.__owner = owner
+        self.__stale_timeout = stale_timeout
+        self.__heartbeat_interval = heartbeat_interval
+
+        self.__stop_event = threading.Event()
+        self.__heartbeat_thread = None
+        self.acquired = False
+
+    def __enter__(self):
+        self.acquired = self.__try_create() or self.__try_reclaim()
+        if self.acquired:
+            self.__heartbeat_thread = threading.Thread(
+                target=self.__heartbeat, daemon=True)
+            self.__heartbeat_thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.acquired:
+            return
+        self.__stop_event.set()
+        self.__heartbeat_thread.join()
+        # Only remove the lock if it has not been re-claimed by others
+        if self.__read_owner(self.__lock_path) == self.__owner:
+            try:
+                os.remove(self.__lock_path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def __read_owner(path: str) -> Optional[str]:
+        try:
+            with open(path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def __try_create(self) -> bool:
+        try:
+            fd = os.open(self.__lock_path,
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.__owner)
+        return True
+
+    def __try_reclaim(self) -> bool:
+
+        stale_owner = self.__read_owner(self.__lock_path)
+        try:
+            age = time.time() - os.path.getmtime(self.__lock_path)
+        except FileNotFoundError:
+            return self.__try_create()
+        if age < self.__stale_timeout:
+            return False
+
+        # Renaming is atomic: only one of the competing workers gets the
+        # stale lock, the others get FileNotFoundError
+        stale_path = f'{self.__lock_path}.stale.{self.__owner}'
+        try:
+            os.rename(self.__lock_path, stale_path)
+        except FileNotFoundError:
+            return False
+
+        # Between reading and renaming, another worker might have
+        # re-claimed the lock already. Put it back (without overwriting)
+        if self.__read_owner(stale_path) != stale_owner:
+            try:
+                os.link(stale_path, self.__lock_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+
+        os.remove(stale_path)
+        logger.warning(f'Re-claimed {self.__lock_path} from {stale_owner} '
+                       f'(heartbeat expired {age:.0f} seconds ago).')
+        return self.__try_create()
+
+    def __heartbeat(self):
+        while not self.__stop_event.wait(self.__heartbeat_interval):
+            if self.__read_owner(self.__lock_path) != self.__owner:
+                logger.warning(f'Lost {self.__lock_path} to another worker.')
+                return
+            os.utime(self.__lock_path)
+
+
+# Featurization ###############################################################
+def featurize_unit(manifest: dict, unit: dict) -> dict:
+    """
+    Featurize a single work unit and write the valid molecules together
+    with their graphs into an output shard named after the unit.
+    """
+
+    columns = read_shard(os.path.join(manifest['source_dir'], unit['shard']))
+
+    cid_list, smiles_list, target_list, graph_list = [], [], [], []
+    for __i in range(unit['start'], unit['stop']):
+        __smiles = decode_string(
+            columns['smiles'], columns['smiles_offsets'], __i)
+        __mol = Chem.MolFromSmiles(__smiles)
+        if __mol is None:
+            continue
+        __graph = mol_to_graph(mol=__mol, **manifest['featurizer'])
+        if __graph is None:
+            continue
+
+        cid_list.append(int(columns['cid'][__i]))
+        smiles_list.append(__smiles)
+        target_list.append(np.array(columns['target'][__i]))
+        graph_list.append(__graph)
+
+    shard_name = None
+    if len(graph_list) > 0:
+        shard_name = SHARD_NAME_FORMAT % unit['unit']
+        write_shard(os.path.join(manifest['output_dir'], shard_name),
+                    cid_array=np.array(cid_list, dtype=np.int64),
+                    smiles_list=smiles_list,
+                    target_array=np.array(target_list, dtype=np.float32),
+                    **encode_graphs(graph_list, *graph_feat_dims(
+                        **manifest['featurizer'])))
+
+    return {'shard': shard_name,
+            'num_input': unit['stop'] - unit['start'],
+            'num_records': len(graph_list), }
+
+
+def work(job_dir: str,
+         worker_id: Optional[str] = None,
+         stale_timeout: float = 600.,
+         heartbeat_interval: float = 60.,
+         poll_interval: float = 60.):
+    """
+    Claim and featurize work units until all of them are done. Units that
+    are locked by others are revisited after poll_interval, in case their
+    owner dies and the locks become stale.
+    """
+
+    RDLogger.logger().setLevel(RDLogger.CRITICAL)
+
+    manifest = load_manifest(job_dir)
+    units = manifest['units']
+    if worker_id is None:
+        worker_id = f'{socket.gethostname()}-{os.getpid()}'
+
+    # Start at different units to reduce the contention on the locks
+    __offset = np.random.default_rng(
+        list(worker_id.encode('utf-8'))).integers(max(len(units), 1))
+    order = [units[(__offset + i) % len(units)] for i in range(len(units))]
+
+    num_done = 0
+    start_time = time.time()
+    while True:
+        num_pending = 0
+        for __unit in order:
+            __unit_name = UNIT_NAME_FORMAT % __unit['unit']
+            __done_path = os.path.join(job_dir, 'done', __unit_name + '.json')
+            if os.path.exists(__done_path):
+                continue
+
+            with UnitLock(os.path.join(job_dir, 'locks',
+                                       __unit_name + '.lock'),
+                          owner=worker_id,
+                          stale_timeout=stale_timeout,
+                          heartbeat_interval=heartbeat_interval) as lock:
+
+                # The unit might have been finished before the claim
+                if (not lock.acquired) or os.path.exists(__done_path):
+                    num_pending += (not lock.acquired)
+                    continue
+
+                __result = featurize_unit(manifest, __unit)
+                write_json(__done_path, {**__result, 'worker': worker_id})
+
+            num_done += 1
+            logger.info(f'{worker_id} finished {__unit_name} '
+                        f'({__result["num_records"]}/'
+                        f'{__result["num_input"]} molecules, '
+                        f'{num_done} units in '
+                        f'{time.time() - start_time:.1f} seconds)')
+
+        if num_pending == 0:
+            break
+        time.sleep(poll_interval)
+
+    logger.info(f'{worker_id} exited after finishing {num_done} units.')
+
+
+def merge(job_dir: str) -> dict:
+    """
+    Build the global index (including target mean/std) over the output
+    shards after all the units are done.
+    """
+
+    manifest = load_manifest(job_dir)
+    shard_names = []
+    for __unit in manifest['units']:
+        __done_path = os.path.join(job_dir, 'done', (UNIT_NAME_FORMAT %
+                                                     __unit['unit']) + '.json')
+        if not os.path.exists(__done_path):
+            raise RuntimeError(f'Unit {__unit["unit"]} is not done yet.')
+        with open(__done_path) as f:
+            __shard_name = json.load(f)['shard']
+        if __shard_name is not None:
+            shard_names.append(__shard_name)
+
+    index = build_index(manifest['output_dir'],
+                        manifest['target_list'],
+                        shard_names,
+                        extra_info={'featurizer': manifest['featurizer']})
+    logger.info(f'Merged {index["num_records"]} molecules in '
+                f'{len(shard_names)} shards into {manifest["output_dir"]}.')
+    return index
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Multi-node featurization over a shared filesystem')
+
+    parser.add_argument('command', type=str,
+                        choices=['plan', 'work', 'merge'])
+    parser.add_argument('--job_dir', type=str, required=True)
+
+    # Arguments for planning
+    parser.add_argument('--source_dir', type=str, default=c.PCBA_SHARD_DIR)
+    parser.add_argument('--output_dir', type=str, default=None)
+    parser.add_argument('--unit_size', type=int, default=2 ** 14)
+    parser.add_argument('--max_num_atoms', type=int, default=128)
+    parser.add_argument('--no_master_atom', action='store_true')
+    parser.add_argument('--no_master_bond', action='store_true')
+
+    # Arguments for working
+    parser.add_argument('--num_workers', type=int, default=c.NUM_CORES,
+                        help='number of worker processes on this node')
+    parser.add_argument('--stale_timeout', type=float, default=600.)
+    parser.add_argument('--heartbeat_interval', type=float, default=60.)
+    parser.add_argument('--poll_interval', type=float, default=60.)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'plan':
+        plan(args.job_dir,
+             source_dir=args.source_dir,
+             output_dir=args.output_dir,
+             unit_size=args.unit_size,
+             master_atom=not args.no_master_atom,
+             master_bond=not args.no_master_bond,
+             max_num_atoms=args.max_num_atoms)
+
+    elif args.command == 'work':
+        # Every process on the node claims units on its own
+        __kwargs = {'stale_timeout': args.stale_timeout,
+                    'heartbeat_interval': args.heartbeat_interval,
+                    'poll_interval': args.poll_interval}
+        processes = [multiprocessing.Process(
+            target=work, args=(args.job_dir, ), kwargs=__kwargs)
+            for _ in range(args.num_workers)]
+        for __p in processes:
+            __p.start()
+        for __p in processes:
+            __p.join()
+
+    else:
+        merge(args.job_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,7 @@ import re
 import torch
 import logging
 import numpy as np
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 from itertools import product, combinations_with_replacement
 
 from joblib import Parallel, delayed
@@ -303,6 +303,12 @@ def mol_to_smiles(mol: Chem.Mol,
                   smiles_kwargs: dict = None) -> Optional[str]:
 
     smiles_kwargs = {} if smiles_kwargs is None else smiles_kwargs
+
+    # Kekule SMILES (kekuleSmiles=True) need the Kekule form of the bonds,
+    # otherwise the aromatic atoms and bonds are written as they are
+    if smiles_kwargs.get('kekuleSmiles', False):
+        mol = Chem.Mol(mol)
+        Chem.Kekulize(mol, clearAromaticFlags=True)
     return Chem.MolToSmiles(mol=mol, **smiles_kwargs)
 
 
@@ -493,6 +499,25 @@ def mol_to_graph(mol: Chem.Mol,
                 edge_index=torch.from_numpy(edge_index),
                 edge_attr=torch.from_numpy(edge_attr))
 
+
+def graph_feat_dims(master_bond: bool = True,
+                    atom_feat_list: List[str] = None,
+                    bond_feat_list: List[str] = None,
+                    **kwargs) -> Tuple[int, int]:
+    """
+    Dimensions (node_attr_dim, edge_attr_dim) of the graphs from
+    mol_to_graph with the same featurizer arguments (extra arguments are
+    ignored). These do not depend on the molecule, but the edge attributes
+    of a molecule without any bond are empty, so the dimensions are taken
+    from a reference molecule with a bond instead of the data.
+    """
+    graph = mol_to_graph(mol=Chem.MolFromSmiles('CC'),
+                         master_bond=master_bond,
+                         max_num_atoms=-1,
+                         atom_feat_list=atom_feat_list,
+                         bond_feat_list=bond_feat_list)
+    return graph.x.shape[1], graph.edge_attr.shape[1]
+
 # TODO: mol_to_image, mol_to_jtnn
 # Note that MolToImage is already implemented in RDKit
 
@@ -703,6 +728,46 @@ def inchi_to_mol(inchi: str) -> Optional[Chem.Mol]:
     return mol
 
 
+def tokens_to_smiles(tokens,
+                     token_dict: dict = None) -> List[str]:
+    """
+    Inverse of mol_to_tokens for a batch of token arrays [batch_size,
+    len_tokens] (or a single token array). The tokens after EOS are
+    dropped, SOS/PAD/MSK are removed, UNK becomes a wildcard atom '*',
+    and indices that are not in the token dict become '?', so that the
+    resulting SMILES are invalid.
+
+    Note that mol_to_tokens tokenizes the atoms by their symbols (e.g.
+    aromatic 'c' as 'C'), so aromatic SMILES are not recovered exactly.
+    Tokenize with smiles_kwargs={'kekuleSmiles': True} for a lossless
+    round trip, as Kekule SMILES do not have aromatic atoms.
+    """
+
+    token_dict = DEFAULT_TOKEN_DICT if token_dict is None else token_dict
+
+    if isinstance(tokens, torch.Tensor):
+        tokens = tokens.detach().cpu().numpy()
+    tokens = np.asarray(tokens).astype(np.int64)
+    if tokens.ndim == 1:
+        tokens = tokens[None, :]
+
+    symbols = np.full(max(max(token_dict.values()), tokens.max()) + 1,
+                      '?', dtype=object)
+    for __symbol, __index in token_dict.items():
+        symbols[__index] = __symbol
+    for __symbol in ['SOS', 'EOS', 'PAD', 'MSK']:
+        if __symbol in token_dict:
+            symbols[token_dict[__symbol]] = ''
+    if 'UNK' in token_dict:
+        symbols[token_dict['UNK']] = '*'
+
+    symbol_array = symbols[tokens]
+    if 'EOS' in token_dict:
+        symbol_array[np.cumsum(tokens == token_dict['EOS'], axis=1) > 0] = ''
+
+    return [''.join(__row) for __row in symbol_array]
+
+
 def graph_to_mol(atoms: np.array,
                  adj_matrix: np.array) -> Optional[Chem.Mol]:
 
@@ -0,0 +1,151 @@
+"""
+    File Name:          MoReL/graph_collate.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Collate functions that turn the PyG graphs from mol_to_graph into
+        the inputs of the adjacency-matrix based models (GraphConvLayer):
+            - sparse: node states of the whole batch [total_num_nodes, F]
+              and a block-diagonal sparse adjacency matrix
+              [total_num_nodes, total_num_nodes * num_edge_types]
+            - dense: node states padded to the smallest size bucket that
+              fits the largest graph in the batch [batch_size, N, F] and
+              adjacency matrix [batch_size, N, N, num_edge_types]
+"""
+import torch
+from typing import List, Optional
+from torch_geometric.data import Data
+
+from network.common.relational_graph import relational_edges
+
+DEFAULT_BUCKET_SIZES = [16, 32, 64, 128]
+
+
+def to_sparse_adj_matrix(edge_index: torch.Tensor,
+                         edge_attr: torch.Tensor,
+                         num_nodes: int,
+                         layout: str = 'coo') -> torch.Tensor:
+    """
+    Sparse adjacency matrix [num_nodes, num_nodes * num_edge_types] with
+    entry (dst, src * num_edge_types + edge_type) for every edge, which
+    matches the layout of the dense adjacency matrix in GraphConvLayer.
+
+    :param edge_index: [2, num_edges] (of a single graph or a batch)
+    :param edge_attr: [num_edges, num_edge_types] binary edge attributes
+    :param num_nodes: number of nodes
+    :param layout: 'coo' or 'csr'
+    """
+
+    num_edge_types = edge_attr.shape[1]
+    edge_index, edge_type = relational_edges(edge_index, edge_attr)
+    src, dst = edge_index
+
+    adj_matrix = torch.sparse_coo_tensor(
+        torch.stack([dst, src * num_edge_types + edge_type]),
+        torch.ones(src.shape[0], device=edge_index.device),
+        size=(num_nodes, num_nodes * num_edge_types)).coalesce()
+
+    if layout == 'coo':
+        return adj_matrix
+    elif layout == 'csr':
+        return adj_matrix.to_sparse_csr()
+    else:
+        raise ValueError(f'Sparse layout {layout} is not supported.')
+
+
+class GraphCollate:
+    """
+    Collate function for DataLoader over datasets of PyG graphs.
+
+    Sparse batches are (x, adj_matrix, batch), where batch is the graph
+    index of every node. Dense batches are (x, adj_matrix, mask), where
+    mask [batch_size, N] marks the real (not padded) nodes. Either way,
+    the targets (data.y) are stacked and returned last if present.
+
+    num_edge_types should be the width of the adjacency matrix of the
+    model (edge_attr_dim). If it is not given, it is inferred from the
+    batch, and a batch of graphs without any bond raises ValueError.
+    """
+
+    def __init__(self,
+                 sparse: bool = True,
+                 layout: str = 'coo',
+                 bucket_sizes: Optional[List[int]] = None,
+                 num_edge_types: Optional[int] = None):
+
+        self.__sparse = sparse
+        self.__layout = layout
+        self.__num_edge_types = num_edge_types
+        self.__bucket_sizes = sorted(bucket_sizes) if bucket_sizes \
+            else DEFAULT_BUCKET_SIZES
+
+    def padded_size(self, max_num_nodes: int) -> int:
+        for __size in self.__bucket_sizes:
+            if max_num_nodes <= __size:
+                return __size
+        return max_num_nodes
+
+    def num_edge_types(self, data_list: List[Data]) -> int:
+        if self.__num_edge_types is not None:
+            return self.__num_edge_types
+        __num_edge_types = max((d.edge_attr.shape[1] for d in data_list
+                                if d.edge_attr.dim() == 2), default=0)
+        if __num_edge_types == 0:
+            raise ValueError('Cannot infer the number of edge types from '
+                             'a batch of graphs without any bond; pass '
+                             'num_edge_types to GraphCollate.')
+        return __num_edge_types
+
+    def __call__(self, data_list: List[Data]):
+
+        num_nodes = [d.x.shape[0] for d in data_list]
+        ret = self.__sparse_collate(data_list, num_nodes) if self.__sparse \
+            else self.__dense_collate(data_list, num_nodes)
+
+        if getattr(data_list[0], 'y', None) is not None:
+            ret = ret + (torch.stack([d.y.view(-1) for d in data_list]), )
+        return ret
+
+    def __sparse_collate(self, data_list: List[Data], num_nodes: List[int]):
+
+        offsets = torch.cumsum(torch.tensor([0] + num_nodes[:-1]), dim=0)
+        edge_index = torch.cat(
+            [d.edge_index.view(2, -1) + __offset
+             for d, __offset in zip(data_list, offsets)], dim=1)
+        edge_attr = torch.cat(
+            [d.edge_attr for d in data_list if d.edge_attr.dim() == 2] or
+            [torch.zeros(0, self.num_edge_types(data_list))], dim=0)
+
+        x = torch.cat([d.x for d in data_list], dim=0)
+        batch = torch.cat([torch.full((__n, ), __i, dtype=torch.long)
+                           for __i, __n in enumerate(num_nodes)])
+        adj_matrix = to_sparse_adj_matrix(
+            edge_index, edge_attr, x.shape[0], self.__layout)
+        return x, adj_matrix, batch
+
+    def __dense_collate(self, data_list: List[Data], num_nodes: List[int]):
+
+        padded_size = self.padded_size(max(num_nodes))
+        num_edge_types = self.num_edge_types(data_list)
+
+        x = data_list[0].x.new_zeros(
+            len(data_list), padded_size, data_list[0].x.shape[1])
+        adj_matrix = torch.zeros(
+            len(data_list), padded_size, padded_size, num_edge_types)
+        mask = torch.zeros(len(data_list), padded_size, dtype=torch.bool)
+
+        for __i, __data in enumerate(data_list):
+            x[__i, :num_nodes[__i]] = __data.x
+            mask[__i, :num_nodes[__i]] = True
+            if __data.edge_attr.dim() != 2:
+                continue
+            __edge_index, __edge_type = relational_edges(
+                __data.edge_index, __data.edge_attr)
+            adj_matrix[__i].index_put_(
+                (__edge_index[1], __edge_index[0], __edge_type),
+                torch.ones(__edge_type.shape[0]), accumulate=True)
+
+        return x, adj_matrix, mask
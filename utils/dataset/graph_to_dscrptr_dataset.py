@@ -8,6 +8,7 @@
 
 """
 import torch
+import hashlib
 import logging
 import numpy as np
 import pandas as pd
@@ -17,11 +18,56 @@ from torch_geometric.data import Data
 from typing import Optional
 
 import utils.dataset.config as c
-from utils.dataset.featurizers import mol_to_graph
+from utils.dataset.featurizers import mol_to_graph, graph_feat_dims
 
 logger = logging.getLogger(__name__)
 
 
+def load_cid_smiles_dict(pcba_only: bool = True) -> dict:
+    """
+    Dictionary of SMILES strings indexed by CIDs (strings).
+    """
+    cid_smiles_csv_path = c.PCBA_CID_SMILES_CSV_PATH \
+        if pcba_only else c.PC_CID_SMILES_CSV_PATH
+    cid_smiles_df = pd.read_csv(cid_smiles_csv_path,
+                                sep='\t',
+                                header=0,
+                                index_col=0,
+                                dtype=str)
+    cid_smiles_df.index = cid_smiles_df.index.map(str)
+    return cid_smiles_df.to_dict()['SMILES']
+
+
+def load_cid_dscrptr_dict(target_list: list) -> tuple:
+    """
+    Dictionary of STD normalized target descriptor arrays indexed by CIDs
+    (strings), and the mean and STD of the descriptors.
+    """
+    cid_list = []
+    dscrptr_array = np.array([], dtype=np.float32).reshape(0, len(target_list))
+    for chunk_cid_dscrptr_df in pd.read_csv(
+            c.PCBA_CID_TARGET_D7DSCPTR_CSV_PATH,
+            sep='\t',
+            header=0,
+            index_col=0,
+            usecols=['CID'] + target_list,
+            dtype={**{'CID': str}, **{t: np.float32 for t in target_list}},
+            chunksize=2 ** 16):
+        chunk_cid_dscrptr_df.index = chunk_cid_dscrptr_df.index.map(str)
+        cid_list.extend(list(chunk_cid_dscrptr_df.index))
+        dscrptr_array = np.vstack((dscrptr_array, chunk_cid_dscrptr_df.values))
+
+    # Perform STD normalization for multi-target regression
+    dscrptr_mean = np.mean(dscrptr_array, axis=0)
+    dscrptr_std = np.std(dscrptr_array, axis=0)
+    dscrptr_array = (dscrptr_array - dscrptr_mean) / dscrptr_std
+
+    assert len(cid_list) == len(dscrptr_array)
+    cid_dscrptr_dict = {cid: dscrptr
+                        for cid, dscrptr in zip(cid_list, dscrptr_array)}
+    return cid_dscrptr_dict, dscrptr_mean, dscrptr_std
+
+
 class GraphToDscrptrDataset(Dataset):
 
     def __init__(self,
@@ -48,15 +94,7 @@ class GraphToDscrptrDataset(Dataset):
 
         # First load the csv files into dict if not given #####################
         if cid_smiles_dict is None:
-            cid_smiles_csv_path = c.PCBA_CID_SMILES_CSV_PATH \
-                if pcba_only else c.PC_CID_SMILES_CSV_PATH
-            cid_smiles_df = pd.read_csv(cid_smiles_csv_path,
-                                        sep='\t',
-                                        header=0,
-                                        index_col=0,
-                                        dtype=str)
-            cid_smiles_df.index = cid_smiles_df.index.map(str)
-            cid_smiles_dict = cid_smiles_df.to_dict()['SMILES']
+            cid_smiles_dict = load_cid_smiles_dict(pcba_only)
         self.__cid_smiles_dict = cid_smiles_dict
 
         if cid_dscrptr_dict is None:
@@ -70,31 +108,8 @@ class GraphToDscrptrDataset(Dataset):
             #     dtype={t: np.float32 for t in self.__target_list})
             # cid_dscrptr_df.index = cid_dscrptr_df.index.map(str)
             # self.__cid_dscrptr_dict = cid_dscrptr_df.to_dict()
-            cid_list = []
-            dscrptr_array = np.array([]).reshape(0, len(self.__target_list))
-            for chunk_cid_dscrptr_df in pd.read_csv(
-                    c.PCBA_CID_TARGET_D7DSCPTR_CSV_PATH,
-                    sep='\t',
-                    header=0,
-                    index_col=0,
-                    usecols=['CID'] + self.__target_list,
-                    dtype={**{'CID': str},
-                           **{t: np.float32 for t in self.__target_list}},
-                    chunksize=2 ** 16):
-                chunk_cid_dscrptr_df.index = chunk_cid_dscrptr_df.index.map(
-                    str)
-                cid_list.extend(list(chunk_cid_dscrptr_df.index))
-                dscrptr_array = np.vstack(
-                    (dscrptr_array, chunk_cid_dscrptr_df.values))
-
-            # Perform STD normalization for multi-target regression
-            dscrptr_mean = np.mean(dscrptr_array, axis=0)
-            dscrptr_std = np.std(dscrptr_array, axis=0)
-            dscrptr_array = (dscrptr_array - dscrptr_mean) / dscrptr_std
-
-            assert len(cid_list) == len(dscrptr_array)
-            self.__cid_dscrptr_dict = \
-                {cid: dscrptr for cid, dscrptr in zip(cid_list, dscrptr_array)}
+            self.__cid_dscrptr_dict, _, _ = \
+                load_cid_dscrptr_dict(self.__target_list)
 
         else:
             # self.__cid_dscrptr_dict = {k: v for k, v
@@ -119,8 +134,7 @@ class GraphToDscrptrDataset(Dataset):
             self.__cid_list = cid_list
         else:
             smiles_cid_set = set(list(self.__cid_smiles_dict.keys()))
-            dscrptr_cid_set = set(
-                list(self.__cid_dscrptr_dict[self.__target_list[0]].keys()))
+            dscrptr_cid_set = set(list(self.__cid_dscrptr_dict.keys()))
             # Sort the CID list to make sure that we didn't introduce extra
             # randomness, and the results are easily reproducible
             self.__cid_list = \
@@ -129,15 +143,28 @@ class GraphToDscrptrDataset(Dataset):
         # Properties for dataset ##############################################
         self.__len = len(self.__cid_list)
 
-        # This part is implemented awkwardly, to change this we need some
-        # changes on the featurizer, make it a class or something
-        single_data = self[0]
-        self.node_attr_dim = single_data.x.shape[1]
-        self.edge_attr_dim = single_data.edge_attr.shape[1]
+        # From the featurizer settings, as the first molecule might not
+        # have any bond
+        self.node_attr_dim, self.edge_attr_dim = graph_feat_dims(
+            master_bond=self.__master_bond,
+            atom_feat_list=self.__atom_feat_list,
+            bond_feat_list=self.__bond_feat_list)
 
     def __len__(self):
         return self.__len
 
+    @property
+    def featurizer_kwargs(self) -> dict:
+        """
+        Keyword arguments of mol_to_graph for the graphs of this dataset
+        (e.g. for featurizing other molecules in the same way).
+        """
+        return {'master_atom': self.__master_atom,
+                'master_bond': self.__master_bond,
+                'max_num_atoms': self.__max_num_atoms,
+                'atom_feat_list': self.__atom_feat_list,
+                'bond_feat_list': self.__bond_feat_list}
+
     def __getitem__(self, index: int):
 
         # TODO: This read is not thread-safe
@@ -153,12 +180,7 @@ class GraphToDscrptrDataset(Dataset):
         # Graph features, including nodes and edges features and adj matrix
         smiles = self.__cid_smiles_dict[cid]
         mol = Chem.MolFromSmiles(smiles)
-        graph = mol_to_graph(mol=mol,
-                             master_atom=self.__master_atom,
-                             master_bond=self.__master_bond,
-                             max_num_atoms=self.__max_num_atoms,
-                             atom_feat_list=self.__atom_feat_list,
-                             bond_feat_list=self.__bond_feat_list)
+        graph = mol_to_graph(mol=mol, **self.featurizer_kwargs)
         graph.y = torch.from_numpy(target)
 
         # This part is extremely tricky
@@ -167,6 +189,25 @@ class GraphToDscrptrDataset(Dataset):
         # This is an inherent restriction of PyG
         return graph
 
+    def signature(self) -> int:
+        """
+        Hash of the CIDs, targets (names and descriptor values) and
+        featurization arguments, which changes with the items of the
+        dataset (e.g. for CachedLoader).
+        """
+        # The descriptor values are hashed from the arrays on every call,
+        # as the dict may be reloaded or modified in place
+        __dscrptr_hash = hashlib.sha1()
+        for __cid in self.__cid_list:
+            __dscrptr_hash.update(np.ascontiguousarray(
+                self.__cid_dscrptr_dict[__cid]).data)
+
+        return hash((tuple(self.__cid_list), repr(self.__target_list),
+                     __dscrptr_hash.hexdigest(),
+                     self.__master_atom, self.__master_bond,
+                     self.__max_num_atoms, repr(self.__atom_feat_list),
+                     repr(self.__bond_feat_list)))
+
     def get_cid(self, index: int) -> str:
         return self.__cid_list[index]
 
@@ -0,0 +1,423 @@
+"""
+    File Name:          MoReL/pubchem_prep.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Parallel and resumable preprocessing of the PubChem raw files.
+
+        Stages (run in this order, or all together with 'all'):
+            smiles      stream (gzipped) CID-InChI file, convert InChI into
+                        canonical SMILES in a process pool, and write
+                        chunked columns (cid, smiles)
+            dscrptr     stream the Dragon7 descriptor file and write chunked
+                        columns (cid, dscrptr) without NaN rows
+            join        join SMILES and descriptors by CID into the sharded
+                        format of sharded_dataset.py
+            csv         export the legacy CID-SMILES and CID-target csv
+                        files from the shards
+
+        Every chunk is written into a temporary directory and renamed when
+        complete. Chunks that already exist are skipped, so an interrupted
+        run resumes from the first unfinished chunk.
+
+        Usage:
+            python -m utils.dataset.pubchem_prep all --num_workers 8
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from rdkit import Chem, RDLogger
+from typing import Optional, List
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import utils.dataset.config as c
+from utils.dataset.download import download
+from utils.dataset.sharded_dataset import \
+    SHARD_NAME_FORMAT, encode_strings, decode_string, write_json, \
+    write_shard, read_shard, build_index
+
+logger = logging.getLogger(__name__)
+
+CHUNK_NAME_FORMAT = 'chunk_%05d'
+STAGE_META_FILE_NAME = 'stage.json'
+CHUNK_META_FILE_NAME = 'meta.json'
+
+
+# Helper functions ############################################################
+def raw_file_path(path: str) -> str:
+    """
+    Return the path of a raw file, preferring the gzipped version, which
+    pandas decompresses on the fly.
+    """
+    if os.path.exists(path + '.gz'):
+        return path + '.gz'
+    if os.path.exists(path):
+        return path
+    raise FileNotFoundError(f'Neither {path} nor {path}.gz exists.')
+
+
+def list_chunks(stage_dir: str) -> List[str]:
+    if not os.path.exists(stage_dir):
+        return []
+    return sorted(d for d in os.listdir(stage_dir)
+                  if d.startswith('chunk_') and not d.endswith('.tmp'))
+
+
+def check_stage_meta(stage_dir: str, meta: dict):
+    """
+    Write the configuration of a stage, or make sure that it matches the
+    one of the existing chunks. Resuming with a different chunk size (or
+    PCBA filtering) would silently mix two incompatible runs.
+    """
+    os.makedirs(stage_dir, exist_ok=True)
+    meta_path = os.path.join(stage_dir, STAGE_META_FILE_NAME)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            __meta = json.load(f)
+        if __meta != meta:
+            raise ValueError(
+                f'Stage configuration {meta} does not match the existing '
+                f'one {__meta} in {stage_dir}. Remove the directory or use '
+                f'the same configuration to resume.')
+    else:
+        write_json(meta_path, meta)
+
+
+def write_chunk(chunk_dir: str, meta: dict, **arrays):
+    tmp_dir = chunk_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for __name, __array in arrays.items():
+        np.save(os.path.join(tmp_dir, __name + '.npy'), __array)
+    write_json(os.path.join(tmp_dir, CHUNK_META_FILE_NAME), meta)
+    os.replace(tmp_dir, chunk_dir)
+
+
+def load_pcba_cid_array() -> np.array:
+    pcba_cid_df = pd.read_csv(raw_file_path(c.PCBA_CID_FILE_PATH),
+                              sep='\t',
+                              header=0,
+                              index_col=None,
+                              usecols=[0],
+                              compression='infer')
+    return np.unique(pcba_cid_df.values.reshape(-1).astype(np.int64))
+
+
+# InChI -> SMILES conversion ##################################################
+def convert_chunk(chunk_dir: str,
+                  cid_array: np.array,
+                  inchi_list: List[str]) -> dict:
+    """
+    Convert a chunk of InChI strings into canonical SMILES and write the
+    valid ones. Executed in the worker processes of the pool.
+    """
+
+    RDLogger.logger().setLevel(RDLogger.CRITICAL)
+
+    valid_cids, smiles_list = [], []
+    for __cid, __inchi in zip(cid_array, inchi_list):
+        try:
+            __mol = Chem.MolFromInchi(__inchi)
+        except Exception:
+            __mol = None
+        if __mol is None:
+            continue
+        valid_cids.append(__cid)
+        smiles_list.append(Chem.MolToSmiles(__mol))
+
+    smiles_data, smiles_offsets = encode_strings(smiles_list)
+    meta = {'num_input': len(cid_array), 'num_records': len(valid_cids)}
+    write_chunk(chunk_dir,
+                meta=meta,
+                cid=np.array(valid_cids, dtype=np.int64),
+                smiles=smiles_data,
+                smiles_offsets=smiles_offsets)
+    return meta
+
+
+def prep_smiles(prep_dir: str,
+                pcba_only: bool = True,
+                chunk_size: int = 2 ** 16,
+                num_workers: int = c.NUM_CORES):
+
+    stage_dir = os.path.join(prep_dir, 'smiles')
+    check_stage_meta(stage_dir, {'pcba_only': pcba_only,
+                                 'chunk_size': chunk_size})
+    finished_chunks = set(list_chunks(stage_dir))
+
+    pcba_cid_array = load_pcba_cid_array() if pcba_only else None
+
+    # Each worker converts a whole chunk, and the number of chunks in flight
+    # is bounded so that the reader does not run ahead of the pool
+    max_num_pending = 2 * num_workers
+    pending = set()
+    num_chunks, num_records = 0, 0
+    start_time = time.time()
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for __i, __chunk_df in enumerate(pd.read_csv(
+                raw_file_path(c.CID_INCHI_FILE_PATH),
+                sep='\t',
+                header=None,
+                index_col=None,
+                usecols=[0, 1],
+                names=['CID', 'InChI'],
+                dtype={'CID': np.int64, 'InChI': str},
+                compression='infer',
+                chunksize=chunk_size)):
+
+            # Chunks are numbered by position in the raw file, before
+            # filtering, so the numbering is stable across runs
+            __chunk_name = CHUNK_NAME_FORMAT % __i
+            if __chunk_name in finished_chunks:
+                continue
+
+            __cid_array = __chunk_df['CID'].values
+            __inchi_list = __chunk_df['InChI'].tolist()
+            if pcba_cid_array is not None:
+                __mask = np.isin(__cid_array, pcba_cid_array,
+                                 assume_unique=False)
+                __cid_array = __cid_array[__mask]
+                __inchi_list = [__inchi for __inchi, __m
+                                in zip(__inchi_list, __mask) if __m]
+
+            if len(pending) >= max_num_pending:
+                __done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for __future in __done:
+                    num_records += __future.result()['num_records']
+                    num_chunks += 1
+
+            pending.add(executor.submit(
+                convert_chunk, os.path.join(stage_dir, __chunk_name),
+                __cid_array, __inchi_list))
+
+            if __i % 64 == 0:
+                logger.info(f'Submitted chunk {__i} ({num_chunks} chunks and '
+                            f'{num_records} molecules converted in '
+                            f'{time.time() - start_time:.1f} seconds)')
+
+        for __future in wait(pending).done:
+            num_records += __future.result()['num_records']
+            num_chunks += 1
+
+    logger.info(f'Converted {num_records} molecules in {num_chunks} new '
+                f'chunks ({len(finished_chunks)} chunks skipped).')
+
+
+# Dragon7 descriptors #########################################################
+def prep_dscrptr(prep_dir: str,
+                 target_list: Optional[List[str]] = None,
+                 chunk_size: int = 2 ** 16):
+    """
+    Convert the Dragon7 descriptor file into chunks of CID and float32
+    descriptors. Descriptor parsing is IO/pandas bound, so this stage is
+    not parallelized.
+    """
+
+    stage_dir = os.path.join(prep_dir, 'dscrptr')
+    check_stage_meta(stage_dir, {'target_list': target_list,
+                                 'chunk_size': chunk_size})
+    finished_chunks = set(list_chunks(stage_dir))
+
+    read_csv_kwargs = {
+        'sep':          '\t',
+        'header':       0,
+        'index_col':    0,
+        'na_values':    'na',
+        'compression':  'infer',
+        'chunksize':    chunk_size,
+    }
+    if target_list is not None:
+        read_csv_kwargs['usecols'] = ['NAME', ] + target_list
+        read_csv_kwargs['dtype'] = {t: np.float32 for t in target_list}
+
+    num_records = 0
+    for __i, __chunk_df in enumerate(pd.read_csv(
+            raw_file_path(c.PCBA_CID_D7_DSCPTR_FILE_PATH),
+            **read_csv_kwargs)):
+
+        if __i == 0:
+            write_json(os.path.join(stage_dir, 'dscrptr_names.json'),
+                       list(__chunk_df.columns))
+
+        __chunk_name = CHUNK_NAME_FORMAT % __i
+        if __chunk_name in finished_chunks:
+            continue
+
+        # Original dataset contains some NaN values
+        __chunk_df = __chunk_df.dropna()
+        write_chunk(os.path.join(stage_dir, __chunk_name),
+                    meta={'num_records': len(__chunk_df)},
+                    cid=__chunk_df.index.values.astype(np.int64),
+                    dscrptr=__chunk_df.values.astype(np.float32))
+        num_records += len(__chunk_df)
+
+    logger.info(f'Converted descriptors of {num_records} molecules '
+                f'({len(finished_chunks)} chunks skipped).')
+
+
+# Join into shards ############################################################
+def join_shards(prep_dir: str, shard_dir: str) -> dict:
+    """
+    Join the SMILES and descriptor chunks by CID. Every SMILES chunk is
+    written as one shard of the same number, so this stage is resumable
+    as well. The descriptor CIDs are sorted once and matched with binary
+    search instead of a dict of millions of entries.
+    """
+
+    smiles_dir = os.path.join(prep_dir, 'smiles')
+    dscrptr_dir = os.path.join(prep_dir, 'dscrptr')
+    with open(os.path.join(dscrptr_dir, 'dscrptr_names.json')) as f:
+        target_list = json.load(f)
+
+    __dscrptr_chunks = [read_shard(os.path.join(dscrptr_dir, d), mmap=False)
+                        for d in list_chunks(dscrptr_dir)]
+    dscrptr_cid_array = np.concatenate([d['cid'] for d in __dscrptr_chunks])
+    dscrptr_array = np.concatenate([d['dscrptr'] for d in __dscrptr_chunks])
+    del __dscrptr_chunks
+
+    __order = np.argsort(dscrptr_cid_array, kind='stable')
+    dscrptr_cid_array = dscrptr_cid_array[__order]
+    dscrptr_array = dscrptr_array[__order]
+
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_names = []
+    for __chunk_name in list_chunks(smiles_dir):
+
+        __shard_name = SHARD_NAME_FORMAT % int(__chunk_name.split('_')[-1])
+        __shard_path = os.path.join(shard_dir, __shard_name)
+        if os.path.exists(__shard_path):
+            shard_names.append(__shard_name)
+            continue
+
+        __chunk = read_shard(os.path.join(smiles_dir, __chunk_name))
+        __cid_array = np.asarray(__chunk['cid'])
+        if len(__cid_array) == 0:
+            continue
+
+        __pos = np.searchsorted(dscrptr_cid_array, __cid_array)
+        __pos = np.minimum(__pos, len(dscrptr_cid_array) - 1)
+        __mask = (dscrptr_cid_array[__pos] == __cid_array)
+        if not __mask.any():
+            continue
+
+        __indices = np.nonzero(__mask)[0]
+        write_shard(__shard_path,
+                    cid_array=__cid_array[__indices],
+                    smiles_list=[decode_string(__chunk['smiles'],
+                                               __chunk['smiles_offsets'], i)
+                                 for i in __indices],
+                    target_array=dscrptr_array[__pos[__indices]])
+        shard_names.append(__shard_name)
+
+    index = build_index(shard_dir, target_list, shard_names)
+    logger.info(f'Joined {index["num_records"]} molecules into '
+                f'{len(shard_names)} shards.')
+    return index
+
+
+# Legacy csv export ###########################################################
+def export_csv(shard_dir: str,
+               cid_smiles_csv_path: str = c.PCBA_CID_SMILES_CSV_PATH,
+               cid_dscrptr_csv_path: str =
+               c.PCBA_CID_TARGET_D7DSCPTR_CSV_PATH):
+    """
+    Export the shards into the (tab-separated) csv files that are used by
+    GraphToDscrptrDataset and the training scripts.
+    """
+
+    with open(os.path.join(shard_dir, 'index.json')) as f:
+        index = json.load(f)
+    target_list = index['target_list']
+
+    for __path in [cid_smiles_csv_path, cid_dscrptr_csv_path]:
+        if os.path.exists(__path):
+            os.remove(__path)
+
+    for __i, __shard in enumerate(index['shards']):
+        __columns = read_shard(os.path.join(shard_dir, __shard['name']))
+        __cid_array = np.asarray(__columns['cid'])
+        __smiles_list = [decode_string(__columns['smiles'],
+                                       __columns['smiles_offsets'], i)
+                         for i in range(len(__cid_array))]
+
+        pd.DataFrame({'CID': __cid_array, 'SMILES': __smiles_list}).to_csv(
+            cid_smiles_csv_path, sep='\t', index=False,
+            header=(__i == 0), mode='a')
+
+        __dscrptr_df = pd.DataFrame(np.asarray(__columns['target']),
+                                    columns=target_list)
+        __dscrptr_df.insert(0, 'CID', __cid_array)
+        __dscrptr_df.to_csv(cid_dscrptr_csv_path, sep='\t', index=False,
+                            header=(__i == 0), mode='a', float_format='%g')
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Resumable PubChem preprocessing pipeline')
+
+    parser.add_argument('stages', type=str, nargs='+',
+                        choices=['smiles', 'dscrptr', 'join', 'csv', 'all'])
+
+    parser.add_argument('--full_pubchem', action='store_true',
+                        help='use all the PubChem molecules for the SMILES '
+                             'stage instead of the PCBA subset')
+    parser.add_argument('--all_dscrptr', action='store_true',
+                        help='keep all the Dragon7 descriptors instead of '
+                             'the targets in config.py')
+    parser.add_argument('--chunk_size', type=int, default=2 ** 16)
+    parser.add_argument('--num_workers', type=int, default=c.NUM_CORES)
+
+    parser.add_argument('--prep_dir', type=str, default=None)
+    parser.add_argument('--shard_dir', type=str, default=None)
+    parser.add_argument('--download', action='store_true',
+                        help='download the raw files (kept gzipped) first')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    pcba_only = not args.full_pubchem
+    prep_dir = args.prep_dir if args.prep_dir else \
+        (c.PCBA_PREP_DIR if pcba_only else c.PC_PREP_DIR)
+    shard_dir = args.shard_dir if args.shard_dir else \
+        (c.PCBA_SHARD_DIR if pcba_only else c.PC_SHARD_DIR)
+    stages = ['smiles', 'dscrptr', 'join', 'csv'] \
+        if 'all' in args.stages else args.stages
+
+    if args.download:
+        download(unpack=False)
+
+    if 'smiles' in stages:
+        prep_smiles(prep_dir,
+                    pcba_only=pcba_only,
+                    chunk_size=args.chunk_size,
+                    num_workers=args.num_workers)
+    if 'dscrptr' in stages:
+        prep_dscrptr(prep_dir,
+                     target_list=None if args.all_dscrptr
+                     else c.TARGET_D7_DSCRPTR_NAMES,
+                     chunk_size=args.chunk_size)
+    if 'join' in stages:
+        join_shards(prep_dir, shard_dir)
+    if 'csv' in stages:
+        if pcba_only:
+            export_csv(shard_dir)
+        else:
+            export_csv(shard_dir,
+                       cid_smiles_csv_path=c.PC_CID_SMILES_CSV_PATH,
+                       cid_dscrptr_csv_path=os.path.join(
+                           c.PROCESSED_DATA_DIR, 'CID-target_DD.csv'))
+
+
+if __name__ == '__main__':
+    main()
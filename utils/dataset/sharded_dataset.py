@@ -0,0 +1,554 @@
+"""
+    File Name:          MoReL/sharded_dataset.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Sharded on-disk format of (CID, SMILES, target vector) records and
+        a streaming dataset over it, for training on the complete PubChem
+        collection (~97M molecules) with constant memory.
+
+        Layout of a sharded dataset directory:
+            index.json              target names, shards, mean/std
+            shard_00000/
+                cid.npy             [n] int64
+                smiles.npy          [total_length] uint8 (UTF-8 bytes)
+                smiles_offsets.npy  [n + 1] int64
+                target.npy          [n, num_targets] float32
+                meta.json           number of records and target sums
+            shard_00001/
+            ...
+
+        Shards written by featurization_job.py also contain precomputed
+        graphs, which are used instead of featurizing the SMILES:
+                x.npy               [total_num_nodes, node_attr_dim] float32
+                x_offsets.npy       [n + 1] int64
+                edge_index.npy      [total_num_edges, 2] int64
+                edge_attr.npy       [total_num_edges, edge_attr_dim] float32
+                edge_offsets.npy    [n + 1] int64
+
+        Shards are written into a temporary directory and renamed when
+        complete, so a shard directory is either complete or absent.
+"""
+import os
+import json
+import shutil
+import logging
+import itertools
+import numpy as np
+from rdkit import Chem
+from typing import Optional, List, Iterable
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from torch_geometric.data import Data
+
+from utils.dataset.featurizers import mol_to_graph, graph_feat_dims
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = 'index.json'
+SHARD_META_FILE_NAME = 'meta.json'
+SHARD_NAME_FORMAT = 'shard_%05d'
+
+
+# Helper functions ############################################################
+def encode_strings(str_list: List[str]):
+    """
+    Encode a list of strings into a flat uint8 array and an offset array,
+    such that str_list[i] == data[offsets[i]: offsets[i + 1]].
+    """
+    encoded = [s.encode('utf-8') for s in str_list]
+    offsets = np.zeros(shape=(len(encoded) + 1, ), dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def decode_string(data: np.array, offsets: np.array, index: int) -> str:
+    return data[offsets[index]: offsets[index + 1]].tobytes().decode('utf-8')
+
+
+def encode_graphs(graph_list: List[Data],
+                  node_attr_dim: int,
+                  edge_attr_dim: int) -> dict:
+    """
+    Encode a list of PyG graphs into flat arrays and offsets, which can be
+    saved as extra columns of a shard (see write_shard). The dimensions
+    are those of the featurizer (see graph_feat_dims), as the graphs might
+    not have any edge at all.
+    """
+
+    x_offsets = np.zeros(shape=(len(graph_list) + 1, ), dtype=np.int64)
+    x_offsets[1:] = np.cumsum([g.x.shape[0] for g in graph_list])
+    edge_offsets = np.zeros(shape=(len(graph_list) + 1, ), dtype=np.int64)
+    edge_offsets[1:] = np.cumsum([g.edge_index.numel() // 2
+                                  for g in graph_list])
+
+    # Molecules without any bond have empty (1D) edge tensors
+    return {
+        'x': np.concatenate(
+            [g.x.numpy().reshape(-1, node_attr_dim) for g in graph_list]),
+        'x_offsets': x_offsets,
+        'edge_index': np.concatenate(
+            [g.edge_index.numpy().reshape(2, -1).T for g in graph_list]),
+        'edge_attr': np.concatenate(
+            [g.edge_attr.numpy().reshape(-1, edge_attr_dim)
+             for g in graph_list]),
+        'edge_offsets': edge_offsets, }
+
+
+def decode_graph(columns: dict, index: int) -> Data:
+    __x_start, __x_end = columns['x_offsets'][index: index + 2]
+    __e_start, __e_end = columns['edge_offsets'][index: index + 2]
+    return Data(
+        x=torch.from_numpy(np.array(columns['x'][__x_start: __x_end])),
+        edge_index=torch.from_numpy(
+            np.array(columns['edge_index'][__e_start: __e_end].T)),
+        edge_attr=torch.from_numpy(
+            np.array(columns['edge_attr'][__e_start: __e_end])))
+
+
+def write_json(path: str, obj: dict):
+    # Write-and-rename, so that readers never see a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def write_shard(shard_dir: str,
+                cid_array: np.array,
+                smiles_list: List[str],
+                target_array: np.array,
+                **extra_arrays):
+    """
+    Write a single shard. Extra (numpy) arrays are saved as additional
+    columns with their keyword as file name.
+    """
+
+    assert len(cid_array) == len(smiles_list) == len(target_array)
+
+    tmp_dir = shard_dir.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    smiles_data, smiles_offsets = encode_strings(smiles_list)
+    target_array = np.asarray(target_array, dtype=np.float32)
+
+    np.save(os.path.join(tmp_dir, 'cid.npy'),
+            np.asarray(cid_array, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, 'smiles.npy'), smiles_data)
+    np.save(os.path.join(tmp_dir, 'smiles_offsets.npy'), smiles_offsets)
+    np.save(os.path.join(tmp_dir, 'target.npy'), target_array)
+    for __name, __array in extra_arrays.items():
+        np.save(os.path.join(tmp_dir, __name + '.npy'), __array)
+
+    # Sums for computing the global mean and standard deviation
+    __target = target_array.astype(np.float64)
+    write_json(os.path.join(tmp_dir, SHARD_META_FILE_NAME), {
+        'num_records': len(cid_array),
+        'target_sum': __target.sum(axis=0).tolist(),
+        'target_sqsum': (__target ** 2).sum(axis=0).tolist(), })
+
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.replace(tmp_dir, shard_dir)
+
+
+def read_shard(shard_dir: str, mmap: bool = True) -> dict:
+    """
+    Read all the columns of a shard into a dict of (memory-mapped) arrays.
+    """
+    mmap_mode = 'r' if mmap else None
+    return {os.path.splitext(f)[0]:
+            np.load(os.path.join(shard_dir, f), mmap_mode=mmap_mode)
+            for f in os.listdir(shard_dir) if f.endswith('.npy')}
+
+
+def build_index(root_dir: str,
+                target_list: List[str],
+                shard_names: Optional[List[str]] = None,
+                extra_info: Optional[dict] = None) -> dict:
+    """
+    Build (and write) the index of a sharded dataset from the shard meta
+    files. The shards are ordered by name if not given. Extra information
+    (e.g. featurizer settings) is saved in the index as it is.
+    """
+
+    if shard_names is None:
+        shard_names = sorted(
+            d for d in os.listdir(root_dir)
+            if d.startswith('shard_') and not d.endswith('.tmp') and
+            os.path.isdir(os.path.join(root_dir, d)))
+
+    num_records = 0
+    target_sum = np.zeros(shape=(len(target_list), ), dtype=np.float64)
+    target_sqsum = np.zeros(shape=(len(target_list), ), dtype=np.float64)
+    shards = []
+    for __name in shard_names:
+        with open(os.path.join(root_dir, __name, SHARD_META_FILE_NAME)) as f:
+            __meta = json.load(f)
+        shards.append({'name': __name, 'num_records': __meta['num_records']})
+        num_records += __meta['num_records']
+        target_sum += np.array(__meta['target_sum'])
+        target_sqsum += np.array(__meta['target_sqsum'])
+
+    target_mean = target_sum / max(num_records, 1)
+    target_std = np.sqrt(np.maximum(
+        target_sqsum / max(num_records, 1) - target_mean ** 2, 0.))
+
+    index = {
+        'target_list': list(target_list),
+        'num_records': num_records,
+        'shards': shards,
+        'target_mean': target_mean.tolist(),
+        'target_std': target_std.tolist(), }
+    if extra_info is not None:
+        index.update(extra_info)
+    write_json(os.path.join(root_dir, INDEX_FILE_NAME), index)
+    return index
+
+
+class ShardWriter:
+    """
+    Buffer records and write them into fixed-size shards.
+
+    with ShardWriter(root_dir, target_list) as writer:
+        for cid, smiles, target in records:
+            writer.write(cid, smiles, target)
+    """
+
+    def __init__(self,
+                 root_dir: str,
+                 target_list: List[str],
+                 shard_size: int = 2 ** 16,
+                 start_shard: int = 0):
+
+        self.__root_dir = root_dir
+        self.__target_list = list(target_list)
+        self.__shard_size = shard_size
+        self.__next_shard = start_shard
+
+        self.__cids, self.__smiles, self.__targets = [], [], []
+        os.makedirs(self.__root_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Do not index a dataset that was interrupted by an exception
+        if exc_type is None:
+            self.close()
+
+    def write(self, cid: int, smiles: str, target: np.array):
+        self.__cids.append(cid)
+        self.__smiles.append(smiles)
+        self.__targets.append(target)
+        if len(self.__cids) >= self.__shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.__cids) == 0:
+            return
+        write_shard(os.path.join(self.__root_dir,
+                                 SHARD_NAME_FORMAT % self.__next_shard),
+                    cid_array=np.array(self.__cids, dtype=np.int64),
+                    smiles_list=self.__smiles,
+                    target_array=np.array(self.__targets, dtype=np.float32))
+        self.__next_shard += 1
+        self.__cids, self.__smiles, self.__targets = [], [], []
+
+    def close(self) -> dict:
+        self.flush()
+        return build_index(self.__root_dir, self.__target_list)
+
+
+# Streaming dataset ###########################################################
+class ShardedGraphToDscrptrDataset(IterableDataset):
+    """
+    Streaming version of GraphToDscrptrDataset over a sharded directory.
+
+    Shards are distributed over (rank, dataloader worker) streams. Each
+    stream reads its shards through a bounded shuffle buffer, so memory
+    usage does not grow with the size of the dataset.
+
+    With more than one rank, every rank yields exactly len(self) graphs
+    per epoch, as DistributedSampler does: streams that run out of their
+    own shards are padded with records from the other shards, and the
+    others are truncated, so that no rank waits on the others in DDP.
+
+    Every yielded graph carries a 'stream_pos' attribute
+    [[stream, pos, num_yielded]]. Pass the collated batches to
+    update_position() in the training loop and use state_dict()/
+    load_state_dict() to resume in the middle of an epoch: the next
+    iteration of each stream skips the records that were already
+    consumed, without featurizing them.
+    """
+
+    def __init__(self,
+                 shard_dir: str,
+                 target_list: Optional[List[str]] = None,
+                 shard_names: Optional[List[str]] = None,
+                 normalize_target: bool = True,
+                 shuffle: bool = True,
+                 shuffle_buffer_size: int = 2 ** 14,
+                 rand_state: int = 0,
+                 rank: int = 0,
+                 world_size: int = 1,
+                 master_atom: bool = True,
+                 master_bond: bool = True,
+                 max_num_atoms: int = 128,
+                 atom_feat_list: list = None,
+                 bond_feat_list: list = None):
+
+        super().__init__()
+        self.__shard_dir = shard_dir
+        self.__shuffle = shuffle
+        self.__shuffle_buffer_size = shuffle_buffer_size
+        self.__rand_state = rand_state
+        self.__rank = rank
+        self.__world_size = world_size
+        self.__featurizer_kwargs = {
+            'master_atom': master_atom,
+            'master_bond': master_bond,
+            'max_num_atoms': max_num_atoms,
+            'atom_feat_list': atom_feat_list,
+            'bond_feat_list': bond_feat_list, }
+
+        with open(os.path.join(shard_dir, INDEX_FILE_NAME)) as f:
+            index = json.load(f)
+
+        # Precomputed graphs are used as they are
+        if ('featurizer' in index) and \
+                (index['featurizer'] != self.__featurizer_kwargs):
+            logger.warning(f'Shards in {shard_dir} contain graphs featurized '
+                           f'with {index["featurizer"]}, which are used '
+                           f'instead of {self.__featurizer_kwargs}.')
+
+        # Shards and target columns ###########################################
+        __shards = {s['name']: s['num_records'] for s in index['shards']}
+        self.__shard_names = [s['name'] for s in index['shards']] \
+            if shard_names is None else list(shard_names)
+        self.__num_records = sum(__shards[s] for s in self.__shard_names)
+
+        self.__target_list = index['target_list'] if target_list is None \
+            else list(target_list)
+        self.__target_indices = np.array(
+            [index['target_list'].index(t) for t in self.__target_list])
+
+        if normalize_target:
+            self.__target_mean = np.array(
+                index['target_mean'], dtype=np.float32)[self.__target_indices]
+            self.__target_std = np.array(
+                index['target_std'], dtype=np.float32)[self.__target_indices]
+        else:
+            self.__target_mean, self.__target_std = None, None
+
+        # Stream positions for checkpointing ##################################
+        self.__epoch = 0
+        self.__positions = {}
+        self.__resume_positions = {}
+
+        # Properties for dataset ##############################################
+        self.node_attr_dim, self.edge_attr_dim = graph_feat_dims(
+            **index.get('featurizer', self.__featurizer_kwargs))
+
+    def __len__(self):
+        # Number of records for each rank (padded if there are many ranks)
+        return int(np.ceil(self.__num_records / self.__world_size))
+
+    @property
+    def num_records(self) -> int:
+        return self.__num_records
+
+    @property
+    def target_mean(self) -> Optional[np.array]:
+        return self.__target_mean
+
+    @property
+    def target_std(self) -> Optional[np.array]:
+        return self.__target_std
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.__epoch:
+            self.__epoch = epoch
+            self.__positions, self.__resume_positions = {}, {}
+
+    def update_position(self, batch):
+        stream_pos = batch.stream_pos.view(-1, 3).cpu().numpy()
+        for __stream in np.unique(stream_pos[:, 0]):
+            __rows = stream_pos[stream_pos[:, 0] == __stream]
+            __pos, __num_yielded = __rows[__rows[:, 1].argmax(), 1:]
+            if __pos > self.__positions.get(int(__stream), (-1, 0))[0]:
+                self.__positions[int(__stream)] = \
+                    (int(__pos), int(__num_yielded))
+
+        # The iteration has started with the resume positions (in the
+        # dataloader workers, which have their own copies of the dataset)
+        self.__resume_positions = {}
+
+    def state_dict(self) -> dict:
+        return {'epoch': self.__epoch,
+                'positions': dict(self.__positions)}
+
+    def load_state_dict(self, state_dict: dict):
+        self.__epoch = state_dict['epoch']
+        self.__positions = \
+            {int(k): tuple(v) for k, v in state_dict['positions'].items()}
+        self.__resume_positions = dict(self.__positions)
+
+    def __shard_records(self, shard_name: str, rng=None):
+
+        shard = read_shard(os.path.join(self.__shard_dir, shard_name))
+        cid, target = shard['cid'], shard['target']
+        smiles, smiles_offsets = shard['smiles'], shard['smiles_offsets']
+
+        graph_columns = shard if ('x' in shard) else None
+
+        order = rng.permutation(len(cid)) if (rng is not None) \
+            else range(len(cid))
+        for __i in order:
+            yield (int(cid[__i]),
+                   decode_string(smiles, smiles_offsets, __i),
+                   np.array(target[__i, self.__target_indices]),
+                   None if graph_columns is None else (graph_columns, __i))
+
+    def __record_stream(self, shard_names: Iterable[str], rng):
+
+        if not self.__shuffle:
+            for __shard_name in shard_names:
+                yield from self.__shard_records(__shard_name)
+            return
+
+        buffer = []
+        for __shard_name in shard_names:
+            for __record in self.__shard_records(__shard_name, rng):
+                if len(buffer) < self.__shuffle_buffer_size:
+                    buffer.append(__record)
+                    continue
+                __j = rng.integers(len(buffer))
+                yield buffer[__j]
+                buffer[__j] = __record
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __featurize(self, record):
+
+        cid, smiles, target, precomputed = record
+        if precomputed is not None:
+            graph = decode_graph(*precomputed)
+        else:
+            mol = Chem.MolFromSmiles(smiles)
+            if mol is None:
+                return None
+            graph = mol_to_graph(mol=mol, **self.__featurizer_kwargs)
+            if graph is None:
+                return None
+
+        if self.__target_mean is not None:
+            target = (target - self.__target_mean) / self.__target_std
+        graph.y = torch.from_numpy(target.astype(np.float32))
+        return graph
+
+    def __iter__(self):
+
+        worker_info = get_worker_info()
+        num_workers, worker_id = (1, 0) if (worker_info is None) \
+            else (worker_info.num_workers, worker_info.id)
+        stream = self.__rank * num_workers + worker_id
+        num_streams = self.__world_size * num_workers
+
+        # The shard order is shared by all the streams of the same epoch,
+        # and the shuffle buffer of each stream has its own random state
+        shard_order = np.random.default_rng(
+            [self.__rand_state, self.__epoch]).permutation(
+            len(self.__shard_names)) if self.__shuffle \
+            else np.arange(len(self.__shard_names))
+        shard_names = [self.__shard_names[i]
+                       for i in shard_order[stream::num_streams]]
+        rng = np.random.default_rng([self.__rand_state, self.__epoch, stream])
+
+        # Equal number of graphs for every rank, split over its workers.
+        # The padding cycles over all the shards, starting at a different
+        # shard for every stream
+        quota = None
+        if self.__world_size > 1:
+            __num_samples = len(self)
+            quota = __num_samples // num_workers + \
+                int(worker_id < __num_samples % num_workers)
+            __padding_order = np.roll(shard_order, -stream)
+            shard_names = itertools.chain(shard_names, itertools.cycle(
+                [self.__shard_names[i] for i in __padding_order]))
+
+        # Resume positions are only used by the first iteration after
+        # loading the state dict
+        resume_positions, self.__resume_positions = \
+            self.__resume_positions, {}
+        __last_pos, num_yielded = resume_positions.get(stream, (-1, 0))
+        if (quota is not None) and (num_yielded >= quota):
+            return
+
+        for __pos, __record in enumerate(self.__record_stream(shard_names,
+                                                              rng)):
+            if __pos <= __last_pos:
+                continue
+            graph = self.__featurize(__record)
+            if graph is None:
+                # Stop padding if a whole pass yields nothing
+                if __pos - __last_pos > self.__num_records + 1:
+                    logger.warning(f'Stream {stream} ran out of valid '
+                                   f'molecules after {num_yielded} graphs.')
+                    return
+                continue
+            __last_pos = __pos
+            num_yielded += 1
+            graph.stream_pos = torch.tensor([[stream, __pos, num_yielded]])
+            yield graph
+            if (quota is not None) and (num_yielded >= quota):
+                return
+
+
+# Testing segment: convert the PCBA csv files and stream through the shards
+if __name__ == '__main__':
+
+    import pandas as pd
+    import torch_geometric.data as pyg_data
+    import utils.dataset.config as c
+
+    SHARD_DIR = c.PCBA_SHARD_DIR
+    TARGET_LIST = c.TARGET_D7_DSCRPTR_NAMES
+
+    if not os.path.exists(os.path.join(SHARD_DIR, INDEX_FILE_NAME)):
+        cid_smiles_df = pd.read_csv(c.PCBA_CID_SMILES_CSV_PATH, sep='\t',
+                                    header=0, index_col=0, dtype=str)
+        cid_smiles_df.index = cid_smiles_df.index.map(int)
+        cid_smiles_dict = cid_smiles_df.to_dict()['SMILES']
+        del cid_smiles_df
+
+        with ShardWriter(SHARD_DIR, TARGET_LIST) as writer:
+            for chunk_cid_dscrptr_df in pd.read_csv(
+                    c.PCBA_CID_TARGET_D7DSCPTR_CSV_PATH,
+                    sep='\t',
+                    header=0,
+                    index_col=0,
+                    usecols=['CID'] + TARGET_LIST,
+                    dtype={t: np.float32 for t in TARGET_LIST},
+                    chunksize=2 ** 16):
+                for cid, row in zip(chunk_cid_dscrptr_df.index,
+                                    chunk_cid_dscrptr_df.values):
+                    if cid in cid_smiles_dict:
+                        writer.write(cid, cid_smiles_dict[cid], row)
+
+    dataset = ShardedGraphToDscrptrDataset(SHARD_DIR)
+    loader = pyg_data.DataLoader(dataset, batch_size=32, num_workers=2)
+    for i, data in enumerate(loader):
+        dataset.update_position(data)
+        if i == 100:
+            break
+    print(f'Stream positions after 100 batches: {dataset.state_dict()}')
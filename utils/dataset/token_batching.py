@@ -0,0 +1,136 @@
+"""
+    File Name:          MoReL/token_batching.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Length-bucketed batching for tokenized SMILES (mol_to_tokens), so
+        that the cost of attention follows the real sequence lengths
+        instead of the fixed token length (128):
+            - LengthBucketBatchSampler groups sequences of similar lengths
+              into the same batches
+            - TokenCollate trims the padding of each batch to the longest
+              sequence in it
+
+        Usage:
+            lengths = [token_length(t) for t in token_list]
+            loader = DataLoader(
+                dataset,
+                batch_sampler=LengthBucketBatchSampler(lengths, 32),
+                collate_fn=TokenCollate(token_position=2))
+"""
+import torch
+import numpy as np
+from typing import List, Optional
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+from utils.dataset.featurizers import DEFAULT_TOKEN_DICT
+
+PAD_INDEX = DEFAULT_TOKEN_DICT['PAD']
+
+
+def token_length(tokens: torch.Tensor, pad_index: int = PAD_INDEX) -> int:
+    """
+    Number of tokens before padding.
+    """
+    return int((tokens != pad_index).sum())
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that shuffles the indices, sorts them by length within
+    pools of (pool_size * batch_size) indices, and splits the pools into
+    batches, so that every batch contains sequences of similar lengths
+    while the order of batches stays random.
+    """
+
+    def __init__(self,
+                 lengths: List[int],
+                 batch_size: int,
+                 pool_size: int = 64,
+                 shuffle: bool = True,
+                 drop_last: bool = False,
+                 rand_state: int = 0):
+
+        super().__init__(None)
+        self.__lengths = np.asarray(lengths)
+        self.__batch_size = batch_size
+        self.__pool_size = pool_size
+        self.__shuffle = shuffle
+        self.__drop_last = drop_last
+        self.__rand_state = rand_state
+        self.__epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.__epoch = epoch
+
+    def __len__(self):
+        if self.__drop_last:
+            return len(self.__lengths) // self.__batch_size
+        return int(np.ceil(len(self.__lengths) / self.__batch_size))
+
+    def __iter__(self):
+
+        rng = np.random.RandomState(self.__rand_state + self.__epoch)
+        self.__epoch += 1
+
+        indices = rng.permutation(len(self.__lengths)) if self.__shuffle \
+            else np.arange(len(self.__lengths))
+
+        batches = []
+        __pool_length = self.__pool_size * self.__batch_size
+        for __start in range(0, len(indices), __pool_length):
+            __pool = indices[__start: __start + __pool_length]
+            __pool = __pool[np.argsort(self.__lengths[__pool],
+                                       kind='stable')]
+            batches.extend(__pool[i: i + self.__batch_size]
+                           for i in range(0, len(__pool), self.__batch_size))
+
+        if self.__drop_last:
+            batches = [b for b in batches if len(b) == self.__batch_size]
+        if self.__shuffle:
+            rng.shuffle(batches)
+
+        for __batch in batches:
+            yield __batch.tolist()
+
+
+class TokenCollate:
+    """
+    Collate function that trims the padded token arrays to the longest
+    sequence in the batch (rounded up to a multiple of pad_to_multiple_of
+    for better kernel efficiency), and collates the rest of the sample
+    with the default collate function.
+
+    :param token_position: index of the tokens in each sample if the
+        samples are tuples, or None if the samples are token arrays
+    """
+
+    def __init__(self,
+                 token_position: Optional[int] = None,
+                 pad_index: int = PAD_INDEX,
+                 pad_to_multiple_of: int = 8):
+
+        self.__token_position = token_position
+        self.__pad_index = pad_index
+        self.__pad_to_multiple_of = pad_to_multiple_of
+
+    def trim(self, tokens: torch.Tensor) -> torch.Tensor:
+        """
+        Trim a batch of tokens [batch_size, len_tokens].
+        """
+        __length = int((tokens != self.__pad_index).sum(dim=1).max())
+        __length = int(np.ceil(__length / self.__pad_to_multiple_of)) * \
+            self.__pad_to_multiple_of
+        return tokens[:, :__length].contiguous()
+
+    def __call__(self, batch: list):
+        batch = default_collate(batch)
+        if self.__token_position is None:
+            return self.trim(batch)
+        batch = list(batch)
+        batch[self.__token_position] = self.trim(batch[self.__token_position])
+        return batch
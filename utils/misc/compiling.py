@@ -0,0 +1,198 @@
+"""
+    File Name:          MoReL/compiling.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Opt-in compilation of the model forward passes, which fuses the
+        many small kernels of the Python loops over convolution steps and
+        edge types in the graph encoders. In order of preference:
+            - torch.compile (PyTorch >= 2.0) with dynamic shapes, so that
+              batches with different numbers of nodes and edges share the
+              compiled graphs; the number of recompilations per frame is
+              bounded by recompile_limit, after which TorchDynamo runs the
+              frame in eager mode
+            - TorchScript, for models that can be scripted
+            - eager mode
+
+        Compilation is lazy, so an operation that cannot be compiled (e.g.
+        some PyG ops) only fails on the first call (in training and in
+        eval mode), and the backward graph only fails in the first
+        backward pass. On these failures (and only on the compile or
+        script errors of fallback_errors) the next option is used, and
+        the call (or the training step in run_step) is repeated. A real
+        error of the model therefore surfaces in eager mode, and all the
+        other errors are raised as they are.
+
+        Usage:
+            forward = CompiledForward(model)
+            loss = forward.run_step(train_step, data)
+            pred = forward(data)
+"""
+import torch
+import logging
+import importlib
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+COMPILE_MODES = ['compile', 'script', 'eager']
+
+# Exception types (module, names) of the failures to compile or script a
+# model, which are not all available in every PyTorch version
+FALLBACK_ERRORS = {
+    'compile': [('torch._dynamo.exc',
+                 ('TorchDynamoException', 'BackendCompilerFailed')),
+                ('torch._inductor.exc',
+                 ('InductorError', 'LoweringException'))],
+    'script': [('torch.jit', ('Error', )),
+               ('torch.jit.frontend', ('FrontendError', ))],
+    'eager': [], }
+
+
+def set_recompile_limit(recompile_limit: int):
+    import torch._dynamo
+    __config = torch._dynamo.config
+    # cache_size_limit is renamed to recompile_limit in PyTorch >= 2.6
+    for __name in ['recompile_limit', 'cache_size_limit']:
+        if hasattr(__config, __name):
+            setattr(__config, __name, recompile_limit)
+
+
+def fallback_errors(mode: str) -> tuple:
+    """
+    Exception types on which CompiledForward falls back from the given
+    mode to the next one (none for eager mode).
+    """
+    __errors = []
+    for __module_name, __names in FALLBACK_ERRORS[mode]:
+        try:
+            __module = importlib.import_module(__module_name)
+        except ImportError:
+            continue
+        __errors.extend(getattr(__module, n) for n in __names
+                        if hasattr(__module, n))
+    return tuple(__errors)
+
+
+def num_compiled_graphs() -> int:
+    """
+    Number of graphs compiled by TorchDynamo so far (including
+    recompilations), or 0 if not available.
+    """
+    try:
+        from torch._dynamo.utils import counters
+        return int(counters['stats']['unique_graphs'])
+    except (ImportError, KeyError):
+        return 0
+
+
+class CompiledForward:
+    """
+    Compiled forward function of a model, which shares the parameters
+    (and the state dict, train/eval mode, etc.) with the model.
+    """
+
+    def __init__(self,
+                 model: nn.Module,
+                 mode: str = 'compile',
+                 dynamic: bool = True,
+                 recompile_limit: int = 8,
+                 backend: str = 'inductor'):
+
+        if mode not in COMPILE_MODES:
+            raise ValueError(f'Compile mode {mode} is not supported.')
+
+        self.__model = model
+        self.__dynamic = dynamic
+        self.__recompile_limit = recompile_limit
+        self.__backend = backend
+
+        self.__mode = None
+        self.__forward = None
+        # Training flags of the successful calls, and whether a training
+        # step succeeded, in the current mode
+        self.__called = set()
+        self.__stepped = False
+        self.__init_forward(COMPILE_MODES.index(mode))
+
+    @property
+    def mode(self) -> str:
+        return self.__mode
+
+    @property
+    def model(self) -> nn.Module:
+        return self.__model
+
+    def __init_forward(self, start: int):
+
+        self.__called = set()
+        self.__stepped = False
+        for __mode in COMPILE_MODES[start:]:
+            # torch.compile is missing before PyTorch 2.0 (AttributeError)
+            # and raises RuntimeError on unsupported Python versions, and
+            # most scripting errors are RuntimeError as well
+            try:
+                if __mode == 'compile':
+                    set_recompile_limit(self.__recompile_limit)
+                    self.__forward = torch.compile(
+                        self.__model, dynamic=self.__dynamic,
+                        backend=self.__backend)
+                elif __mode == 'script':
+                    self.__forward = torch.jit.script(self.__model)
+                else:
+                    self.__forward = self.__model
+                self.__mode = __mode
+                return
+            except (AttributeError, RuntimeError) + \
+                    fallback_errors(__mode) as e:
+                logger.warning(f'Failed to {__mode} the model '
+                               f'({type(e).__name__}: {e}).')
+
+    def train(self, mode: bool = True):
+        self.__model.train(mode)
+        # Scripted modules keep their own training flags
+        if isinstance(self.__forward, torch.jit.ScriptModule):
+            self.__forward.train(mode)
+        return self
+
+    def eval(self):
+        return self.train(False)
+
+    def __fall_back(self, error: Exception):
+        logger.warning(f'Falling back from {self.__mode} mode '
+                       f'({type(error).__name__}: {error}).')
+        self.__init_forward(COMPILE_MODES.index(self.__mode) + 1)
+
+    def __call__(self, *args, **kwargs):
+        while True:
+            __training = self.__model.training
+            try:
+                __output = self.__forward(*args, **kwargs)
+            except fallback_errors(self.__mode) as e:
+                if __training in self.__called:
+                    raise
+                self.__fall_back(e)
+                continue
+            self.__called.add(__training)
+            return __output
+
+    def run_step(self, step_func: callable, *args, **kwargs):
+        """
+        Run a training step step_func(*args, **kwargs), which calls this
+        forward and the backward pass, and repeat it in the next mode if
+        the backward graph fails to compile in the first step of a mode.
+        The step must zero the gradients (before the forward pass) itself.
+        """
+        while True:
+            try:
+                __result = step_func(*args, **kwargs)
+            except fallback_errors(self.__mode) as e:
+                if self.__stepped:
+                    raise
+                self.__fall_back(e)
+                continue
+            self.__stepped = True
+            return __result
@@ -0,0 +1,177 @@
+"""
+    File Name:          MoReL/distributed.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Multi-process data-parallel training on CPU with torch.distributed
+        (gloo backend) on a single node:
+            - launch spawns the local processes and sets up the process
+              group (and optionally the number of intra-op threads per
+              process, so that the processes do not oversubscribe cores)
+            - distributed_sampler shards the training set by rank
+            - wrap_model averages the gradients with DDP all-reduce
+            - main-process-only printing and checkpointing
+
+        Without launch (or with a single process), all the functions fall
+        back to single-process behavior, so the task scripts use the same
+        code path in both cases.
+
+        Usage:
+            def run(args):
+                model = wrap_model(MPNN(...))
+                sampler = distributed_sampler(trn_dataset)
+                ...
+            launch(run, num_procs=4, args=(args, ), threads_per_proc=8)
+"""
+import os
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from typing import Optional
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, DistributedSampler
+
+DEFAULT_MASTER_ADDR = '127.0.0.1'
+DEFAULT_MASTER_PORT = 29500
+
+
+# Process group ###############################################################
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def default_threads_per_proc(num_procs: int) -> int:
+    return max(os.cpu_count() // num_procs, 1)
+
+
+def __worker(rank: int,
+             func: callable,
+             num_procs: int,
+             args: tuple,
+             threads_per_proc: Optional[int],
+             master_addr: str,
+             master_port: int):
+
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = str(master_port)
+    if threads_per_proc is not None:
+        torch.set_num_threads(threads_per_proc)
+
+    dist.init_process_group('gloo', rank=rank, world_size=num_procs)
+    try:
+        func(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(func: callable,
+           num_procs: int,
+           args: tuple = (),
+           threads_per_proc: Optional[int] = None,
+           master_addr: str = DEFAULT_MASTER_ADDR,
+           master_port: int = DEFAULT_MASTER_PORT):
+    """
+    Run func(*args) in num_procs local processes of a gloo process group,
+    or directly in this process if num_procs is 1. The function and its
+    arguments must be picklable (e.g. module-level functions).
+    """
+
+    if num_procs == 1:
+        if threads_per_proc is not None:
+            torch.set_num_threads(threads_per_proc)
+        return func(*args)
+
+    mp.spawn(__worker,
+             args=(func, num_procs, args, threads_per_proc,
+                   master_addr, master_port),
+             nprocs=num_procs,
+             join=True)
+
+
+# Training helpers ############################################################
+def wrap_model(model: nn.Module) -> nn.Module:
+    """
+    DDP (gradient all-reduce) for CPU models in a process group.
+    """
+    if get_world_size() == 1:
+        return model
+    return DistributedDataParallel(model)
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    return model.module if isinstance(model, DistributedDataParallel) \
+        else model
+
+
+def distributed_sampler(dataset: Dataset,
+                        shuffle: bool = True,
+                        seed: int = 0) -> Optional[DistributedSampler]:
+    """
+    Sampler of the shard of the current rank, or None without a process
+    group. Remember to call set_epoch on it at the beginning of epochs.
+    """
+    if get_world_size() == 1:
+        return None
+    return DistributedSampler(dataset, num_replicas=get_world_size(),
+                              rank=get_rank(), shuffle=shuffle, seed=seed)
+
+
+def all_reduce_sum(value):
+    """
+    Sum of a number or a (CPU) tensor over the processes.
+    """
+    if get_world_size() == 1:
+        return value
+    __tensor = torch.as_tensor(value, dtype=torch.float64).clone()
+    dist.all_reduce(__tensor, op=dist.ReduceOp.SUM)
+    return __tensor.item() if isinstance(value, (int, float)) else __tensor
+
+
+def broadcast_value(value: Optional[float], src: int = 0) -> float:
+    """
+    Value of the src rank on all the ranks (e.g. the validation metric
+    computed on the main process for the scheduler and early stopping).
+    """
+    if get_world_size() == 1:
+        return value
+    __tensor = torch.tensor([value if get_rank() == src else 0.],
+                            dtype=torch.float64)
+    dist.broadcast(__tensor, src=src)
+    return __tensor.item()
+
+
+def barrier():
+    if get_world_size() > 1:
+        dist.barrier()
+
+
+def main_print(*args, **kwargs):
+    if is_main_process():
+        print(*args, **kwargs)
+
+
+def save_checkpoint(path: str, model: nn.Module, **extra):
+    """
+    Save the state dict of the (unwrapped) model and extra objects (e.g.
+    optimizer state dict, epoch) on the main process only.
+    """
+    if is_main_process():
+        torch.save({'model': unwrap_model(model).state_dict(), **extra},
+                   path)
+    barrier()
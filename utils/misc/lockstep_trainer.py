@@ -0,0 +1,302 @@
+"""
+    File Name:          MoReL/lockstep_trainer.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Train several model configurations in lockstep on a single
+        dataloader. Each batch is fetched (and featurized) once, moved to
+        the device once, and then used for the forward/backward pass of
+        every model that is still training. Learning rate scheduling,
+        best metrics and early stopping are tracked per model; models that
+        stop early simply drop out of the loop. The forward passes and the
+        losses run in the given precision, as in Trainer.
+"""
+import time
+import logging
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Optional, List, Dict
+
+from utils.misc.precision import autocast
+from utils.misc.trainer import batch_to_device
+
+logger = logging.getLogger(__name__)
+
+
+class LockstepMember:
+    """
+    A single model configuration (model, optimizer and scheduler) together
+    with its training status.
+    """
+
+    def __init__(self,
+                 model: nn.Module,
+                 optimizer: torch.optim.Optimizer,
+                 scheduler=None,
+                 name: Optional[str] = None,
+                 early_stop_patience: Optional[int] = None):
+
+        self.model = model
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.name = name
+        self.early_stop_patience = early_stop_patience
+
+        self.best_metric = None
+        self.best_epoch = None
+        self.early_stop_counter = 0
+        self.stopped = False
+
+    def __str__(self):
+        return self.name
+
+
+class LockstepTrainer:
+
+    def __init__(self,
+                 members: List[LockstepMember],
+                 forward_func: callable,
+                 loss_func: callable = F.mse_loss,
+                 device: torch.device = torch.device('cpu'),
+                 higher_is_better: bool = True,
+                 precision: str = 'fp32'):
+        """
+        :param members: list of model configurations to train together
+        :param forward_func: function that takes (model, batch) on device
+            and returns the prediction and target tensors
+        :param loss_func: function that takes (prediction, target)
+        :param device: device for all the models and batches
+        :param higher_is_better: direction of the evaluation metric used
+            for scheduling and early stopping
+        :param precision: precision of the forward passes and the loss
+            (see utils/misc/precision.py)
+        """
+
+        self.__members = members
+        self.__forward_func = forward_func
+        self.__loss_func = loss_func
+        self.__device = device
+        self.__higher_is_better = higher_is_better
+        self.__precision = precision
+        self.samples_per_second = 0.
+
+        for __i, __member in enumerate(self.__members):
+            if __member.name is None:
+                __member.name = f'model_{__i}'
+            __member.model.to(self.__device)
+
+    @property
+    def members(self) -> List[LockstepMember]:
+        return self.__members
+
+    @property
+    def active_members(self) -> List[LockstepMember]:
+        return [m for m in self.__members if not m.stopped]
+
+    def train_epoch(self, loader) -> Dict[str, float]:
+        """
+        Train the active members for an epoch, and return their average
+        losses. The aggregate throughput of the epoch (samples of all the
+        active members per second) is in samples_per_second.
+        """
+
+        active_members = self.active_members
+        if len(active_members) == 0:
+            return {}
+        for __member in active_members:
+            __member.model.train()
+
+        # Accumulate the losses as tensors to avoid one sync per model/batch
+        trn_losses = torch.zeros(len(active_members), device=self.__device)
+        num_samples = 0
+
+        __start_time = time.perf_counter()
+        for batch in loader:
+            batch = batch_to_device(batch, self.__device)
+
+            for __i, __member in enumerate(active_members):
+                __member.optimizer.zero_grad()
+                with autocast(self.__precision, self.__device):
+                    pred, trgt = self.__forward_func(__member.model, batch)
+                    loss = self.__loss_func(pred.float(), trgt)
+                loss.backward()
+                __member.optimizer.step()
+                __batch_size = trgt.shape[0]
+                trn_losses[__i] += loss.detach() * __batch_size
+
+            num_samples += __batch_size
+
+        trn_losses = (trn_losses / max(num_samples, 1)).tolist()
+        __seconds = time.perf_counter() - __start_time
+        self.samples_per_second = \
+            num_samples * len(active_members) / max(__seconds, 1e-9)
+        return {m.name: l for m, l in zip(active_members, trn_losses)}
+
+    def evaluate(self,
+                 loader,
+                 metric_func: callable) -> Dict[str, float]:
+        """
+        :param metric_func: function that takes the concatenated
+            (prediction, target) tensors of the whole loader on CPU and
+            returns a single scalar
+        """
+
+        active_members = self.active_members
+        if len(active_members) == 0:
+            return {}
+        for __member in active_members:
+            __member.model.eval()
+
+        preds = [[] for _ in active_members]
+        trgts = []
+
+        with torch.no_grad():
+            for batch in loader:
+                batch = batch_to_device(batch, self.__device)
+                for __i, __member in enumerate(active_members):
+                    with autocast(self.__precision, self.__device):
+                        pred, trgt = self.__forward_func(__member.model,
+                                                         batch)
+                    preds[__i].append(pred.float().cpu())
+                trgts.append(trgt.float().cpu())
+
+        trgt = torch.cat(trgts)
+        return {m.name: float(metric_func(torch.cat(p), trgt))
+                for m, p in zip(active_members, preds)}
+
+    def accumulate(self,
+                   loader,
+                   update_funcs: Dict[str, callable]):
+        """
+        Streaming evaluation of the active members in a single pass over
+        the loader, which calls update_funcs[name](pred, trgt, batch) of
+        every member on every batch (e.g. to update the accumulators in
+        utils/misc/metrics.py).
+        """
+
+        active_members = self.active_members
+        for __member in active_members:
+            __member.model.eval()
+
+        with torch.no_grad():
+            for batch in loader:
+                batch = batch_to_device(batch, self.__device)
+                for __member in active_members:
+                    with autocast(self.__precision, self.__device):
+                        pred, trgt = self.__forward_func(__member.model,
+                                                         batch)
+                    update_funcs[__member.name](
+                        pred.float(), trgt.float(), batch)
+
+    def step(self,
+             metrics: Dict[str, float],
+             epoch: int) -> List[LockstepMember]:
+        """
+        Update the schedulers, best metrics and early stopping counters
+        with the evaluation metrics of the current epoch.
+        Returns the list of members that improved in this epoch.
+        """
+
+        improved_members = []
+        for __member in self.active_members:
+            metric = metrics[__member.name]
+
+            if __member.scheduler is not None:
+                if isinstance(__member.scheduler,
+                              torch.optim.lr_scheduler.ReduceLROnPlateau):
+                    __member.scheduler.step(metric)
+                else:
+                    __member.scheduler.step()
+
+            if __member.best_metric is None:
+                __improved = True
+            elif self.__higher_is_better:
+                __improved = metric > __member.best_metric
+            else:
+                __improved = metric < __member.best_metric
+
+            if __improved:
+                __member.best_metric = metric
+                __member.best_epoch = epoch
+                __member.early_stop_counter = 0
+                improved_members.append(__member)
+            else:
+                __member.early_stop_counter += 1
+                if (__member.early_stop_patience is not None) and \
+                        (__member.early_stop_counter >=
+                         __member.early_stop_patience):
+                    logger.info(f'{__member.name} stopped early at epoch '
+                                f'{epoch} (best epoch {__member.best_epoch})')
+                    __member.stopped = True
+
+        return improved_members
+
+    def fit(self,
+            trn_loader,
+            val_loader,
+            metric_func: callable,
+            max_num_epochs: int) -> Dict[str, tuple]:
+        """
+        Train all the members until they either stop early or reach the
+        maximum number of epochs. Returns the best (metric, epoch) for
+        each member.
+        """
+
+        for epoch in range(1, max_num_epochs + 1):
+            if len(self.active_members) == 0:
+                break
+
+            trn_losses = self.train_epoch(trn_loader)
+            val_metrics = self.evaluate(val_loader, metric_func)
+            self.step(val_metrics, epoch)
+
+            for __name, __loss in trn_losses.items():
+                print(f'Epoch: {epoch:03d}, Model: {__name}, '
+                      f'Loss: {__loss:.4f}, '
+                      f'Validation Metric: {val_metrics[__name]:.4f}')
+            print(f'Epoch: {epoch:03d}, Training Throughput: '
+                  f'{self.samples_per_second:.1f} samples/s '
+                  f'({len(trn_losses)} models)')
+
+        return {m.name: (m.best_metric, m.best_epoch) for m in self.__members}
+
+
+# Testing segment with a few MLPs of different widths and learning rates
+if __name__ == '__main__':
+
+    from torch.utils.data import TensorDataset, DataLoader
+
+    torch.manual_seed(0)
+    __x = torch.randn(8192, 64)
+    __y = (__x[:, :8].sum(dim=1, keepdim=True) > 0).float()
+    __trn_loader = DataLoader(TensorDataset(__x[:6144], __y[:6144]),
+                              batch_size=32, shuffle=True)
+    __val_loader = DataLoader(TensorDataset(__x[6144:], __y[6144:]),
+                              batch_size=256)
+
+    def __forward(model, batch):
+        return model(batch[0]), batch[1]
+
+    def __neg_mse(pred, trgt):
+        return -F.mse_loss(pred, trgt).item()
+
+    __members = []
+    for state_dim in [32, 64, 128]:
+        for lr in [1e-3, 1e-4]:
+            __model = nn.Sequential(nn.Linear(64, state_dim), nn.ReLU(),
+                                    nn.Linear(state_dim, 1))
+            __optimizer = torch.optim.Adam(__model.parameters(), lr=lr)
+            __members.append(LockstepMember(
+                model=__model, optimizer=__optimizer,
+                name=f'mlp(state_dim={state_dim}, lr={lr})',
+                early_stop_patience=3))
+
+    __start_time = time.time()
+    trainer = LockstepTrainer(__members, forward_func=__forward)
+    print(trainer.fit(__trn_loader, __val_loader, __neg_mse, 10))
+    print(f'Trained {len(__members)} models in lockstep in '
+          f'{time.time() - __start_time:.2f} seconds.')
@@ -0,0 +1,172 @@
+"""
+    File Name:          MoReL/metrics.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Streaming metric accumulators for the evaluation loops, which keep
+        constant-size sufficient statistics on the device (instead of
+        collecting all the predictions and targets for sklearn):
+            - RegressionMetrics:    R2, MAE and MSE per target, from the
+                                    count, sum(y), sum(y^2), sum of squared
+                                    errors and sum of absolute errors
+            - BinaryMetrics:        accuracy, balanced accuracy, MCC and
+                                    TPR/TNR/FPR/FNR from confusion matrices
+
+        Both of them optionally accumulate the statistics per group (e.g.
+        data source) in the same pass, and the overall metrics are
+        computed from the sums over the groups.
+
+        Usage:
+            reg_metrics = RegressionMetrics(num_groups=5, device=device)
+            for pred, trgt, source in ...:
+                reg_metrics.update(pred, trgt, groups=source)
+            r2 = reg_metrics.result()['r2']
+            r2_per_source = reg_metrics.result(grouped=True)['r2']
+"""
+import torch
+from typing import Dict, Optional
+
+
+def safe_divide(numerator: torch.Tensor,
+                denominator: torch.Tensor,
+                default: float) -> torch.Tensor:
+    return torch.where(denominator > 0,
+                       numerator / denominator.clamp(min=1e-300),
+                       torch.full_like(numerator, default))
+
+
+class RegressionMetrics:
+
+    def __init__(self,
+                 num_targets: int = 1,
+                 num_groups: int = 1,
+                 device: torch.device = torch.device('cpu')):
+
+        self.__num_targets = num_targets
+        self.__num_groups = num_groups
+        self.__device = device
+        self.__sums = None
+        self.reset()
+
+    def reset(self):
+        # count, sum(y), sum(y^2), sum((p - y)^2), sum(|p - y|)
+        self.__sums = torch.zeros(
+            5, self.__num_groups, self.__num_targets,
+            dtype=torch.float64, device=self.__device)
+
+    def update(self,
+               pred: torch.Tensor,
+               trgt: torch.Tensor,
+               groups: Optional[torch.Tensor] = None):
+        """
+        :param pred: predictions [batch_size] or [batch_size, num_targets]
+        :param trgt: targets of the same shape as pred
+        :param groups: group indices [batch_size] in [0, num_groups)
+        """
+
+        __trgt = trgt.detach().to(self.__sums).reshape(
+            -1, self.__num_targets)
+        __error = pred.detach().to(self.__sums).reshape(__trgt.shape) - \
+            __trgt
+        __stats = torch.stack([torch.ones_like(__trgt), __trgt, __trgt ** 2,
+                               __error ** 2, __error.abs()])
+
+        if groups is None:
+            self.__sums[:, 0] += __stats.sum(dim=1)
+        else:
+            self.__sums.index_add_(
+                1, groups.to(self.__device).view(-1), __stats)
+
+    def result(self, grouped: bool = False) -> Dict[str, torch.Tensor]:
+        """
+        Metrics of the shape [num_targets], or [num_groups, num_targets]
+        if grouped. As in sklearn, R2 of constant targets is 1 for perfect
+        predictions and 0 otherwise.
+        """
+
+        __sums = self.__sums if grouped else self.__sums.sum(dim=1)
+        __count, __sum, __sqsum, __sse, __sae = __sums
+
+        __sst = __sqsum - safe_divide(__sum ** 2, __count, 0.)
+        __r2 = torch.where(
+            __sst > 0, 1. - safe_divide(__sse, __sst, 0.),
+            (__sse == 0).to(__sse))
+
+        return {
+            'r2': __r2,
+            'mae': safe_divide(__sae, __count, float('nan')),
+            'mse': safe_divide(__sse, __count, float('nan')),
+            'count': __count, }
+
+
+class BinaryMetrics:
+    """
+    Metrics of binarized regression targets (e.g. AUC of drug response),
+    where the positives are values below (or at and above) a threshold.
+    """
+
+    def __init__(self,
+                 threshold: float,
+                 positive_below: bool = True,
+                 num_groups: int = 1,
+                 device: torch.device = torch.device('cpu')):
+
+        self.__threshold = threshold
+        self.__positive_below = positive_below
+        self.__num_groups = num_groups
+        self.__device = device
+        self.__counts = None
+        self.reset()
+
+    def reset(self):
+        # Confusion matrices flattened as (tn, fp, fn, tp) per group
+        self.__counts = torch.zeros(self.__num_groups, 4, dtype=torch.long,
+                                    device=self.__device)
+
+    def __binarize(self, values: torch.Tensor) -> torch.Tensor:
+        __values = values.detach().to(self.__device).view(-1)
+        return (__values < self.__threshold) if self.__positive_below \
+            else (__values >= self.__threshold)
+
+    def update(self,
+               pred: torch.Tensor,
+               trgt: torch.Tensor,
+               groups: Optional[torch.Tensor] = None):
+
+        __cells = 2 * self.__binarize(trgt).long() + \
+            self.__binarize(pred).long()
+        if groups is not None:
+            __cells = __cells + 4 * groups.to(self.__device).view(-1)
+        self.__counts.view(-1).index_add_(
+            0, __cells, torch.ones_like(__cells))
+
+    def result(self, grouped: bool = False) -> Dict[str, torch.Tensor]:
+        """
+        Metrics (scalars, or of the shape [num_groups] if grouped). TPR
+        (TNR) is 1 if there are no positives (negatives), and MCC is 0 if
+        any of the marginal counts is 0, as in sklearn.
+        """
+
+        __counts = (self.__counts if grouped
+                    else self.__counts.sum(dim=0)).double()
+        __tn, __fp, __fn, __tp = __counts.unbind(dim=-1)
+
+        __tpr = safe_divide(__tp, __tp + __fn, 1.)
+        __tnr = safe_divide(__tn, __tn + __fp, 1.)
+        __mcc = safe_divide(
+            __tp * __tn - __fp * __fn,
+            torch.sqrt((__tp + __fp) * (__tp + __fn) *
+                       (__tn + __fp) * (__tn + __fn)), 0.)
+
+        return {
+            'acc': safe_divide(__tp + __tn, __counts.sum(dim=-1),
+                               float('nan')),
+            'bal_acc': (__tpr + __tnr) / 2.,
+            'mcc': __mcc,
+            'tpr': __tpr,
+            'tnr': __tnr,
+            'fpr': 1. - __tnr,
+            'fnr': 1. - __tpr, }
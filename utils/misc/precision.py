@@ -0,0 +1,103 @@
+"""
+    File Name:          MoReL/precision.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Mixed precision (bfloat16 autocast) for the task scripts, on CPU as
+        well as on GPU. bfloat16 has the same exponent range as float32,
+        so no loss scaling is needed.
+
+        The scatter/segment operations of the graph layers (message
+        aggregation, segment softmax of attention, and global pooling)
+        accumulate over a variable number of elements, and lose too much
+        precision in bfloat16 with only 8 bits of mantissa. The graph
+        layers in this repo run these operations in float32 on their own
+        (see network/common/fp32_ops.py). For the PyG layers, keep_fp32
+        runs the aggregation of the message passing layers and the
+        pooling layers with autocast disabled and float32 inputs, while
+        everything else (edge networks, GRU, output heads, etc.) runs in
+        bfloat16.
+
+        Usage:
+            model = keep_fp32(MPNN(...))
+            with autocast(args.precision, device):
+                loss = F.mse_loss(model(data).float(), data.y)
+            loss.backward()
+"""
+import torch
+import contextlib
+import torch.nn as nn
+import torch_geometric.nn as pyg_nn
+from typing import Dict, Optional, Tuple
+
+from network.common.fp32_ops import fp32_op
+
+PRECISIONS = ['fp32', 'bf16']
+
+# Methods of the PyG modules that are run in float32: the aggregation of
+# the messages, and the whole forward pass of the pooling layers
+FP32_METHODS = {t: m for t, m in (
+    (pyg_nn.MessagePassing, ('aggregate', 'message_and_aggregate')),
+    (getattr(pyg_nn, 'GlobalAttention', None), ('forward', )),
+    (getattr(pyg_nn, 'Set2Set', None), ('forward', )), ) if t is not None}
+
+
+def autocast(precision: str, device: torch.device):
+    """
+    Autocast context for the forward pass and the loss.
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision == 'bf16':
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    raise ValueError(f'Precision {precision} is not supported.')
+
+
+class FP32Method:
+    """
+    Replacement of a method of a module (as an instance attribute), which
+    calls the method of its class in float32 (see fp32_op). The state dict
+    is unchanged, and the module can still be copied and pickled.
+    """
+
+    def __init__(self, module: nn.Module, name: str):
+        self.module = module
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        return fp32_op(getattr(type(self.module), self.name),
+                       self.module, *args, **kwargs)
+
+
+def keep_fp32(model: nn.Module,
+              module_methods: Optional[Dict[type, Tuple[str, ...]]] = None) \
+        -> nn.Module:
+    """
+    Run the given methods of the submodules of the given types (outermost
+    ones only) in float32, with autocast disabled in a with block around
+    the method calls. The model is modified in place and returned.
+    """
+
+    module_methods = FP32_METHODS if module_methods is None \
+        else module_methods
+    module_types = tuple(module_methods.keys())
+
+    __wrapped_names = []
+    for __name, __module in model.named_modules():
+        if not isinstance(__module, module_types) or any(
+                __name.startswith(n + '.') for n in __wrapped_names):
+            continue
+        for __type, __methods in module_methods.items():
+            if not isinstance(__module, __type):
+                continue
+            for __method in __methods:
+                if hasattr(type(__module), __method) and \
+                        not isinstance(getattr(__module, __method),
+                                       FP32Method):
+                    setattr(__module, __method,
+                            FP32Method(__module, __method))
+        __wrapped_names.append(__name)
+    return model
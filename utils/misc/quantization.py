@@ -0,0 +1,165 @@
+"""
+    File Name:          MoReL/quantization.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Dynamic int8 quantization for CPU inference. The weights of the
+        selected nn.Linear layers are quantized ahead of time, and the
+        activations are quantized on the fly with the scales of every
+        batch, so no calibration data is needed; the accuracy of the
+        quantized model is instead checked against fp32 on held-out data
+        with quantization_report.
+
+        The quantized layers per model:
+            - SimpleUno:        all the Linear layers, after folding the
+                                BatchNorm layers (SimpleUno.export)
+            - MPNN/GCN/GAT:     the output heads (out_linear)
+            - Transformer:      the feed-forward blocks
+            - others:           the Linear layers outside of the graph
+                                convolutions (e.g. not the edge networks
+                                of NNConv, which generate the weights of
+                                the messages)
+
+        The layers are always selected by name in the qconfig dict, so
+        that the Linear layers elsewhere in the model stay in fp32.
+"""
+import io
+import copy
+import time
+import torch
+import platform
+import torch.nn as nn
+import torch_geometric.nn as pyg_nn
+from typing import Callable, Optional, Set
+
+from network.simple_uno import SimpleUno
+from network.gnn.gat.gat import EdgeGATEncoder, RelationalGATConv
+from network.gnn.gcn.gcn import EdgeGCNEncoder, FusedEdgeGCN
+from network.gnn.mpnn.mpnn import MPNN, TypedNNConv
+from network.gnn.ggnn.propagator import SparsePropagator
+from network.transformer.feed_forward import FeedForward
+
+# torch.ao.quantization replaces torch.quantization in PyTorch >= 1.10
+try:
+    from torch.ao.quantization import quantize_dynamic, \
+        default_dynamic_qconfig
+except ImportError:
+    from torch.quantization import quantize_dynamic, default_dynamic_qconfig
+
+GRAPH_ENCODERS = (MPNN, EdgeGCNEncoder, EdgeGATEncoder)
+
+# Graph convolutions, of which the Linear layers are never quantized
+GRAPH_CONV_MODULES = (pyg_nn.MessagePassing, TypedNNConv,
+                      RelationalGATConv, FusedEdgeGCN, SparsePropagator)
+
+
+# Helper functions ############################################################
+def set_quantized_engine():
+    """
+    Use fbgemm on x86 and qnnpack on ARM CPUs, if supported.
+    """
+    __engines = torch.backends.quantized.supported_engines
+    __engine = 'qnnpack' if platform.machine().lower() in \
+        ['arm64', 'aarch64'] else 'fbgemm'
+    if __engine in __engines:
+        torch.backends.quantized.engine = __engine
+
+
+def model_size(model: nn.Module) -> int:
+    """
+    Size of the serialized state dict in bytes.
+    """
+    __buffer = io.BytesIO()
+    torch.save(model.state_dict(), __buffer)
+    return __buffer.tell()
+
+
+def linear_names(model: nn.Module,
+                 prefixes: Optional[Set[str]] = None,
+                 excluded_types: tuple = ()) -> Set[str]:
+    """
+    Names of the Linear layers in the submodules with the given names (or
+    anywhere in the model), except for those in submodules of the
+    excluded types.
+    """
+    __excluded = [n for n, m in model.named_modules()
+                  if excluded_types and isinstance(m, excluded_types)]
+    return {n for n, m in model.named_modules()
+            if isinstance(m, nn.Linear) and
+            ((prefixes is None) or
+             any(n.startswith(p + '.') for p in prefixes)) and
+            (not any(n.startswith(e + '.') for e in __excluded))}
+
+
+def quantized_module_names(model: nn.Module) -> Set[str]:
+    """
+    Names of the Linear layers to quantize.
+    """
+    if isinstance(model, GRAPH_ENCODERS):
+        return linear_names(model, {n for n, _ in model.named_modules()
+                                    if n.endswith('__out_linear')})
+    __ff_names = {n for n, m in model.named_modules()
+                  if isinstance(m, FeedForward)}
+    if __ff_names:
+        return linear_names(model, __ff_names)
+    return linear_names(model, excluded_types=GRAPH_CONV_MODULES)
+
+
+# Quantization ################################################################
+def quantize_linear(model: nn.Module,
+                    module_names: Optional[Set[str]] = None) -> nn.Module:
+    """
+    Copy of an (eval mode, CPU) model with the given Linear layers (or all
+    the Linear layers) dynamically quantized to int8.
+    """
+    set_quantized_engine()
+    model = copy.deepcopy(model).cpu().eval()
+    if module_names is None:
+        module_names = linear_names(model)
+    qconfig_spec = {__name: default_dynamic_qconfig
+                    for __name in module_names}
+    return quantize_dynamic(model, qconfig_spec=qconfig_spec,
+                            dtype=torch.qint8)
+
+
+def quantize_for_inference(model: nn.Module) -> nn.Module:
+
+    if isinstance(model, SimpleUno):
+        return quantize_linear(
+            copy.deepcopy(model).cpu().export(script=False))
+    return quantize_linear(model, quantized_module_names(model))
+
+
+def quantization_report(eval_func: Callable[[nn.Module], tuple],
+                        model: nn.Module,
+                        quantized_model: nn.Module) -> dict:
+    """
+    Compare the fp32 and the quantized model on CPU.
+
+    :param eval_func: function that evaluates a model on the held-out
+        data (on CPU) and returns (r2, mae)
+    """
+
+    report = {}
+    for __name, __model in [('fp32', copy.deepcopy(model).cpu().eval()),
+                            ('int8', quantized_model)]:
+        __start_time = time.time()
+        with torch.no_grad():
+            __r2, __mae = eval_func(__model)
+        report[__name] = {
+            'r2': float(__r2),
+            'mae': float(__mae),
+            'seconds': time.time() - __start_time,
+            'size_mb': model_size(__model) / 2 ** 20, }
+
+    print(f'{"":6s}{"R2":>10s}{"MAE":>10s}{"Time(s)":>10s}{"Size(MB)":>10s}')
+    for __name, __result in report.items():
+        print(f'{__name:6s}{__result["r2"]:10.4f}{__result["mae"]:10.4f}'
+              f'{__result["seconds"]:10.2f}{__result["size_mb"]:10.2f}')
+    __fp32, __int8 = report['fp32'], report['int8']
+    print(f'R2 drop: {__fp32["r2"] - __int8["r2"]:.4f}, '
+          f'speedup: {__fp32["seconds"] / __int8["seconds"]:.2f}x')
+    return report
@@ -11,11 +11,12 @@ import torch
 
 
 def is_sparse(tensor: torch.Tensor):
-    return tensor.type().startswith('torch.sparse')
+    # Layout covers both COO and compressed (CSR) sparse tensors
+    return tensor.layout != torch.strided
 
 
 def is_dense(tensor: torch.Tensor):
-    return not tensor.type().startswith('torch.sparse')
+    return tensor.layout == torch.strided
 
 
 def to_dense(tensor: torch.Tensor):
@@ -0,0 +1,297 @@
+"""
+    File Name:          MoReL/trainer.py
+    Author:             Xiaotian Duan (xduan7)
+    Email:              xduan7@uchicago.edu
+    Date:               10/19/26
+    Python Version:     3.5.4
+    File Description:
+
+        Training and inference loops shared by the task scripts.
+
+        BatchPrefetcher iterates over a dataloader in a background thread,
+        which keeps up to num_prefetch collated (and optionally pinned)
+        batches ready, so that loading and collating the next batches
+        overlaps with the computation of the current one. The batches are
+        moved to the device with non-blocking copies (asynchronous from
+        pinned memory). The time that the training loop spends waiting for
+        batches is measured, and a high fraction of waiting time means
+        that the training is bound by the data loading.
+
+        Trainer runs the loops with callbacks of the task:
+            forward_func(model, batch) -> (pred, trgt), batch first
+            loss_func(pred, trgt) -> loss (a scalar or a vector, e.g. the
+                losses of ensemble members, which are summed for backward)
+            metric_func(pred_array, trgt_array) -> metrics
+            update_func(pred, trgt, batch), for streaming evaluation
+
+        Usage:
+            trainer = Trainer(model, optimizer,
+                              forward_func=lambda m, d: (m(d), d.y),
+                              loss_func=F.mse_loss, device=device)
+            trn_result = trainer.train_epoch(trn_loader, epoch)
+            r2 = trainer.evaluate(tst_loader, r2_metric)
+"""
+import time
+import queue
+import torch
+import threading
+import numpy as np
+import torch.nn as nn
+from typing import Callable, Iterable, Optional, Tuple
+
+from utils.misc.precision import autocast
+from utils.misc.distributed import all_reduce_sum
+
+# Timeout (in seconds) of the background thread waiting for space in the
+# queue, after which it checks if the prefetcher is closed
+PUT_TIMEOUT = 0.1
+
+
+# Helper functions ############################################################
+def pin_batch(batch):
+    """
+    Pin the tensors of a batch (tensors, PyG batches, and nested tuples,
+    lists and dicts of them) in page-locked memory.
+    """
+    if isinstance(batch, torch.Tensor):
+        return batch if batch.is_pinned() else batch.pin_memory()
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(pin_batch(b) for b in batch)
+    if isinstance(batch, dict):
+        return {k: pin_batch(v) for k, v in batch.items()}
+    if hasattr(batch, 'pin_memory'):
+        return batch.pin_memory()
+    return batch
+
+
+def batch_to_device(batch, device: torch.device):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, (tuple, list)):
+        return type(batch)(batch_to_device(b, device) for b in batch)
+    if isinstance(batch, dict):
+        return {k: batch_to_device(v, device) for k, v in batch.items()}
+    if hasattr(batch, 'to'):
+        return batch.to(device, non_blocking=True)
+    return batch
+
+
+# Prefetching #################################################################
+class BatchPrefetcher:
+
+    def __init__(self,
+                 loader: Iterable,
+                 device: torch.device,
+                 num_prefetch: int = 2,
+                 pin_memory: bool = False):
+
+        self.__loader = loader
+        self.__device = device
+        self.__num_prefetch = num_prefetch
+        self.__pin_memory = pin_memory and (device.type == 'cuda')
+
+        self.__queue = None
+        self.__thread = None
+        self.__closed = threading.Event()
+        self.wait_seconds = 0.
+
+    def __put(self, item) -> bool:
+        while not self.__closed.is_set():
+            try:
+                self.__queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __prefetch(self):
+        try:
+            for __batch in self.__loader:
+                if self.__pin_memory:
+                    __batch = pin_batch(__batch)
+                if not self.__put((__batch, None)):
+                    return
+            self.__put((None, None))
+        except Exception as e:
+            self.__put((None, e))
+
+    def __iter__(self):
+        self.close()
+        self.__closed.clear()
+        self.__queue = queue.Queue(maxsize=self.__num_prefetch)
+        self.__thread = threading.Thread(target=self.__prefetch, daemon=True)
+        self.__thread.start()
+        self.wait_seconds = 0.
+
+        try:
+            while True:
+                __start_time = time.perf_counter()
+                __batch, __exception = self.__queue.get()
+                self.wait_seconds += time.perf_counter() - __start_time
+
+                if __exception is not None:
+                    raise __exception
+                if __batch is None:
+                    return
+                yield batch_to_device(__batch, self.__device)
+        finally:
+            # Also when the loop breaks early or raises
+            self.close()
+
+    def close(self):
+        """
+        Stop the background thread (e.g. after breaking out of a loop).
+        """
+        self.__closed.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+
+# Training and inference ######################################################
+class Trainer:
+
+    def __init__(self,
+                 model: nn.Module or Callable,
+                 optimizer,
+                 forward_func: Callable,
+                 loss_func: Callable,
+                 device: torch.device,
+                 precision: str = 'fp32',
+                 num_prefetch: int = 2,
+                 pin_memory: bool = False):
+        """
+        :param model: model (or a compiled forward with train/eval and
+            run_step) for training and the default model for inference
+        :param optimizer: optimizer with zero_grad and step (e.g.
+            torch.optim.Optimizer or EnsembleOptimizer)
+        """
+
+        self.__model = model
+        self.__optimizer = optimizer
+        self.__forward_func = forward_func
+        self.__loss_func = loss_func
+        self.__device = device
+        self.__precision = precision
+        self.__num_prefetch = num_prefetch
+        self.__pin_memory = pin_memory
+
+    def __prefetcher(self,
+                     loader: Iterable,
+                     device: torch.device) -> BatchPrefetcher:
+        return BatchPrefetcher(loader, device, self.__num_prefetch,
+                               self.__pin_memory)
+
+    def train_epoch(self,
+                    loader: Iterable,
+                    epoch: Optional[int] = None,
+                    step_callback: Optional[Callable] = None) -> dict:
+        """
+        Train the model for an epoch.
+
+        :param epoch: epoch number for the distributed sampler of the
+            loader (if any) to shuffle differently in every epoch
+        :param step_callback: function called after every step with
+            (step, loss, num_samples), where loss is the detached loss
+        :return: average loss (over the samples of all the processes),
+            number of samples, and the (waiting) time of the epoch
+        """
+
+        __sampler = getattr(loader, 'sampler', None)
+        if (epoch is not None) and hasattr(__sampler, 'set_epoch'):
+            __sampler.set_epoch(epoch)
+
+        self.__model.train()
+        __prefetcher = self.__prefetcher(loader, self.__device)
+        __start_time = time.perf_counter()
+        __loss_sum, __num_samples = 0., 0
+
+        def __train_step(__batch):
+            self.__optimizer.zero_grad()
+            with autocast(self.__precision, self.__device):
+                __pred, __trgt = self.__forward_func(self.__model, __batch)
+                __loss = self.__loss_func(__pred.float(), __trgt)
+            __loss.sum().backward()
+            return __loss, __trgt
+
+        # Compiled forwards repeat the steps that fail to compile (also
+        # in the backward pass) in their fallback modes
+        __run_step = getattr(self.__model, 'run_step', None)
+        for __step, __batch in enumerate(__prefetcher):
+            __loss, __trgt = __train_step(__batch) if __run_step is None \
+                else __run_step(__train_step, __batch)
+            self.__optimizer.step()
+
+            # Accumulated on the device without synchronization
+            __loss = __loss.detach()
+            __loss_sum = __loss_sum + __loss * __trgt.shape[0]
+            __num_samples += __trgt.shape[0]
+            if step_callback is not None:
+                step_callback(__step, __loss, __trgt.shape[0])
+
+        __seconds = time.perf_counter() - __start_time
+        __loss_sum = all_reduce_sum(torch.as_tensor(__loss_sum).cpu())
+        __num_samples = all_reduce_sum(__num_samples)
+        return {
+            'loss': (__loss_sum / max(__num_samples, 1)).tolist(),
+            'num_samples': int(__num_samples),
+            'seconds': __seconds,
+            'wait_seconds': __prefetcher.wait_seconds,
+            'wait_fraction': __prefetcher.wait_seconds / __seconds
+            if __seconds > 0 else 0., }
+
+    def predict(self,
+                loader: Iterable,
+                model: Optional[nn.Module or Callable] = None,
+                device: Optional[torch.device] = None,
+                precision: Optional[str] = None) -> Tuple[np.array, np.array]:
+        """
+        Predictions and targets of all the batches in the loader, as float
+        arrays of the shape [num_samples, ...], with the training model,
+        device and precision by default.
+        """
+
+        model = self.__model if model is None else model
+        device = self.__device if device is None else device
+        precision = self.__precision if precision is None else precision
+
+        model.eval()
+        __pred_list, __trgt_list = [], []
+        with torch.no_grad():
+            for __batch in self.__prefetcher(loader, device):
+                with autocast(precision, device):
+                    __pred, __trgt = self.__forward_func(model, __batch)
+                __pred_list.append(__pred.float().cpu().numpy())
+                __trgt_list.append(__trgt.float().cpu().numpy())
+
+        return np.concatenate(__pred_list), np.concatenate(__trgt_list)
+
+    def evaluate(self,
+                 loader: Iterable,
+                 metric_func: Callable,
+                 **predict_kwargs):
+        return metric_func(*self.predict(loader, **predict_kwargs))
+
+    def accumulate(self,
+                   loader: Iterable,
+                   update_func: Callable,
+                   model: Optional[nn.Module or Callable] = None,
+                   device: Optional[torch.device] = None,
+                   precision: Optional[str] = None):
+        """
+        Streaming inference, which calls update_func(pred, trgt, batch)
+        on every batch, e.g. to update the metric accumulators (in
+        utils/misc/metrics.py) on the device, without collecting the
+        predictions and targets of all the batches.
+        """
+
+        model = self.__model if model is None else model
+        device = self.__device if device is None else device
+        precision = self.__precision if precision is None else precision
+
+        model.eval()
+        with torch.no_grad():
+            for __batch in self.__prefetcher(loader, device):
+                with autocast(precision, device):
+                    __pred, __trgt = self.__forward_func(model, __batch)
+                update_func(__pred.float(), __trgt.float(), __batch)